@@ -0,0 +1,6 @@
+# Installed as the kegg_extract package, the scripts import each other relative to it (`from .table_store import ...`);
+# run from this folder, as main.sh does, they import each other as top-level modules. Each script picks one or the
+# other by whether it was imported as part of a package, so a module is never loaded under both names.
+from .kegg_cli import main
+
+__all__ = ['main']
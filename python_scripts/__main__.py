@@ -0,0 +1,8 @@
+import sys
+if __package__:
+    from .kegg_cli import main
+else:
+    from kegg_cli import main
+
+# python -m kegg_extract, once installed
+sys.exit(main())
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+from multiprocessing import cpu_count
+if __package__:
+    from .convert_table_to_fasta import convert_table_to_FASTA, OUT_NAMES, TABLE_COLUMNS
+    from .kegg_cli import lazy_import
+else:
+    from convert_table_to_fasta import convert_table_to_FASTA, OUT_NAMES, TABLE_COLUMNS
+    from kegg_cli import lazy_import
+pd = lazy_import('pandas')
+
+TEST_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_data', 'output')
+
+
+def _legacy_convert_table_to_FASTA(file_names, aa_KO_out_file, aa_NoKO_out_file, nt_KO_out_file, nt_NoKO_out_file):
+    # the row-by-row converter used before convert_file, kept for the benchmark (with the No KO nt output fixed)
+    with open(aa_KO_out_file, 'w') as aa_KO_fid, open(aa_NoKO_out_file, 'w') as aa_NoKO_fid, \
+            open(nt_KO_out_file, 'w') as nt_KO_fid, open(nt_NoKO_out_file, 'w') as nt_NoKO_fid:
+        for filename in file_names:
+            df = pd.read_csv(filename, sep='\t', lineterminator='\n', header=0, keep_default_na=False)
+            df = df.reset_index()
+            for _, row in df.iterrows():
+                index, kegg_gene_id, desc, koid, aaseq, ntseq = row
+                header = "|".join([kegg_gene_id, desc, koid])
+                if koid:
+                    if aaseq:
+                        aa_KO_fid.write(f">{header}\n{aaseq}\n")
+                    if ntseq:
+                        nt_KO_fid.write(f">{header}\n{ntseq}\n")
+                else:
+                    if aaseq:
+                        aa_NoKO_fid.write(f">{header}\n{aaseq}\n")
+                    if ntseq:
+                        nt_NoKO_fid.write(f">{header}\n{ntseq}\n")
+
+
+def _read_fasta(path):
+    records = dict()
+    header = None
+    with open(path) as fid:
+        for line in fid:
+            if line.startswith('>'):
+                header = line[1:].rstrip('\n')
+            elif header is not None:
+                records[header] = line.strip()
+    return records
+
+
+def render_fixture_tables(fasta_dir, table_dir, genes_per_table=500):
+    """
+    Render the FASTA files in fasta_dir back into KEGG gene tables
+    :param fasta_dir: the directory with the four FASTA files of OUT_NAMES
+    :param table_dir: the directory to write the gene tables to
+    :param genes_per_table: the number of genes per table
+    :return: a list of the table files
+    """
+    aa = {**_read_fasta(os.path.join(fasta_dir, OUT_NAMES[0])), **_read_fasta(os.path.join(fasta_dir, OUT_NAMES[1]))}
+    nt = {**_read_fasta(os.path.join(fasta_dir, OUT_NAMES[2])), **_read_fasta(os.path.join(fasta_dir, OUT_NAMES[3]))}
+    rows = [header.split('|') + [aa.get(header, ''), nt.get(header, '')] for header in dict.fromkeys(list(aa) + list(nt))]
+    file_names = []
+    for i in range(0, len(rows), genes_per_table):
+        file_name = os.path.join(table_dir, f"table{i // genes_per_table:05d}_kegg_genes.txt")
+        pd.DataFrame(rows[i:i + genes_per_table], columns=TABLE_COLUMNS).to_csv(file_name, sep='\t', index=None)
+        file_names.append(file_name)
+    return file_names
+
+
+def benchmark(file_names, processes, repeat=3):
+    """
+    Measure the conversion throughput of the row-by-row converter and convert_table_to_FASTA
+    :param file_names: the KEGG gene tables to convert
+    :param processes: the number of worker processes of convert_table_to_FASTA
+    :param repeat: the number of timed passes (the fastest one is reported)
+    :return: a dict of method -> MB/s of input tables
+    """
+    n_bytes = sum(os.path.getsize(x) for x in file_names)
+    out_dir = tempfile.mkdtemp()
+    stats = dict()
+    outputs = dict()
+    methods = [('iterrows', lambda *out: _legacy_convert_table_to_FASTA(file_names, *out)),
+               ('vectorized', lambda *out: convert_table_to_FASTA(file_names, *out, processes=1)),
+               (f'vectorized, {processes} processes', lambda *out: convert_table_to_FASTA(file_names, *out, processes=processes))]
+    stdout = sys.stdout
+    try:
+        for name, method in methods:
+            out_files = [os.path.join(out_dir, f"{len(outputs)}_{x}") for x in OUT_NAMES]
+            best = None
+            for _ in range(repeat):
+                sys.stdout = open(os.devnull, 'w')
+                start = time.perf_counter()
+                method(*out_files)
+                elapsed = time.perf_counter() - start
+                sys.stdout.close()
+                sys.stdout = stdout
+                best = elapsed if best is None else min(best, elapsed)
+            stats[name] = n_bytes / 1e6 / best
+            outputs[name] = []
+            for x in out_files:
+                with open(x) as fid:
+                    outputs[name].append(fid.read())
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(out_dir)
+    for name in outputs:
+        if outputs[name] != outputs['iterrows']:
+            raise Exception(f"The {name} converter does not reproduce the row-by-row output")
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the throughput of convert_table_to_fasta.py in MB/s on gene tables rendered from FASTA files")
+    parser.add_argument("--fasta_dir", type=str, help="The folder of the four FASTA files the gene tables are rendered from", default=TEST_DATA)
+    parser.add_argument("--processes", type=int, help="The number of worker processes of the parallel pass", default=cpu_count())
+    args = parser.parse_args(argv)
+
+    table_dir = tempfile.mkdtemp()
+    try:
+        file_names = render_fixture_tables(args.fasta_dir, table_dir)
+        print(f"{len(file_names)} tables ({sum(os.path.getsize(x) for x in file_names) / 1e6:.1f} MB)")
+        for method, rate in benchmark(file_names, args.processes).items():
+            print(f"{method}: {rate:.1f} MB/s")
+    finally:
+        shutil.rmtree(table_dir)
+
+
+if __name__ == '__main__':
+    main()
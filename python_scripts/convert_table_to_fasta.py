@@ -1,12 +1,276 @@
 #!/usr/bin/env python
 import os
-import sys
+import json
+import hashlib
+import itertools
+import shutil
+import tempfile
 from os import listdir
 from os.path import isfile, join
-import pandas as pd
+from multiprocessing import Pool, cpu_count
 import argparse
+from functools import partial
+from bisect import bisect_right
+if __package__:
+    from .seq_store import SequenceStore
+    from .fasta_index import FastaIndexWriter, index_path
+    from .metrics import METRICS, Progress, add_metrics_arguments, metrics_from_args
+    from .kegg_cli import lazy_import
+else:
+    from seq_store import SequenceStore
+    from fasta_index import FastaIndexWriter, index_path
+    from metrics import METRICS, Progress, add_metrics_arguments, metrics_from_args
+    from kegg_cli import lazy_import
+pd = lazy_import('pandas')
 
-def convert_table_to_FASTA(file_names, aa_KO_out_file, aa_NoKO_out_file, nt_KO_out_file, nt_NoKO_out_file):
+# the order of the outputs returned by convert_file
+OUT_NAMES = ["kegg_genes_KO.faa", "kegg_genes_No_KO.faa", "kegg_genes_KO.fna", "kegg_genes_No_KO.fna"]
+TABLE_COLUMNS = ['kegg_gene_id', 'desc', 'koid', 'aaseq', 'ntseq']
+# the version of the manifest written by convert_table_to_FASTA; a manifest of another version triggers a full conversion
+MANIFEST_VERSION = 1
+
+
+def _fasta_records(headers, seqs, mask):
+    mask = mask & (seqs != '')
+    if not mask.any():
+        return ''
+    return (headers[mask] + seqs[mask]).str.cat(sep='\n') + '\n'
+
+
+def iter_fasta_chunks(filename, chunksize=100000, seq_store=None):
+    """
+    Convert one KEGG gene table into FASTA records, one chunk of rows at a time
+    :param filename: a KEGG gene table with the columns kegg_gene_id, desc, koid, aaseq and ntseq
+    :param chunksize: the number of rows read at a time
+    :param seq_store: the folder of a seq_store.SequenceStore that holds the sequences left empty in the table
+    :return: a generator of lists of four strings with the records of a chunk for aa KO, aa No KO, nt KO and nt No KO
+             (the order of OUT_NAMES)
+    """
+    try:
+        reader = pd.read_csv(filename, sep='\t', lineterminator='\n', header=0, keep_default_na=False, dtype=str,
+                             usecols=TABLE_COLUMNS, chunksize=chunksize)
+    except ValueError:
+        print(f"Error: Fail to convert {filename}, it does not have the columns {', '.join(TABLE_COLUMNS)}", flush=True)
+        return
+    store = SequenceStore(seq_store) if seq_store is not None else None
+    try:
+        with reader:
+            for df in reader:
+                if store is not None:
+                    seqs = store.get_genes(df['kegg_gene_id'])
+                    for i, column in enumerate(['aaseq', 'ntseq']):
+                        df[column] = [seq if seq else seqs[kegg_gene_id][i] if kegg_gene_id in seqs else ''
+                                      for kegg_gene_id, seq in zip(df['kegg_gene_id'], df[column])]
+                # header will be the concatenated (with deliminter "|") kegg gene id, description, and koid
+                headers = '>' + df['kegg_gene_id'] + '|' + df['desc'] + '|' + df['koid'] + '\n'
+                has_ko = df['koid'] != ''
+                yield [_fasta_records(headers, df['aaseq'], has_ko), _fasta_records(headers, df['aaseq'], ~has_ko),
+                       _fasta_records(headers, df['ntseq'], has_ko), _fasta_records(headers, df['ntseq'], ~has_ko)]
+    finally:
+        if store is not None:
+            store.close()
+
+
+def convert_file(filename, chunksize=100000, seq_store=None):
+    """
+    Convert one KEGG gene table into FASTA records held in memory; the converters below stream iter_fasta_chunks instead
+    :return: a list of four strings with the records for aa KO, aa No KO, nt KO and nt No KO (the order of OUT_NAMES)
+    """
+    out = [[], [], [], []]
+    for records in iter_fasta_chunks(filename, chunksize=chunksize, seq_store=seq_store):
+        for x, text in zip(out, records):
+            x.append(text)
+    return [''.join(x) for x in out]
+
+
+def file_digest(path, block_size=2 ** 20):
+    """
+    :param path: a file
+    :return: the sha1 hex digest of its content
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fid:
+        for block in iter(lambda: fid.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _parsed_chunks(chunks):
+    # time the conversion of every chunk apart from the writing of its records
+    chunks = iter(chunks)
+    while True:
+        with METRICS.stage('parse'):
+            records = next(chunks, None)
+        if records is None:
+            return
+        yield records
+
+
+def _write_chunks(chunks, out_handles, index_writers=None):
+    """
+    Append the records of a table to the open output files as its chunks are converted
+    :param chunks: lists of four strings, see iter_fasta_chunks
+    :return: the (offset, length) of the table's records in every output, the size of every block written to every
+             output and the number of records
+    """
+    starts = [x.tell() for x in out_handles]
+    blocks = [[] for _ in out_handles]
+    n_records = 0
+    for records in chunks:
+        with METRICS.stage('write'):
+            for i, (out_handle, text) in enumerate(zip(out_handles, records)):
+                if not text:
+                    continue
+                data = text.encode()
+                if index_writers is not None:
+                    index_writers[i].add(data, out_handle.tell())
+                out_handle.write(data)
+                blocks[i].append(len(data))
+        n_records += sum(x.count('\n>') + x.startswith('>') for x in records)
+    ranges = [[start, out_handle.tell() - start] for start, out_handle in zip(starts, out_handles)]
+    return ranges, blocks, n_records
+
+
+def _convert_to_spool(filename, spool_dir, chunksize=100000, seq_store=None):
+    # a worker writes the records of its table to spool files, which the parent appends to the outputs in order;
+    # the digest is taken in the worker, so that hashing the tables runs in parallel as well
+    spool_files = []
+    for name in OUT_NAMES:
+        fd, spool_file = tempfile.mkstemp(prefix=name + '.', dir=spool_dir)
+        os.close(fd)
+        spool_files.append(spool_file)
+    out_handles = [open(x, 'wb') for x in spool_files]
+    try:
+        _, blocks, n_records = _write_chunks(iter_fasta_chunks(filename, chunksize=chunksize, seq_store=seq_store), out_handles)
+    finally:
+        for out_handle in out_handles:
+            out_handle.close()
+    return file_digest(filename), spool_files, blocks, n_records
+
+
+def _append_spool(spool_files, blocks, out_handles, index_writers):
+    # the blocks of the spool files hold whole records, so each one is indexed as it is copied
+    def chunks():
+        spool_handles = [open(x, 'rb') for x in spool_files]
+        try:
+            for i, spool_handle in enumerate(spool_handles):
+                for size in blocks[i]:
+                    records = ['', '', '', '']
+                    records[i] = spool_handle.read(size).decode()
+                    yield records
+        finally:
+            for spool_handle in spool_handles:
+                spool_handle.close()
+            for spool_file in spool_files:
+                os.remove(spool_file)
+    ranges, _, _ = _write_chunks(chunks(), out_handles, index_writers)
+    return ranges
+
+
+def _append_tables(file_names, out_handles, index_writers, processes=1, chunksize=100000, seq_store=None):
+    """
+    Convert tables and append their records to the open output files, one chunk of rows at a time
+    :return: a manifest entry per table: its path, size, mtime, digest and the (offset, length) of its records in every output
+    """
+    entries = []
+    if not file_names:
+        return entries
+    progress = Progress(len(file_names), 'gene tables')
+    if processes > 1 and len(file_names) > 1:
+        spool_dir = tempfile.mkdtemp(prefix='.convert_', dir=os.path.dirname(os.path.abspath(out_handles[0].name)))
+        pool = Pool(min(processes, len(file_names)))
+        results = pool.imap(partial(_convert_to_spool, spool_dir=spool_dir, chunksize=chunksize, seq_store=seq_store), file_names)
+    else:
+        spool_dir = None
+        pool = None
+    try:
+        for filename in file_names:
+            # taken before the table is read, so that a table written during the conversion is converted again next time
+            stat = os.stat(filename)
+            if pool is not None:
+                # the time spent waiting for the next converted table
+                with METRICS.stage('parse'):
+                    digest, spool_files, blocks, n_records = next(results)
+                ranges = _append_spool(spool_files, blocks, out_handles, index_writers)
+            else:
+                digest = file_digest(filename)
+                chunks = _parsed_chunks(iter_fasta_chunks(filename, chunksize=chunksize, seq_store=seq_store))
+                ranges, _, n_records = _write_chunks(chunks, out_handles, index_writers)
+            entries.append({'path': filename, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': digest, 'ranges': ranges})
+            METRICS.inc('records_total', n_records, stage='write')
+            progress.update()
+    finally:
+        if pool is not None:
+            # every table is converted by now, unless the conversion is given up
+            pool.terminate()
+            pool.join()
+        if spool_dir is not None:
+            shutil.rmtree(spool_dir)
+    progress.close()
+    return entries
+
+
+def _report(text, logger=None):
+    if logger is not None:
+        logger.info(text)
+    else:
+        print(text, flush=True)
+
+
+def _write_manifest(path, out_files, entries, seq_store, index):
+    manifest = {'version': MANIFEST_VERSION, 'seq_store': seq_store, 'index': index,
+                'outputs': {x: os.path.getsize(x) for x in out_files}, 'tables': entries}
+    with open(path + '.tmp', 'w') as out_handle:
+        json.dump(manifest, out_handle)
+    os.replace(path + '.tmp', path)
+
+
+def _read_manifest(path, out_files, seq_store, index):
+    """
+    :return: the manifest of the last conversion, or None when it does not describe the current output files
+    """
+    try:
+        with open(path) as fid:
+            manifest = json.load(fid)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('seq_store') != seq_store or manifest.get('index') != index:
+        return None
+    for out_file in out_files:
+        if not os.path.exists(out_file) or os.path.getsize(out_file) != manifest['outputs'].get(out_file):
+            return None
+        if index and not os.path.exists(index_path(out_file)):
+            return None
+    return manifest
+
+
+def compact_file(path, ranges, block_size=64 * 2 ** 20):
+    """
+    Cut byte ranges out of a file in place, moving the bytes after them down
+    :param path: the file
+    :param ranges: a sorted list of non-overlapping (offset, length)
+    :return: the new size of the file
+    """
+    ranges = [x for x in ranges if x[1] > 0]
+    with open(path, 'r+b') as fid:
+        size = fid.seek(0, os.SEEK_END)
+        if not ranges:
+            return size
+        write_pos = ranges[0][0]
+        for (start, length), next_start in zip(ranges, [x[0] for x in ranges[1:]] + [size]):
+            read_pos = start + length
+            while read_pos < next_start:
+                fid.seek(read_pos)
+                data = fid.read(min(block_size, next_start - read_pos))
+                fid.seek(write_pos)
+                fid.write(data)
+                read_pos += len(data)
+                write_pos += len(data)
+        fid.truncate(write_pos)
+    return write_pos
+
+
+def convert_table_to_FASTA(file_names, aa_KO_out_file, aa_NoKO_out_file, nt_KO_out_file, nt_NoKO_out_file, processes=1, chunksize=100000, seq_store=None, index=True, manifest=None):
     """
     Convert the tables of genes into FASTA sequences
     :param file_names: a list of all the KEGG gene tables to convert
@@ -14,42 +278,121 @@ def convert_table_to_FASTA(file_names, aa_KO_out_file, aa_NoKO_out_file, nt_KO_o
     :param aa_NoKO_out_file: FASTA amino acid sequences that do NOY have associated KO IDs
     :param nt_KO_out_file: FASTA nucleotide sequences that have associated KO IDs
     :param nt_NoKO_out_file: FASTA nucleotide sequences that do NOY have associated KO IDs
+    :param processes: the number of worker processes; the outputs are written in the order of file_names
+    :param chunksize: the number of rows of a table read at a time
+    :param seq_store: the folder of a seq_store.SequenceStore to read the sequences from
+    :param index: also write the sidecar index of every output file (see fasta_index.py)
+    :param manifest: also write the manifest that update_table_to_FASTA needs to this file
     :return: None
     """
-    with open(aa_KO_out_file, 'w') as aa_KO_fid:
-        with open(aa_NoKO_out_file, 'w') as aa_NoKO_fid:
-            with open(nt_KO_out_file, 'w') as nt_KO_fid:
-                with open(nt_NoKO_out_file, 'w') as nt_NoKO_fid:
-                    for filename in file_names:
-                        print(f"converting file: {filename}")
-                        # read in one of the gene tables
-                        df = pd.read_csv(filename, sep='\t', lineterminator='\n', header=0, keep_default_na=False)
-                        df = df.reset_index()
-                        for _, row in df.iterrows():
-                            index, kegg_gene_id, desc, koid, aaseq, ntseq = row
-                            # header will be the concatenated (with deliminter "|") kegg gene id, description, and koid
-                            header = "|".join([kegg_gene_id, desc, koid])
-                            if koid:
-                                if aaseq:
-                                    aa_KO_fid.write(f">{header}\n{aaseq}\n")
-                                if ntseq:
-                                    nt_KO_fid.write(f">{header}\n{ntseq}\n")
-                            else:
-                                if aaseq:
-                                    aa_NoKO_fid.write(f">{header}\n{aaseq}\n")
-                                if ntseq:
-                                    nt_NoKO_fid.write(f">{header}\n{aaseq}\n")
+    out_files = [aa_KO_out_file, aa_NoKO_out_file, nt_KO_out_file, nt_NoKO_out_file]
+    if manifest is not None and os.path.exists(manifest):
+        # the outputs are about to change, so the old manifest no longer describes them
+        os.remove(manifest)
+    out_handles = [open(x, 'wb') for x in out_files]
+    index_writers = [FastaIndexWriter() for _ in out_files] if index else None
+    try:
+        entries = _append_tables(file_names, out_handles, index_writers, processes=processes, chunksize=chunksize, seq_store=seq_store)
+    finally:
+        for out_handle in out_handles:
+            out_handle.close()
+    if index_writers is not None:
+        with METRICS.stage('write'):
+            for out_file, index_writer in zip(out_files, index_writers):
+                index_writer.write(index_path(out_file))
+    if manifest is not None:
+        _write_manifest(manifest, out_files, entries, seq_store, index)
     return
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+def update_table_to_FASTA(file_names, aa_KO_out_file, aa_NoKO_out_file, nt_KO_out_file, nt_NoKO_out_file, manifest, processes=1, chunksize=100000, seq_store=None, index=True, logger=None):
+    """
+    Bring the FASTA files of an earlier convert_table_to_FASTA run up to date, converting only the new and changed tables.
+
+    The records of removed and changed tables are cut out of the outputs, and those of new and changed tables are
+    appended, so after an update the records are no longer in the order of file_names. A table counts as changed when
+    its size, or its mtime and its checksum, differ from the manifest. Without a manifest that matches the outputs,
+    all tables are converted again. The other parameters are those of convert_table_to_FASTA.
+    :param file_names: a list of all the KEGG gene tables
+    :param manifest: the manifest file, e.g. <out_dir>/convert_manifest.json
+    :param logger: logger (the progress is printed without one)
+    :return: the number of tables converted and the number of tables removed
+    """
+    out_files = [aa_KO_out_file, aa_NoKO_out_file, nt_KO_out_file, nt_NoKO_out_file]
+    old = _read_manifest(manifest, out_files, seq_store, index)
+    if old is None:
+        _report("No manifest of the current FASTA files, convert all tables", logger)
+        convert_table_to_FASTA(file_names, *out_files, processes=processes, chunksize=chunksize, seq_store=seq_store, index=index, manifest=manifest)
+        return len(file_names), 0
+
+    current = set(file_names)
+    kept, dropped = [], []
+    for entry in old['tables']:
+        if entry['path'] not in current:
+            dropped.append(entry)
+            continue
+        stat = os.stat(entry['path'])
+        if stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime_ns']:
+            kept.append(entry)
+        elif stat.st_size == entry['size'] and file_digest(entry['path']) == entry['sha1']:
+            # touched, but not changed
+            kept.append(dict(entry, mtime_ns=stat.st_mtime_ns))
+        else:
+            dropped.append(entry)
+    kept_paths = {x['path'] for x in kept}
+    todo = [x for x in file_names if x not in kept_paths]
+    n_removed = sum(1 for x in old['tables'] if x['path'] not in current)
+    _report(f"{len(kept)} tables are unchanged, {len(todo)} are new or changed and {n_removed} were removed", logger)
+    if not kept and (dropped or todo):
+        convert_table_to_FASTA(file_names, *out_files, processes=processes, chunksize=chunksize, seq_store=seq_store, index=index, manifest=manifest)
+        return len(todo), n_removed
+
+    # the outputs are about to change, so the old manifest no longer describes them
+    os.remove(manifest)
+    index_writers = [FastaIndexWriter.load(index_path(x)) for x in out_files] if index and (dropped or todo) else None
+    for i, out_file in enumerate(out_files):
+        ranges = sorted(tuple(x['ranges'][i]) for x in dropped if x['ranges'][i][1] > 0)
+        if not ranges:
+            continue
+        with METRICS.stage('write'):
+            compact_file(out_file, ranges)
+        starts = [x[0] for x in ranges]
+        removed = list(itertools.accumulate(x[1] for x in ranges))
+        for entry in kept:
+            offset, length = entry['ranges'][i]
+            position = bisect_right(starts, offset)
+            entry['ranges'][i] = [offset - (removed[position - 1] if position else 0), length]
+        if index_writers is not None:
+            index_writers[i].remove_ranges(ranges)
+
+    # the outputs are opened for appending, so tell() starts at their end
+    out_handles = [open(x, 'ab') for x in out_files]
+    try:
+        entries = _append_tables(todo, out_handles, index_writers, processes=processes, chunksize=chunksize, seq_store=seq_store)
+    finally:
+        for out_handle in out_handles:
+            out_handle.close()
+    if index_writers is not None:
+        with METRICS.stage('write'):
+            for out_file, index_writer in zip(out_files, index_writers):
+                index_writer.write(index_path(out_file))
+    _write_manifest(manifest, out_files, kept + entries, seq_store, index)
+    return len(todo), n_removed
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog)
     parser.add_argument("--gene_dir", type=str,
                         help="The full path of the directory that contains all of the .txt gene tables (and nothing else)",
                         default="/data/shared_data/KEGG_data/organisms/kegg_gene_info")
     parser.add_argument("--out_dir", type=str, help="The full path to the directory that the files will be written",
                         default="/data/shared_data/KEGG_data/")
-    args = parser.parse_args()
+    parser.add_argument("--processes", type=int, help="The number of tables converted in parallel", default=cpu_count())
+    parser.add_argument("--seq_store", type=str, help="The sequence store the extractors wrote the sequences to (see seq_store.py)", default=None)
+    parser.add_argument("--full", action='store_true', help="Convert all tables, instead of only the tables that are new or changed since the last run")
+    add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+
     # parse the args
     KEGG_prot_directory = args.gene_dir
     if not os.path.exists(KEGG_prot_directory):
@@ -58,13 +401,24 @@ if __name__ == "__main__":
     if not os.path.exists(out_dir):
         print(f"Output folder {out_dir} does not exist, making one now.")
         os.makedirs(out_dir)
-    # get the file names to convert
-    file_names = [os.path.join(KEGG_prot_directory, f) for f in listdir(KEGG_prot_directory) if
-                  isfile(join(KEGG_prot_directory, f))]
+    metrics_from_args(args, os.path.join(out_dir, 'profile'))
+    # get the file names to convert; sorted so that the record order does not depend on the file system
+    file_names = sorted([os.path.join(KEGG_prot_directory, f) for f in listdir(KEGG_prot_directory) if
+                         isfile(join(KEGG_prot_directory, f))])
     # name the output files
     aa_KO_out_file = os.path.join(out_dir, "kegg_genes_KO.faa")
     aa_NoKO_out_file = os.path.join(out_dir, "kegg_genes_No_KO.faa")
     nt_KO_out_file = os.path.join(out_dir, "kegg_genes_KO.fna")
     nt_NoKO_out_file = os.path.join(out_dir, "kegg_genes_No_KO.fna")
+    # the checksums of the converted tables and the byte ranges of their records in the output files
+    manifest = os.path.join(out_dir, "convert_manifest.json")
     # then do the conversion
-    convert_table_to_FASTA(file_names, aa_KO_out_file, aa_NoKO_out_file, nt_KO_out_file, nt_NoKO_out_file)
\ No newline at end of file
+    if args.full:
+        convert_table_to_FASTA(file_names, aa_KO_out_file, aa_NoKO_out_file, nt_KO_out_file, nt_NoKO_out_file, processes=args.processes, seq_store=args.seq_store, manifest=manifest)
+    else:
+        update_table_to_FASTA(file_names, aa_KO_out_file, aa_NoKO_out_file, nt_KO_out_file, nt_NoKO_out_file, manifest,
+                              processes=args.processes, seq_store=args.seq_store)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,70 +1,292 @@
 import os
 import sys
-from multiprocessing import Pool, cpu_count
-import pandas as pd
-from collections import Counter
-from tqdm import tqdm, trange
-import pickle
 import argparse
-import logging
-from Bio import Entrez
-Entrez.email = "test@example.com"
+import time
+import itertools
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import requests
+if __package__:
+    from .kegg_client import EUTILS_link
+    from .http_cache import add_cache_arguments, cache_from_args
+    from .rate_limit import RetryPolicy, limiter_for, configure_limiter
+    from .table_store import read_entry_table
+    from .metrics import METRICS, Progress, endpoint_of, add_metrics_arguments, metrics_from_args
+    from .kegg_cli import get_logger
+else:
+    from kegg_client import EUTILS_link
+    from http_cache import add_cache_arguments, cache_from_args
+    from rate_limit import RetryPolicy, limiter_for, configure_limiter
+    from table_store import read_entry_table
+    from metrics import METRICS, Progress, endpoint_of, add_metrics_arguments, metrics_from_args
+    from kegg_cli import get_logger
+EFETCH_LINK = f"{EUTILS_link}/efetch.fcgi"
+# the parameters sent with every efetch request, so that NCBI can tell this tool's requests apart; main adds the email and
+# api_key
+EFETCH_PARAMS = {'tool': 'kegg_extract'}
+# the pieces an efetch response is streamed to disk in
+CHUNK_BYTES = 1 << 20
+# larger efetch responses (e.g. batches of whole genomes) are not kept in the response cache
+CACHE_MAX_BYTES = 16 << 20
 
-def get_logger():
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s  [%(levelname)s]  %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
-    ch = logging.StreamHandler(sys.stdout)
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
-    return logger
+def _write_fasta_chunks(chunks, out_handle):
+    """
+    Write the FASTA text of an efetch response as it arrives, without the empty lines between its records
+    :param chunks: the response body in pieces (bytes)
+    :param out_handle: a file opened in binary mode
+    :return: the number of bytes received
+    """
+    size = 0
+    last = b''
+    for chunk in chunks:
+        size += len(chunk)
+        if last == b'\n' and chunk.startswith(b'\n'):
+            chunk = chunk[1:]
+        chunk = chunk.replace(b'\n\n', b'\n')
+        if chunk:
+            out_handle.write(chunk)
+            last = chunk[-1:]
+    return size
 
-def download_seq(seq_id):
+def download_seq(seq_ids, spool_file, cache=None, retry=None):
+    """
+    Download the FASTA records of a batch of accessions with one efetch request, streamed to a spool file so that a
+    batch of whole genomes is never held in memory
+    :param seq_ids: a list of NCBI nucleotide accessions
+    :param spool_file: the file the FASTA records are written to
+    :param cache: an optional http_cache.ResponseCache; only responses up to CACHE_MAX_BYTES are stored in it
+    :param retry: the rate_limit.RetryPolicy for throttling and server errors (default: RetryPolicy())
+    :return: True when the records are written, False when the request fails
+    """
+    retry = retry if retry is not None else RetryPolicy()
+    seq_id = ','.join(seq_ids)
+    endpoint = endpoint_of(EFETCH_LINK)
+    # the cache key is the GET form of the efetch request, as Entrez used to build it, so existing caches stay valid
+    link = f"{EFETCH_LINK}?db=nucleotide&id={seq_id}&rettype=fasta&retmode=text"
+    if cache is not None:
+        cached = cache.get(link)
+        if cached is not None:
+            METRICS.inc('http_cache_hits_total', endpoint=endpoint)
+            with open(spool_file, 'w') as out_handle:
+                out_handle.write(cached.text)
+            return True
+        if cache.offline:
+            print(f"Error: {seq_id} is not in the offline cache", flush=True)
+            return False
 
     # Downloading...
-    try:
-        handle = Entrez.efetch(db="nucleotide", id=seq_id, rettype="fasta", retmode="text")
-    except:
-        print(f"Error: Fail to donwload nucleotide sequence for {seq_id}", flush=True)
-        return None
-    seq = handle.read().replace('\n\n','\n')
-    handle.close()
-    return seq
+    limiter = limiter_for(link)
+    for attempt in range(retry.max_retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        start = time.monotonic()
+        size = 0
+        try:
+            # POST, so that the URL length does not grow with the batch size
+            with requests.post(EFETCH_LINK, data={'db': 'nucleotide', 'id': seq_id, 'rettype': 'fasta', 'retmode': 'text', **EFETCH_PARAMS}, timeout=300, stream=True) as res:
+                status_code = res.status_code
+                if status_code == 200:
+                    with open(spool_file, 'wb') as out_handle:
+                        size = _write_fasta_chunks(res.iter_content(chunk_size=CHUNK_BYTES), out_handle)
+        except requests.RequestException:
+            # a connection lost in the middle of the body is retried as a whole
+            status_code = None
+        METRICS.record_request(EFETCH_LINK, status_code, time.monotonic() - start, size)
+        if limiter is not None:
+            limiter.update(status_code)
+        if status_code == 200:
+            break
+        if attempt == retry.max_retries or not retry.should_retry(status_code):
+            print(f"Error: Fail to donwload nucleotide sequence for {seq_id}", flush=True)
+            return False
+        METRICS.inc('http_retries_total', endpoint=endpoint)
+        time.sleep(retry.delay(attempt))
+    if cache is not None and size <= CACHE_MAX_BYTES:
+        with open(spool_file) as fid:
+            cache.put(link, 200, fid.read())
+    return True
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--table", type=str, help="The full path of virus/organism table")
-    parser.add_argument("--organisms", type=str, nargs='*', help="Multiple options from Fungi, Archaea, Bacteria", default=None)
-    parser.add_argument("--col", type=str, help="Download seqs based on the ids from specific column", default='rs_ncbi_seq_ids')
-    parser.add_argument("--outfile", type=str, help="The full path of output file")
-    args = parser.parse_args()
+def _accessions(headers):
+    # an accession matches with and without its version
+    headers = set(headers)
+    return headers | {x.split('.')[0] for x in headers}
 
-    logger = get_logger()
+def _is_done(seq_id, done):
+    return seq_id in done or seq_id.split('.')[0] in done
+
+def _append_spool(spool_file, out_handle):
+    """
+    Append the records of a spool file to the output
+    :return: the accessions in the headers of the records
+    """
+    headers = []
+    with open(spool_file, 'rb') as spool_handle:
+        for line in spool_handle:
+            if line.startswith(b'>'):
+                headers.append(line[1:].split(None, 1)[0].decode())
+            out_handle.write(line)
+    out_handle.flush()
+    return headers
+
+def read_checkpoint(outfile):
+    """
+    Restore the progress of an interrupted download
+    :param outfile: the output FASTA file
+    :return: the set of accessions in the output, with and without their version; the FASTA file is truncated after the
+             last complete batch
+    """
+    checkpoint_file = f"{outfile}.checkpoint"
+    done = set()
+    if not os.path.exists(outfile):
+        # the checkpoint of an output that is gone describes nothing
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+        return done
+    if not os.path.exists(checkpoint_file):
+        # an output from an older run without checkpoint: take the accessions from the FASTA headers
+        with open(outfile) as fid:
+            done = _accessions(line[1:].split(None, 1)[0] for line in fid if line.startswith('>'))
+        return done
+    end_offset = 0
+    with open(checkpoint_file) as fid:
+        for line in fid:
+            if not line.endswith('\n'):
+                # the last line was cut off in the middle of writing
+                break
+            offset, seq_ids = line.rstrip('\n').split('\t')
+            end_offset = int(offset)
+            done.update(_accessions(seq_ids.split(',')))
+    with open(outfile, 'r+') as out_handle:
+        out_handle.truncate(end_offset)
+    return done
 
-    if args.organisms is not None:
-        args.organisms = [x.lower() for x in args.organisms]
+def download_seqs(seq_id_list, outfile, cache=None, threads=3, batch_size=200, logger=None):
+    """
+    Download accessions in batches on a pool of threads and append each batch to the output as soon as it arrives;
+    the responses are streamed through spool files on disk, so memory does not grow with the batch size
+    :param seq_id_list: the NCBI nucleotide accessions
+    :param outfile: the output FASTA file; accessions recorded in its checkpoint are skipped
+    :param cache: an optional http_cache.ResponseCache
+    :param threads: the number of efetch requests in flight (the shared NCBI rate limit still applies)
+    :param batch_size: the number of accessions per efetch request
+    :param logger: logger
+    :return: the list of accessions whose batch failed
+    """
+    done = read_checkpoint(outfile)
+    todo = [x for x in dict.fromkeys(seq_id_list) if not _is_done(x, done)]
+    if logger is not None and done:
+        logger.info(f"Resume the download: {len(done)} accessions are already done, {len(todo)} are left")
+    batches = [todo[i:i+batch_size] for i in range(0, len(todo), batch_size)]
+    failed = []
+    # each batch is streamed to its own spool file next to the output and appended to the output once complete
+    for spool_file in glob(f"{outfile}.batch*.tmp"):
+        os.remove(spool_file)
+    spool_ids = itertools.count()
+    with open(outfile, 'ab') as out_handle, open(f"{outfile}.checkpoint", 'a') as checkpoint_handle, ThreadPoolExecutor(max_workers=threads) as executor:
+        in_flight = dict()
+        batches = iter(batches)
+        progress = Progress(len(todo), 'accessions', logger)
+        while True:
+            # keep a bounded number of batches in flight so that the spooled responses do not grow with the number of accessions
+            for seq_ids in batches:
+                spool_file = f"{outfile}.batch{next(spool_ids)}.tmp"
+                in_flight[executor.submit(download_seq, seq_ids, spool_file, cache)] = (seq_ids, spool_file)
+                if len(in_flight) >= threads * 2:
+                    break
+            if not in_flight:
+                break
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                seq_ids, spool_file = in_flight.pop(future)
+                downloaded = future.result()
+                progress.update(len(seq_ids))
+                if not downloaded:
+                    if os.path.exists(spool_file):
+                        os.remove(spool_file)
+                    if len(seq_ids) > 1:
+                        # one bad accession can fail the whole batch, so retry its accessions one at a time
+                        batches = itertools.chain([[x] for x in seq_ids], batches)
+                        progress.update(-len(seq_ids))
+                    else:
+                        failed += seq_ids
+                    continue
+                with METRICS.stage('write'):
+                    written = _append_spool(spool_file, out_handle)
+                    # only the accessions whose records are in the output are checkpointed; efetch can leave some out
+                    if written:
+                        checkpoint_handle.write(f"{out_handle.tell()}\t{','.join(written)}\n")
+                        checkpoint_handle.flush()
+                    os.remove(spool_file)
+                METRICS.inc('records_total', len(written), stage='write')
+                written = _accessions(written)
+                missing = [x for x in seq_ids if not _is_done(x, written)]
+                if missing:
+                    if len(seq_ids) > 1:
+                        batches = itertools.chain([[x] for x in missing], batches)
+                        progress.update(-len(missing))
+                    else:
+                        print(f"Error: {seq_ids[0]} is not in the efetch response", flush=True)
+                        failed += missing
+        progress.close()
+    return failed
 
-    ## read virus/organism table
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument("--table", type=str, help="The full path of virus/organism table (.txt or .parquet)")
+    parser.add_argument("--organisms", type=str, nargs='*', help="Only the organisms of an organism table from these lineages, as in extract_kegg_organism_data.py (e.g. Archaea Bacteria Fungi)", default=None)
+    parser.add_argument("--exclude", type=str, nargs='*', help="Leave out the organisms of these lineages (e.g. Bacilli)", default=None)
+    parser.add_argument("--taxdump", type=str, help="The folder of the extracted NCBI taxdump, for selections by taxid subtree or NCBI rank", default=None)
+    parser.add_argument("--col", type=str, nargs='+', help="Download seqs based on the ids from specific columns, e.g. rs_ncbi_seq_ids gb_ncbi_seq_id; the table is read once for all of them", default=['rs_ncbi_seq_ids'])
+    parser.add_argument("--outfile", type=str, nargs='+', help="The full path of output file, one per --col", required=True)
+    parser.add_argument("--batch_size", type=int, help="The number of accessions per efetch request", default=200)
+    parser.add_argument("--threads", type=int, help="The number of efetch requests in flight", default=None)
+    parser.add_argument("--api_key", type=str, help="NCBI API key, which raises the request limit from 3 to 10 per second", default=os.environ.get('NCBI_API_KEY'))
+    parser.add_argument("--email", type=str, help="The contact address sent to NCBI with every request, as the E-utilities usage policy asks", default=os.environ.get('NCBI_EMAIL'))
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+    if len(args.col) != len(args.outfile):
+        parser.error("--outfile needs one file per --col")
+
+    logger = get_logger()
+    metrics_from_args(args, os.path.join(os.path.dirname(os.path.abspath(args.outfile[0])), 'profile'), logger)
+    cache = cache_from_args(args, os.path.join(os.path.dirname(os.path.abspath(args.outfile[0])), 'http_cache.sqlite'))
+    if args.email:
+        EFETCH_PARAMS['email'] = args.email
+    else:
+        logger.warning("No --email (or NCBI_EMAIL) is given; NCBI asks for a contact address with E-utilities requests")
+    if args.api_key:
+        EFETCH_PARAMS['api_key'] = args.api_key
+        configure_limiter('eutils.ncbi.nlm.nih.gov', 10)
+    if args.threads is None:
+        args.threads = 10 if args.api_key else 3
+
+    ## read virus/organism table, only the sequence id columns and (with --organisms/--exclude) the rows of the selected organisms
     logger.info("Read virus/organism table")
-    table = pd.read_csv(args.table, sep='\t', header=0)
-    table.loc[table['rs_ncbi_seq_ids'].isnull(),'rs_ncbi_seq_ids'] = 'None'
-    table['rs_ncbi_seq_ids'] = table['rs_ncbi_seq_ids'].apply(lambda row: eval(row) if type(row) is str else row)
-    table.loc[table['gb_ncbi_seq_id'].isnull(),'gb_ncbi_seq_id'] = 'None'
-    table['gb_ncbi_seq_id'] = table['gb_ncbi_seq_id'].apply(lambda row: eval(row) if type(row) is str else row)
-    table['taxaid'] = table['taxaid'].astype(int)
+    table = read_entry_table(args.table, columns=args.col, organisms=args.organisms, exclude=args.exclude, taxdump=args.taxdump, logger=logger)
 
-    if args.organisms is not None:
-        table = table.loc[table.apply(lambda row: len(set(args.organisms).intersection(set(row[3].lower().split(';')))) > 0, axis=1),:].reset_index(drop=True)
+    ## start to download sequences; batches are appended to the output as they complete
+    n_failed = 0
+    for col, outfile in zip(args.col, args.outfile):
+        logger.info(f"Start to download sequences of {col}")
+        seq_id_list = [y for x in table[col] if x is not None for y in x ]
+        failed = download_seqs(seq_id_list, outfile, cache=cache, threads=args.threads, batch_size=args.batch_size, logger=logger)
+        if failed:
+            logger.error(f"Fail to download {len(failed)} sequences, their ids are written to {outfile}.failed")
+            with open(f"{outfile}.failed", 'w') as out_handle:
+                out_handle.write('\n'.join(failed) + '\n')
+        elif os.path.exists(f"{outfile}.failed"):
+            os.remove(f"{outfile}.failed")
+        n_failed += len(failed)
 
-    ## start to download sequences
-    logger.info("Start to download sequences")
-    seq_id_list = [y for x in table[args.col] if x is not None for y in x ]
-    seqs = list(map(download_seq, tqdm(seq_id_list)))
+    if cache is not None:
+        logger.info(cache.summary())
 
-    ## save sequences
-    with open(args.outfile,'w') as out_handle:
-        for seq in seqs:
-            if seq is not None:
-                out_handle.write(seq)
+    if n_failed:
+        # the failed accessions are not in the checkpoint, so a rerun downloads them; a non-zero exit keeps the pipeline
+        # from recording the stage as done
+        sys.exit(1)
 
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+import os
+import sys
+import argparse
+import json
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from glob import glob
+if __package__:
+    from .mock_services import MockServices, render_fixtures, load_recorded, SERVICES
+else:
+    from mock_services import MockServices, render_fixtures, load_recorded, SERVICES
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_FILE = os.path.join(SCRIPT_DIR, '..', 'benchmarks', 'e2e_results.jsonl')
+# the metrics compared with the stored runs (higher is worse) and the change below which they count as noise
+REGRESSION_METRICS = {'wall_time': 0.5, 'peak_rss_mb': 5}
+
+
+def _count_rows(files):
+    n_rows = 0
+    for name in files:
+        with open(name) as fid:
+            n_rows += max(sum(1 for _ in fid) - 1, 0)
+    return n_rows
+
+
+def _count_records(files):
+    n_records = 0
+    for name in files:
+        with open(name) as fid:
+            n_records += sum(1 for line in fid if line.startswith('>'))
+    return n_records
+
+
+def pipeline_stages(out_dir, client_rate):
+    """
+    The scripts of main.sh (and the KO hierarchy), in order, as run by the benchmark
+    :param out_dir: the output folder of the run
+    :param client_rate: the KEGG requests/sec the extractors are limited to (--rate and --max_rate)
+    :return: a list of (stage name, command, function that counts the records the stage wrote)
+    """
+    organisms = os.path.join(out_dir, 'kegg_organisms')
+    viruses = os.path.join(out_dir, 'kegg_viruses')
+    rate = ['--rate', str(client_rate), '--max_rate', str(client_rate)]
+    return [
+        ('extract_kegg_organism_data', ['extract_kegg_organism_data.py', '--organisms', 'Bacteria', '--outdir', organisms, '--no_cache'] + rate,
+         lambda: _count_rows(glob(os.path.join(organisms, 'kegg_gene_info', '*.txt')))),
+        ('extract_kegg_virus_data', ['extract_kegg_virus_data.py', '--outdir', viruses, '--no_cache'] + rate,
+         lambda: _count_rows([os.path.join(viruses, 'kegg_gene_info', 'gene_table.txt')])),
+        ('download_seq_fasta', ['download_seq_fasta.py', '--table', os.path.join(organisms, 'organism_table.txt'), '--col', 'rs_ncbi_seq_ids',
+                                '--organisms', 'Bacteria', '--outfile', os.path.join(organisms, 'rs_ncbi_organism.fasta'), '--no_cache'],
+         lambda: _count_records([os.path.join(organisms, 'rs_ncbi_organism.fasta')])),
+        ('convert_table_to_fasta', ['convert_table_to_fasta.py', '--gene_dir', os.path.join(organisms, 'kegg_gene_info'), '--out_dir', os.path.join(out_dir, 'fasta'), '--full'],
+         lambda: _count_records(glob(os.path.join(out_dir, 'fasta', '*.fa[an]')))),
+        ('get_ko_hierarchy', ['get_ko_hierarchy.py', '--brite', 'ko00001', '--outdir', out_dir, '--no_cache'],
+         lambda: _count_rows([os.path.join(out_dir, 'kegg_ko_edge_df_br:ko00001.txt')])),
+    ]
+
+
+def run_stage(command, env, log_file):
+    """
+    Run one script to completion
+    :param command: the script and its arguments
+    :param env: the environment, pointing the script at the stand-in services
+    :param log_file: the file stdout and stderr are written to
+    :return: (exit code, wall time in seconds, peak RSS in MB)
+    """
+    with open(log_file, 'w') as log_handle:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, os.path.join(SCRIPT_DIR, command[0])] + command[1:], env=env, cwd=SCRIPT_DIR,
+                                   stdout=log_handle, stderr=subprocess.STDOUT)
+        # wait4 gives the resource usage of this child only
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    return process.returncode, elapsed, usage.ru_maxrss / 1024
+
+
+def run_suite(out_dir, services, client_rate=200):
+    """
+    Run the pipeline end to end against the stand-in services
+    :param out_dir: the output folder; the log of every stage is written to <stage>.log in it
+    :param services: a started mock_services.MockServices
+    :param client_rate: the KEGG requests/sec the extractors are limited to
+    :return: a dict of stage -> metrics
+    """
+    env = {**os.environ, **services.environment()}
+    results = dict()
+    for name, command, count in pipeline_stages(out_dir, client_rate):
+        before = services.snapshot()
+        exit_code, elapsed, peak_rss = run_stage(command, env, os.path.join(out_dir, f"{name}.log"))
+        after = services.snapshot()
+        n_requests = sum(after[x]['requests'] - before[x]['requests'] for x in SERVICES)
+        try:
+            n_records = count()
+        except OSError:
+            n_records = 0
+        results[name] = {'exit_code': exit_code, 'wall_time': elapsed, 'peak_rss_mb': peak_rss,
+                         'requests': n_requests, 'requests_per_sec': n_requests / elapsed,
+                         'records': n_records, 'records_per_sec': n_records / elapsed,
+                         'errors': sum(after[x]['errors'] - before[x]['errors'] for x in SERVICES),
+                         'throttled': sum(after[x]['throttled'] - before[x]['throttled'] for x in SERVICES)}
+    return results
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_results(results_file):
+    if not os.path.exists(results_file):
+        return []
+    with open(results_file) as fid:
+        return [json.loads(line) for line in fid if line.strip()]
+
+
+def find_regressions(run, history, tolerance=0.2):
+    """
+    Compare a run with the stored runs of the same parameters on the same machine. Wall time and peak RSS are compared
+    with their median over the stored runs in which the stage succeeded, so a slow run does not become the baseline of
+    the next one and a gradual drift is still caught; the record counts with the latest of these runs.
+    :param run: the run, as stored in the results file
+    :param history: the stored runs
+    :param tolerance: the relative increase of a metric that counts as a regression
+    :return: (the stored runs compared with, a list of messages)
+    """
+    previous = [x for x in history if x['params'] == run['params'] and x['machine'] == run['machine']]
+    messages = [f"{stage} failed with exit code {metrics['exit_code']}" for stage, metrics in run['stages'].items() if metrics['exit_code'] != 0]
+    if not previous:
+        return [], messages
+    for stage, metrics in run['stages'].items():
+        baseline = [x['stages'][stage] for x in previous if stage in x['stages'] and x['stages'][stage]['exit_code'] == 0]
+        if not baseline:
+            continue
+        for metric, noise in REGRESSION_METRICS.items():
+            old, new = statistics.median(x[metric] for x in baseline), metrics[metric]
+            if new > old * (1 + tolerance) and new - old > noise:
+                messages.append(f"{stage}: {metric} {old:.2f} -> {new:.2f} (+{(new / old - 1) * 100:.0f}%)")
+        if metrics['records'] != baseline[-1]['records']:
+            messages.append(f"{stage}: {baseline[-1]['records']} records before, {metrics['records']} now")
+    return previous, messages
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--organisms", type=int, help="The number of organisms the stand-in KEGG serves (copies of the fixture organism)", default=5)
+    parser.add_argument("--viruses", type=int, help="The number of viruses the stand-in KEGG serves", default=10)
+    parser.add_argument("--latency", type=float, help="The delay of every stand-in response in seconds", default=0.02)
+    parser.add_argument("--error_rate", type=float, help="The fraction of requests the stand-ins answer with 503", default=0.0)
+    parser.add_argument("--server_rate", type=float, help="The requests/sec per service beyond which the stand-ins throttle", default=None)
+    parser.add_argument("--client_rate", type=float, help="The KEGG requests/sec the extractors are limited to", default=200)
+    parser.add_argument("--replay", type=str, nargs='*', help="http_cache.sqlite files of real runs whose responses are replayed", default=[])
+    parser.add_argument("--results", type=str, help="The JSON lines file the results are appended to and compared with", default=RESULTS_FILE)
+    parser.add_argument("--tolerance", type=float, help="The relative increase of wall time or peak RSS reported as a regression", default=0.2)
+    parser.add_argument("--outdir", type=str, help="Keep the outputs and logs of the run in this folder (default: a temporary one)", default=None)
+    args = parser.parse_args()
+
+    fixtures = render_fixtures(n_organisms=args.organisms, n_viruses=args.viruses)
+    for cache_file in args.replay:
+        load_recorded(fixtures, cache_file)
+    services = MockServices(fixtures, latency=args.latency, error_rate=args.error_rate, rate=args.server_rate).start()
+    out_dir = args.outdir if args.outdir is not None else tempfile.mkdtemp()
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    try:
+        stages = run_suite(out_dir, services, args.client_rate)
+    finally:
+        services.shutdown()
+        if args.outdir is None:
+            shutil.rmtree(out_dir)
+
+    params = {x: getattr(args, x) for x in ['organisms', 'viruses', 'latency', 'error_rate', 'server_rate', 'client_rate', 'replay']}
+    run = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': _commit(), 'machine': f"{platform.node()} ({os.cpu_count()} CPUs)",
+           'params': params, 'stages': stages}
+    print(f"{'stage':<28}{'wall s':>9}{'peak MB':>9}{'req/s':>9}{'records/s':>11}")
+    for stage, metrics in stages.items():
+        print(f"{stage:<28}{metrics['wall_time']:>9.2f}{metrics['peak_rss_mb']:>9.1f}{metrics['requests_per_sec']:>9.1f}{metrics['records_per_sec']:>11.1f}")
+    baseline, regressions = find_regressions(run, read_results(args.results), args.tolerance)
+    if not os.path.exists(os.path.dirname(os.path.abspath(args.results))):
+        os.makedirs(os.path.dirname(os.path.abspath(args.results)))
+    with open(args.results, 'a') as out_handle:
+        out_handle.write(json.dumps(run) + '\n')
+    if baseline:
+        print(f"Compared with the median of {len(baseline)} stored runs since {baseline[0]['time']} (last commit {baseline[-1]['commit']})")
+    for message in regressions:
+        print(f"Error: {message}", flush=True)
+    sys.exit(1 if regressions else 0)
@@ -2,192 +2,558 @@
 import os
 import sys
 import argparse
-import logging
-from tqdm import tqdm, trange
-import pickle
-from itertools import chain
-import pandas as pd
-import pytaxonkit
-import requests
-from bs4 import BeautifulSoup
-from multiprocessing import Pool, cpu_count
-import time
 import re
+import html
+import socket
+import multiprocessing
+from collections import Counter
 from glob import glob
+if __package__:
+    from .kegg_client import AsyncFetcher, KEGG_api_link, GENOME_link, http_get, pack_queries, PackingStats, prefetch
+    from .http_cache import add_cache_arguments, cache_from_args, RefreshingCache
+    from .rate_limit import add_rate_limit_arguments, limiter_from_args
+    from .kegg_flatfile import parse_get_response, parse_link_response, iter_fasta
+    from .table_store import SEQ_ID_COLUMNS, parse_id_list, add_store_arguments, write_entry_table, read_entry_table, entry_table_exists, select_organisms, pack_gene_tables
+    from .seq_store import SequenceStore, add_seq_store_arguments
+    from .kegg_sync import parse_list_response, diff_listing, SyncManifest
+    from .metrics import METRICS, progress, add_metrics_arguments, metrics_from_args, configure_metrics
+    from .work_queue import WorkQueue, DONE
+    from .kegg_cli import get_logger, lazy_import
+else:
+    from kegg_client import AsyncFetcher, KEGG_api_link, GENOME_link, http_get, pack_queries, PackingStats, prefetch
+    from http_cache import add_cache_arguments, cache_from_args, RefreshingCache
+    from rate_limit import add_rate_limit_arguments, limiter_from_args
+    from kegg_flatfile import parse_get_response, parse_link_response, iter_fasta
+    from table_store import SEQ_ID_COLUMNS, parse_id_list, add_store_arguments, write_entry_table, read_entry_table, entry_table_exists, select_organisms, pack_gene_tables
+    from seq_store import SequenceStore, add_seq_store_arguments
+    from kegg_sync import parse_list_response, diff_listing, SyncManifest
+    from metrics import METRICS, progress, add_metrics_arguments, metrics_from_args, configure_metrics
+    from work_queue import WorkQueue, DONE
+    from kegg_cli import get_logger, lazy_import
+pd = lazy_import('pandas')
 
-def get_logger():
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s  [%(levelname)s]  %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
-    ch = logging.StreamHandler(sys.stdout)
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
-    return logger
-
-def extract_taxid(org_code):
-    link = f"https://www.genome.jp/kegg-bin/show_organism?org={org_code}"
-    r = requests.get(link)
-    if r.status_code == 200:
-        soup = BeautifulSoup(r.text, 'html.parser')
-        try:
-            return soup.find_all('a',{'href': re.compile('Taxonomy')})[0].text
-        except:
-            print(f"Error: Fail to get the taxa id for {org_code}",flush=True)
-            return None
+ANCHOR_RE = re.compile(r'<a\s[^>]*?href\s*=\s*["\']?([^"\'\s>]*)[^>]*>(.*?)</a>', re.IGNORECASE | re.DOTALL)
+TAG_RE = re.compile(r'<[^>]+>')
+
+def extract_organism_info(page):
+    """
+    Pull the NCBI taxonomy id, GenBank ids and RefSeq ids out of a genome.jp show_organism page in one pass
+    :param page: the html text of the page
+    :return: (taxid, gb_ncbi_seq_id, rs_ncbi_seq_ids)
+    """
+    taxid = None
+    gb_ncbi_seq_id = []
+    rs_ncbi_seq_ids = []
+    for href, text in ANCHOR_RE.findall(page):
+        text = html.unescape(TAG_RE.sub('', text)).strip()
+        if taxid is None and 'Taxonomy' in href:
+            taxid = text
+        elif 'www.ncbi.nlm.nih.gov/nuccore' in href:
+            gb_ncbi_seq_id.append(text)
+        elif 'www.genome.jp/dbget-bin/www_bget?refseq' in href:
+            rs_ncbi_seq_ids.append(text)
+    return taxid, gb_ncbi_seq_id, rs_ncbi_seq_ids
+
+def process_organism_page(result):
+    if result.status == 200:
+        taxid, gb_ncbi_seq_id, rs_ncbi_seq_ids = extract_organism_info(result.text)
+        if taxid is None:
+            print(f"Error: Fail to get the taxa id for {result.key}", flush=True)
+        return result.key, taxid, gb_ncbi_seq_id, rs_ncbi_seq_ids
     else:
-        print(f"Error: Fail to get the taxa id for {org_code}",flush=True)
+        print(f"Error: Fail to get the organism information for {result.key}", flush=True)
         return None
 
-def extract_ref_seq_id(params):
-    org_code, seq_db = params
-    link = f"https://www.genome.jp/kegg-bin/show_organism?org={org_code}"
-    r = requests.get(link)
-    if r.status_code == 200:
-        soup = BeautifulSoup(r.text, 'html.parser')
-        if seq_db == 'gb':
-            try:
-                return [x.text for x in soup.find_all('a',{'href': re.compile('www.ncbi.nlm.nih.gov\/nuccore')})]
-            except:
-                print(f"Error: Fail to get the ref seq id for {org_code}",flush=True)
-                return None
-        elif seq_db == 'rs':
-            try:
-                return [x.text for x in soup.find_all('a',{'href': re.compile('www.genome.jp/dbget-bin/www_bget\?refseq')})]
-            except:
-                print(f"Error: Fail to get the ref seq id for {org_code}",flush=True)
-                return None
+def fetch_organism_info(org_code_list, partial_file, fetcher, logger):
+    """
+    Fetch the show_organism page of each organism and append its taxid, GenBank and RefSeq ids to a partial table
+    :param org_code_list: the KEGG organism codes
+    :param partial_file: the partial table; organisms already in it are not fetched again
+    :param fetcher: kegg_client.AsyncFetcher
+    :param logger: logger
+    :return: a DataFrame of org_code, taxaid, gb_ncbi_seq_id, rs_ncbi_seq_ids of the organisms whose page was fetched,
+             and the list of the organisms whose page still fails
+    """
+    if os.path.exists(partial_file):
+        done = set(pd.read_csv(partial_file, sep='\t', header=0, dtype=str)['org_code'])
     else:
-        print(f"Error: Fail to get the ref seq id for {org_code}",flush=True)
-        return None
+        done = set()
+        with open(partial_file, 'w') as out_handle:
+            out_handle.write('org_code\ttaxaid\tgb_ncbi_seq_id\trs_ncbi_seq_ids\n')
+    requested = set(org_code_list)
+    org_code_list = [x for x in org_code_list if x not in done]
+    with open(partial_file, 'a') as out_handle:
+        for result in progress(fetcher.fetch_all((org_code, f"{GENOME_link}/kegg-bin/show_organism?org={org_code}") for org_code in org_code_list), len(org_code_list), 'organism pages', logger):
+            with METRICS.stage('parse'):
+                row = process_organism_page(result)
+            if row is not None:
+                org_code, taxid, gb_ncbi_seq_id, rs_ncbi_seq_ids = row
+                out_handle.write(f"{org_code}\t{taxid if taxid is not None else ''}\t{gb_ncbi_seq_id}\t{rs_ncbi_seq_ids}\n")
+                out_handle.flush()
+    failed = [x[0] for x in fetcher.failed]
+    if failed:
+        logger.error(f"Fail to get the organism information for {len(failed)} organisms: {' '.join(failed)}")
+    organism_info = pd.read_csv(partial_file, sep='\t', header=0, dtype=str)
+    # the partial file can hold rows of an earlier attempt for organisms that are in the organism table by now
+    organism_info = organism_info.loc[organism_info['org_code'].isin(requested),:].drop_duplicates('org_code', keep='last').reset_index(drop=True)
+    for column in SEQ_ID_COLUMNS:
+        organism_info[column] = organism_info[column].apply(parse_id_list)
+    return organism_info, failed
+
+def _replace_table(table, path):
+    # written next to the target and renamed, so that a crashed or concurrent worker never leaves a partial table
+    tmp_file = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    table.to_csv(tmp_file, sep='\t', index=None)
+    os.replace(tmp_file, path)
 
 def download_kegg_gene(params):
-    org_code, out_loc = params
+    org_code, out_loc, cache = params
+    # an existing table holds the (possibly annotated) genes from an earlier run
+    if os.path.exists(os.path.join(out_loc,f"{org_code}_kegg_genes.txt")):
+        return 1
     link1 = f"{KEGG_api_link}/list/{org_code}"
-    r = requests.get(link1)
+    r = http_get(link1, cache=cache)
     if r.status_code == 200:
-        print(f"Successuflly download gene/protein information from {link1}")
         table1 = pd.DataFrame([x.split('\t') for x in r.text.split('\n') if x.split('\t')[0]])
         table1.columns = ['kegg_gene_id','desc']
     else:
         print(f"Error: Fail to download gene/protein information from {link1}")
         return 0
 
-    table1.to_csv(os.path.join(out_loc,f"{org_code}_kegg_genes.txt"), sep='\t', index=None)
+    _replace_table(table1, os.path.join(out_loc,f"{org_code}_kegg_genes.txt"))
     return 1
 
 
-def extract_taxaid_seq(inlist):
-    temp = '|'.join(inlist)
-    if 'ORTHOLOGY' in temp:
-        koid = 'ko:'+[re.sub('\s.*','',re.sub('ORTHOLOGY\s*','',line)) for line in inlist if 'ORTHOLOGY' in line][0]
+def process_query(result):
+    if result.status == 200:
+        return [(kegg_gene_id, record.koid, record.aaseq, record.ntseq) for kegg_gene_id, record in parse_get_response(result.key, result.text)]
     else:
-        koid = None
-    if 'AASEQ' in temp:
-        aaseq = re.sub('\d*','','|'.join(inlist).split('AASEQ       ')[1].split('|COMMENT     ')[0].split('|NTSEQ     ')[0]).replace('|            ','').replace('|','')
-    else:
-        aaseq = None
-    if 'NTSEQ' in temp:
-        ntseq = re.sub('\d*','','|'.join(inlist).split('NTSEQ       ')[1].split('|COMMENT     ')[0]).replace('|            ','').replace('|','')
+        print(f"Error: Fail to extract info from {result.url}", flush=True)
+        return []
+
+def process_aaseq_query(result):
+    if result.status == 200:
+        return [(kegg_gene_id, None, aaseq, None) for kegg_gene_id, aaseq in iter_fasta(result.text)]
     else:
-        ntseq = None
-    return koid, aaseq, ntseq
+        print(f"Error: Fail to extract info from {result.url}", flush=True)
+        return []
 
-def process_query(instr):
-    link = KEGG_api_link + f"/get/{instr}"
-    res = requests.get(link)
+def get_ko_links(org_code, cache=None):
+    link = f"{KEGG_api_link}/link/ko/{org_code}"
+    res = http_get(link, cache=cache)
     if res.status_code == 200:
-        print(f"Successuflly extract info from {link}")
-        res = [tuple([a])+b for a, b in zip(instr.split('+'),list(map(extract_taxaid_seq,[x.split('\n') for x in res.text.split('///')])))]
-        return res
+        return parse_link_response(res.text)
+    elif res.status_code == 404:
+        # KEGG answers 404 when none of the organism's genes has a KO
+        return dict()
     else:
-        print(f"Error: Fail to extract info from {link}")
-        return []
+        print(f"Error: Fail to download KO links from {link}", flush=True)
+        return None
 
+def write_gene_table(gene_table_file, infile, rows, ko_links=None, seq_store=None, columns=('koid','aaseq','ntseq')):
+    with METRICS.stage('write'):
+        _write_gene_table(gene_table_file, infile, rows, ko_links, seq_store, columns)
+    METRICS.inc('records_total', len(rows), stage='write')
+
+def _write_gene_table(gene_table_file, infile, rows, ko_links=None, seq_store=None, columns=('koid','aaseq','ntseq')):
+    if ko_links is not None:
+        rows = [(kegg_gene_id, ko_links.get(kegg_gene_id), aaseq, ntseq) for kegg_gene_id, _, aaseq, ntseq in rows]
+    if seq_store is not None:
+        # the sequences go to the store once per distinct sequence, the table keeps empty sequence columns
+        seq_store.add_genes((kegg_gene_id, aaseq, ntseq) for kegg_gene_id, _, aaseq, ntseq in rows)
+        rows = [(kegg_gene_id, koid, None, None) for kegg_gene_id, koid, _, _ in rows]
+    final_res = pd.DataFrame(rows, columns=['kegg_gene_id','koid','aaseq','ntseq'])
+    if 'koid' in infile.columns:
+        # a synced table keeps the records of unchanged genes and takes the fetched columns of the fetched genes, also
+        # where they are now empty (e.g. a KO link that the new release removed)
+        outfile = infile.set_index('kegg_gene_id')
+        fetched = final_res.drop_duplicates('kegg_gene_id', keep='last').set_index('kegg_gene_id')
+        fetched = fetched.loc[fetched.index.isin(outfile.index), list(columns)]
+        outfile[list(columns)] = outfile[list(columns)].astype(object)
+        outfile.loc[fetched.index, list(columns)] = fetched.astype(object)
+        outfile = outfile.reset_index()
+    else:
+        outfile = infile.merge(final_res, on='kegg_gene_id', how='left').reset_index(drop=True)
+    _replace_table(outfile, gene_table_file)
+
+
+def annotate_gene_tables(gene_table_files, fetcher, cache=None, total=None, ko_only=False, aaseq_only=False, seq_store=None, gene_diffs=None, on_done=None, logger=None):
+    """
+    Fill the koid, aaseq and ntseq columns of the gene tables that do not have them yet
+    :param gene_table_files: the <org_code>_kegg_genes.txt tables; it is consumed lazily, so it can be a generator
+    :param fetcher: kegg_client.AsyncFetcher
+    :param cache: an optional http_cache.ResponseCache for the /link/ko requests of aaseq_only
+    :param total: the number of tables, for the progress reports
+    :param ko_only: only fill the koid column, from one /link/ko/<org> request per organism
+    :param aaseq_only: fill koid from /link/ko/<org> and aaseq from /get/<ids>/aaseq
+    :param seq_store: an optional seq_store.SequenceStore the sequences are written to
+    :param gene_diffs: org_code -> (genes to fetch with their desc, genes to drop) from a sync
+    :param on_done: called with the org_code of every table that is complete, including the ones that already were
+    :param logger: logger
+    :return: the org codes whose tables are left incomplete because some requests still fail
+    """
+    gene_diffs = gene_diffs if gene_diffs is not None else dict()
+    on_done = on_done if on_done is not None else (lambda org_code: None)
+    failed = []
+
+    def _iter_gene_tables():
+        for gene_table_file in progress(gene_table_files, total, 'gene tables', logger):
+            infile = pd.read_csv(gene_table_file, sep='\t', header=0)
+            if 'koid_x' in infile.columns:
+                infile = infile[['kegg_gene_id','desc','koid_x','aaseq_x','ntseq_x']]
+                infile.columns = ['kegg_gene_id','desc','koid','aaseq','ntseq']
+                infile.to_csv(gene_table_file, sep='\t', index=None)
+            org_code = os.path.basename(gene_table_file).replace('_kegg_genes.txt','')
+            to_fetch = None
+            if org_code in gene_diffs:
+                ## drop removed and changed genes and append the new and changed ones
+                to_fetch, to_drop = gene_diffs.pop(org_code)
+                infile = infile.loc[~infile['kegg_gene_id'].isin(to_drop),:]
+                infile = pd.concat([infile, pd.DataFrame({'kegg_gene_id': list(to_fetch), 'desc': list(to_fetch.values())})]).reset_index(drop=True)
+            if 'koid' in infile.columns:
+                # an annotated table only needs the genes that a sync added or changed
+                if to_fetch is None:
+                    on_done(org_code)
+                    continue
+                if not to_fetch:
+                    infile.to_csv(gene_table_file, sep='\t', index=None)
+                    on_done(org_code)
+                    continue
+                yield gene_table_file, infile, org_code, list(to_fetch)
+            elif len(infile) == 0:
+                write_gene_table(gene_table_file, infile, [])
+                on_done(org_code)
+            else:
+                yield gene_table_file, infile, org_code, list(infile['kegg_gene_id'])
+
+    if ko_only:
+        ## one /link/ko/<org> request per organism fills the koid column, sequences are left empty
+        gene_tables = dict()
+        def _iter_link_queries():
+            for gene_table_file, infile, org_code, _ in _iter_gene_tables():
+                gene_tables[org_code] = (gene_table_file, infile)
+                yield org_code, f"{KEGG_api_link}/link/ko/{org_code}"
+        for result in fetcher.fetch(_iter_link_queries()):
+            gene_table_file, infile = gene_tables.pop(result.key)
+            if result.status in (200, 404):
+                ko_links = parse_link_response(result.text) if result.status == 200 else dict()
+                write_gene_table(gene_table_file, infile, [(kegg_gene_id, None, None, None) for kegg_gene_id in infile['kegg_gene_id']], ko_links, columns=('koid',))
+                on_done(result.key)
+            else:
+                logger.error(f"Fail to download KO links from {result.url}, skip {gene_table_file} for now")
+                failed.append(result.key)
+    else:
+        # gene tables waiting for /get results, keyed by the organism prefix of their gene ids
+        pending = dict()
+        packing = PackingStats()
+        if aaseq_only:
+            query_suffix, parse_result = '/aaseq', process_aaseq_query
+        else:
+            query_suffix, parse_result = '', process_query
+
+        def _iter_gene_ids():
+            for gene_table_file, infile, org_code, kegg_gene_id_list in _iter_gene_tables():
+                pending[org_code] = {'file': gene_table_file, 'table': infile, 'remaining': len(kegg_gene_id_list), 'rows': []}
+                yield gene_table_file, kegg_gene_id_list
+
+        ## requests are packed with 10 gene ids across organisms and each result is routed back to the table of its organism
+        for result in progress(fetcher.fetch_all((instr, f"{KEGG_api_link}/get/{instr}{query_suffix}") for instr in pack_queries(_iter_gene_ids(), stats=packing)), None, 'requests', logger):
+            with METRICS.stage('parse'):
+                rows = parse_result(result)
+            METRICS.inc('records_total', len(rows), stage='parse')
+            for row in rows:
+                pending[row[0].split(':')[0]]['rows'].append(row)
+            for org_code, count in Counter(x.split(':')[0] for x in result.key.split('+')).items():
+                pending[org_code]['remaining'] -= count
+                if pending[org_code]['remaining'] == 0:
+                    item = pending.pop(org_code)
+                    ko_links = get_ko_links(org_code, cache) if aaseq_only else None
+                    if aaseq_only and ko_links is None:
+                        logger.error(f"Fail to download KO links for {org_code}, skip {item['file']} for now")
+                        failed.append(org_code)
+                        continue
+                    write_gene_table(item['file'], item['table'], item['rows'], ko_links, seq_store, ('koid','aaseq') if aaseq_only else ('koid','aaseq','ntseq'))
+                    on_done(org_code)
+        logger.info(packing.summary())
+        # tables with requests that still fail are left without a koid column so that the next run fetches them again
+        for org_code, item in pending.items():
+            logger.error(f"{item['remaining']} gene ids still fail for {item['file']}, skip it for now")
+            failed.append(org_code)
+    return failed
+
+
+def queue_file(args):
+    return args.queue if args.queue is not None else os.path.join(args.outdir, 'organism_queue.sqlite')
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--organisms", type=str, nargs='*', help="Multiple options from Fungi, Archaea, Bacteria", default=['Archaea','Bacteria', 'Fungi'])
-    parser.add_argument("--outdir", type=str, help="The output dir")
-    args = parser.parse_args()
 
-    KEGG_api_link = 'http://rest.kegg.jp'
+def run_worker(args, logger):
+    """
+    Work off the organism queue of --shard init: claim an organism, download its gene list and annotate its gene table.
+    The next organism is claimed and its gene list downloaded while the requests of the previous one are queued, so the
+    fetcher never drains.
+    :param args: the parsed command line arguments
+    :param logger: logger
+    :return: the org codes this worker completed
+    """
+    queue = WorkQueue(queue_file(args), lease=args.lease, max_attempts=args.max_attempts)
+    # WAL needs shared memory, so processes on different hosts do not share a response cache
+    cache = cache_from_args(args, os.path.join(args.outdir, f"http_cache_{socket.gethostname()}.sqlite"))
+    limiter_from_args(args)
+    gene_dir = os.path.join(args.outdir,'kegg_gene_info')
+    completed = []
+
+    def _claimed_tables():
+        while True:
+            org_codes = queue.claim()
+            if not org_codes:
+                return
+            for org_code in org_codes:
+                if download_kegg_gene((org_code, gene_dir, cache)):
+                    yield os.path.join(gene_dir, f"{org_code}_kegg_genes.txt")
+                else:
+                    queue.fail(org_code, 'the gene list could not be downloaded')
+
+    def _done(org_code):
+        if queue.complete(org_code):
+            completed.append(org_code)
+        else:
+            logger.warning(f"The lease of {org_code} expired before its table was written, it is left to the worker that claimed it again")
+
+    queue.start_heartbeat()
+    try:
+        fetcher = AsyncFetcher(concurrency=args.concurrency, logger=logger, cache=cache)
+        # claiming (which can wait on the queue's lock) and the gene list download run in their own thread, one organism
+        # ahead, so neither holds up reading the gene table of the previous organism and queueing its requests
+        for org_code in annotate_gene_tables(prefetch(_claimed_tables()), fetcher, cache, None, args.ko_only, args.aaseq_only, on_done=_done, logger=logger):
+            queue.fail(org_code, 'some requests still fail')
+    finally:
+        queue.close()
+    if cache is not None:
+        logger.info(cache.summary())
+    logger.info(f"Worker {queue.worker_id} completed {len(completed)} organisms")
+    return completed
+
+
+def _worker_process(args, index):
+    # the entry point of the extra worker processes of --workers; everything it needs comes from args, so it runs the same
+    # under the fork and the spawn start method. The workers report their metrics on their own
+    logger = get_logger()
+    configure_metrics(args, os.path.join(args.outdir, 'profile'), script=f"extract_kegg_organism_data_worker{index}")
+    run_worker(args, logger)
+    logger.info(METRICS.summary())
+    if args.metrics is not None:
+        stem, ext = os.path.splitext(args.metrics)
+        METRICS.write(f"{stem}_worker{index}{ext}")
+    METRICS.write_profiles()
+
+
+def merge_shards(args, logger):
+    """
+    Check that every organism of the queue has an annotated gene table; organisms whose table is missing are queued again
+    :param args: the parsed command line arguments
+    :param logger: logger
+    :return: True when all organisms are done
+    """
+    queue = WorkQueue(queue_file(args), lease=args.lease, max_attempts=args.max_attempts)
+    gene_dir = os.path.join(args.outdir,'kegg_gene_info')
+    missing = []
+    for org_code, _, _, _, _ in queue.jobs(DONE):
+        gene_table_file = os.path.join(gene_dir, f"{org_code}_kegg_genes.txt")
+        if not os.path.exists(gene_table_file):
+            missing.append(org_code)
+            continue
+        with open(gene_table_file) as fid:
+            if 'koid' not in fid.readline().rstrip('\n').split('\t'):
+                missing.append(org_code)
+    if missing:
+        logger.error(f"{len(missing)} organisms are done in the queue without an annotated gene table, they are queued again: {' '.join(missing)}")
+        queue.requeue(missing, 'the gene table is missing or not annotated')
+    logger.info(queue.summary())
+    unfinished = [x for x in queue.jobs() if x[1] != DONE]
+    for org_code, state, worker, attempts, error in unfinished:
+        logger.error(f"{org_code} is {state} after {attempts} attempts{f' by {worker}' if worker else ''}{f': {error}' if error else ''}")
+    queue.close()
+    return not unfinished
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument("--organisms", type=str, nargs='*', help="The organisms to extract: KEGG lineage names (e.g. Archaea Bacteria Fungi, Firmicutes), rank=name (e.g. kingdom=Bacteria) or, with --taxdump, NCBI taxids (their whole subtree) and NCBI names", default=['Archaea','Bacteria', 'Fungi'])
+    parser.add_argument("--exclude", type=str, nargs='*', help="The organisms to leave out, as in --organisms (e.g. --organisms Firmicutes --exclude Bacilli)", default=None)
+    parser.add_argument("--taxdump", type=str, help="The folder of the extracted NCBI taxdump (nodes.dmp, names.dmp), for selections by taxid subtree or NCBI rank", default=None)
+    parser.add_argument("--outdir", type=str, help="The output dir")
+    parser.add_argument("--concurrency", type=int, help="The number of concurrent HTTP requests", default=20)
+    add_cache_arguments(parser)
+    add_rate_limit_arguments(parser)
+    parser.add_argument("--ko_only", "--ko-only", action='store_true', help="Only fill the koid column, from one /link/ko/<org> request per organism")
+    parser.add_argument("--aaseq_only", "--aaseq-only", action='store_true', help="Fill the koid and aaseq columns from /link/ko/<org> and /get/<ids>/aaseq, without nucleotide sequences")
+    parser.add_argument("--sync", action='store_true', help="Update an existing output folder to the current KEGG release, fetching only added or changed organisms and genes")
+    add_store_arguments(parser)
+    add_seq_store_arguments(parser)
+    add_metrics_arguments(parser)
+    parser.add_argument("--shard", type=str, choices=['init', 'work', 'merge'], default=None,
+                        help="Split the gene extraction across processes and hosts: init builds the organism table and queues the selected organisms; work claims organisms from the queue and writes their gene tables (run any number of these, on hosts sharing the output folder); merge checks that every organism is done")
+    parser.add_argument("--queue", type=str, help="The SQLite queue of --shard (default: <outdir>/organism_queue.sqlite)", default=None)
+    parser.add_argument("--workers", type=int, help="The number of worker processes --shard work starts on this host", default=1)
+    parser.add_argument("--lease", type=float, help="The seconds a worker holds an organism without a heartbeat before another worker takes it over", default=600)
+    parser.add_argument("--max_attempts", type=int, help="The number of times an organism is tried before it is marked as failed", default=3)
+    args = parser.parse_args(argv)
+    if args.ko_only and args.aaseq_only:
+        parser.error("--ko_only and --aaseq_only are mutually exclusive")
+    if args.shard is not None and args.sync:
+        parser.error("--sync does not work with --shard")
+    if args.shard == 'work' and args.seq_store is not None:
+        parser.error("--seq_store is written from one process; import the gene tables after the merge with seq_store.py --import_tables")
 
     logger = get_logger()
     args.organisms = [x.lower() for x in args.organisms]
 
     if not os.path.exists(args.outdir):
         os.makedirs(args.outdir)
+    metrics_from_args(args, os.path.join(args.outdir, 'profile'), logger)
+
+    if args.shard in ['work', 'merge']:
+        if not os.path.exists(queue_file(args)):
+            logger.error(f"{queue_file(args)} does not exist, run with --shard init first")
+            sys.exit(1)
+        if args.shard == 'work':
+            ## this process is worker 0, the others are started next to it
+            os.makedirs(os.path.join(args.outdir,'kegg_gene_info'), exist_ok=True)
+            workers = [multiprocessing.Process(target=_worker_process, args=(args, i)) for i in range(1, args.workers)]
+            for worker in workers:
+                worker.start()
+            run_worker(args, logger)
+            for worker in workers:
+                worker.join()
+            sys.exit(0 if all(worker.exitcode == 0 for worker in workers) else 1)
+        if not merge_shards(args, logger):
+            sys.exit(1)
+        if args.store == 'parquet':
+            pack_gene_tables(os.path.join(args.outdir,'kegg_gene_info'), os.path.join(args.outdir,'kegg_gene_info.parquet'), logger)
+        sys.exit(0)
+
+    cache = cache_from_args(args, os.path.join(args.outdir, 'http_cache.sqlite'))
+    # a sync only downloads added or changed entries, whose cached responses would be those of the old release
+    fetch_cache = RefreshingCache(cache) if args.sync and cache is not None else cache
+    limiter_from_args(args)
+    seq_store = SequenceStore(args.seq_store) if args.seq_store is not None else None
+
+    organism_table_file = os.path.join(args.outdir,'organism_table.txt')
+    gene_dir = os.path.join(args.outdir,'kegg_gene_info')
+    manifest = SyncManifest() if args.sync else None
+    # the organisms left incomplete by requests that still fail; a rerun fetches them again
+    incomplete = []
 
-    ## download KEGG organism table
-    if not os.path.exists(os.path.join(args.outdir,'organism_table.txt')):
+    ## download KEGG organism table; the partial file of the organism pages is only left by a run in which some of them failed
+    partial_file = os.path.join(args.outdir,'organism_table.txt.partial')
+    resume = os.path.exists(partial_file)
+    if not entry_table_exists(organism_table_file) or args.sync or resume:
         link = KEGG_api_link + '/list/organism'
-        res = requests.get(link)
+        # a sync always compares against the current listing, not a cached one
+        res = http_get(link, cache=None if args.sync else cache)
         if res.status_code == 200:
             logger.info('Organism table is sucessfully downloaded!')
             organism_table = pd.DataFrame([x.split('\t') for x in res.text.split('\n') if x.split('\t')[0]])
             organism_table.columns = ['T_number','org_code','name','lineage']
+        else:
+            logger.error(f"Fail to download the organism table from {link}")
+            sys.exit(1)
 
-        ## extract taxa ids for each KEGG organism code
-        org_code_list = list(organism_table['org_code'])
-        org_code_taxaids = list(map(extract_taxid, org_code_list))
-        params = zip(org_code_list, ['gb']*len(org_code_list))
-        gb_ncbi_seq_ids = list(map(extract_ref_seq_id, params))
-        params = zip(org_code_list, ['rs']*len(org_code_list))
-        rs_ncbi_seq_ids = list(map(extract_ref_seq_id, params))
-        organism_table = pd.concat([organism_table,pd.DataFrame(org_code_taxaids),pd.Series(gb_ncbi_seq_ids),pd.Series(rs_ncbi_seq_ids)], axis=1)
-        organism_table.columns = ['T_number','org_code','name','lineage', 'taxaid','gb_ncbi_seq_id','rs_ncbi_seq_ids']
-        organism_table['org_code'] = organism_table['org_code'].astype(str)
-        organism_table['taxaid'] = organism_table['taxaid'].astype(int).astype(str)
-        organism_table.to_csv(os.path.join(args.outdir,'organism_table.txt'),sep='\t',index=None)
+        fetcher = AsyncFetcher(concurrency=args.concurrency, logger=logger, cache=fetch_cache)
+        if entry_table_exists(organism_table_file):
+            ## only organisms that are new, or whose genome (T number) was replaced, need their show_organism page
+            old_table = read_entry_table(organism_table_file)
+            added, removed, changed = diff_listing(dict(zip(old_table['org_code'], old_table['T_number'])), dict(zip(organism_table['org_code'], organism_table['T_number'])))
+            if manifest is not None:
+                manifest.add_entries('organisms', added, removed, changed)
+            for org_code in removed + changed:
+                if os.path.exists(os.path.join(gene_dir,f"{org_code}_kegg_genes.txt")):
+                    os.remove(os.path.join(gene_dir,f"{org_code}_kegg_genes.txt"))
+            # the organisms whose page failed in the run that left the partial file are in the table without a taxaid; a
+            # sync re-queues them too, e.g. for a table written before failed pages were kept for the next run
+            retry = set()
+            if resume or args.sync:
+                retry = set(old_table.loc[old_table['taxaid'].isna(),'org_code']) & set(organism_table['org_code'])
+            old_info = old_table.loc[~old_table['org_code'].isin(set(removed + changed) | retry),['org_code','taxaid','gb_ncbi_seq_id','rs_ncbi_seq_ids']]
+            org_code_list = added + changed + sorted(retry - set(added + changed))
+        else:
+            old_info = None
+            org_code_list = list(organism_table['org_code'])
+
+        ## extract taxa ids and NCBI sequence ids for each KEGG organism code; rows are appended as pages arrive so an interrupted run resumes
+        organism_info, failed_pages = fetch_organism_info(org_code_list, partial_file, fetcher, logger)
+        if old_info is not None:
+            organism_info = pd.concat([old_info, organism_info]).reset_index(drop=True)
+        organism_table = organism_table.merge(organism_info, on='org_code', how='left').reset_index(drop=True)
+        write_entry_table(organism_table, organism_table_file, args.store)
+        if failed_pages:
+            # the other organisms go ahead; the partial file is kept, so the next run only fetches the failed pages
+            incomplete += failed_pages
+        else:
+            os.remove(partial_file)
+        organism_table = organism_table.loc[~organism_table.taxaid.isna() & organism_table['org_code'].isin(select_organisms(organism_table_file, args.organisms, args.exclude, args.taxdump, logger)),:].reset_index(drop=True)
     else:
-        organism_table = pd.read_csv(os.path.join(args.outdir,'organism_table.txt'), sep='\t', header=0)
+        organism_table = read_entry_table(organism_table_file, organisms=args.organisms, exclude=args.exclude, taxdump=args.taxdump, logger=logger)
         organism_table = organism_table.loc[~organism_table.taxaid.isna(),:].reset_index(drop=True)
-        organism_table['org_code'] = organism_table['org_code'].astype(str)
-        organism_table['taxaid'] = organism_table['taxaid'].astype(int).astype(str)
+        organism_table['taxaid'] = organism_table['taxaid'].astype(float).astype(int).astype(str)
 
-    organism_table = organism_table.loc[organism_table.apply(lambda row: len(set(args.organisms).intersection(set(row[3].lower().split(';')))) > 0, axis=1),:].reset_index(drop=True)
+    if args.shard == 'init':
+        ## queue the selected organisms for the workers of --shard work
+        queue = WorkQueue(queue_file(args), lease=args.lease, max_attempts=args.max_attempts)
+        logger.info(f"{queue.add(organism_table['org_code'])} organisms are queued in {queue_file(args)} ({queue.summary()})")
+        queue.close()
+        sys.exit(1 if incomplete else 0)
 
     ## extract gene/protein information from KEGG
-    if not os.path.exists(os.path.join(args.outdir,'kegg_gene_info')):
-        os.makedirs(os.path.join(args.outdir,'kegg_gene_info'))
+    if not os.path.exists(gene_dir):
+        os.makedirs(gene_dir)
 
     org_code_list = list(organism_table['org_code'])
-    params = zip(org_code_list, [os.path.join(args.outdir,'kegg_gene_info')]*len(org_code_list))
-    res = list(map(download_kegg_gene, params))
+    # gene lists that changed since the stored tables were written: org_code -> (genes to fetch with their desc, genes to drop)
+    gene_diffs = dict()
+    if args.sync:
+        stored = [x for x in org_code_list if os.path.exists(os.path.join(gene_dir,f"{x}_kegg_genes.txt"))]
+        logger.info(f"Compare the gene lists of {len(stored)} organisms with the current KEGG release")
+        # listings are not cached, a sync always needs the current release
+        list_fetcher = AsyncFetcher(concurrency=args.concurrency, logger=logger)
+        for result in progress(list_fetcher.fetch_all((org_code, f"{KEGG_api_link}/list/{org_code}") for org_code in stored), len(stored), 'gene lists', logger):
+            new = parse_list_response(result.text)
+            old_table = pd.read_csv(os.path.join(gene_dir,f"{result.key}_kegg_genes.txt"), sep='\t', header=0, usecols=['kegg_gene_id','desc'], dtype=str, keep_default_na=False)
+            added, removed, changed = diff_listing(dict(zip(old_table['kegg_gene_id'], old_table['desc'])), new)
+            manifest.add_genes(result.key, added, removed, changed)
+            if added or removed or changed:
+                gene_diffs[result.key] = ({x: new[x] for x in added + changed}, set(removed + changed))
+        if list_fetcher.failed:
+            logger.error(f"Fail to list the genes of {len(list_fetcher.failed)} organisms, they are not synced: {' '.join(x[0] for x in list_fetcher.failed)}")
+            incomplete += [x[0] for x in list_fetcher.failed]
 
-    all_gene_table_list = glob(os.path.join(args.outdir,'kegg_gene_info','*'))
-    for index in trange(len(all_gene_table_list)):
-        infile = pd.read_csv(all_gene_table_list[index], sep='\t', header=0)
-        if 'koid' in infile.columns or 'koid_x' in infile.columns:
-            if 'koid_x' in infile.columns:
-                infile = infile[['kegg_gene_id','desc','koid_x','aaseq_x','ntseq_x']]
-                infile.columns = ['kegg_gene_id','desc','koid','aaseq','ntseq']
-                infile.to_csv(all_gene_table_list[index], sep='\t', index=None)
-            continue
+    params = zip(org_code_list, [gene_dir]*len(org_code_list), [fetch_cache]*len(org_code_list))
+    res = list(map(download_kegg_gene, progress(params, len(org_code_list), 'organism gene lists', logger)))
+    incomplete += [org_code for org_code, downloaded in zip(org_code_list, res) if not downloaded]
 
-        kegg_gene_id_list = list(infile['kegg_gene_id'])
-        batch =list(range(0,len(kegg_gene_id_list),10))
-        batch.append(len(kegg_gene_id_list))
-        kegg_gene_id_list = ['+'.join(kegg_gene_id_list[batch[i-1]:batch[i]]) for i in range(1, len(batch))]
-        batch =list(range(0,len(kegg_gene_id_list),20))
-        batch.append(len(kegg_gene_id_list))
-
-        final_res = []
-        get_data = True
-        for i in range(1, len(batch)):
-            start = batch[i-1]
-            end = batch[i]
-            while get_data:
-                try:
-                    with Pool(processes=20) as excutator:
-                        res = excutator.map(process_query, kegg_gene_id_list[start:end])
-                        get_data = False
-                except:
-                    time.sleep(300)
-            final_res += [y for x in res for y in x]
-            time.sleep(5)
-            get_data = True
-        final_res = pd.DataFrame(final_res)
-        final_res.columns = ['kegg_gene_id','koid','aaseq','ntseq']
-        outfile = infile.merge(final_res, on='kegg_gene_id', how='left').reset_index(drop=True)
-        outfile.to_csv(all_gene_table_list[index], sep='\t', index=None)
+    fetcher = AsyncFetcher(concurrency=args.concurrency, logger=logger, cache=fetch_cache)
+    all_gene_table_list = glob(os.path.join(gene_dir,'*_kegg_genes.txt'))
+    incomplete += annotate_gene_tables(all_gene_table_list, fetcher, fetch_cache, len(all_gene_table_list), args.ko_only, args.aaseq_only, seq_store, gene_diffs, logger=logger)
+
+    if args.store == 'parquet':
+        pack_gene_tables(gene_dir, gene_dir + '.parquet', logger)
+
+    if cache is not None:
+        logger.info(cache.summary())
+
+    if seq_store is not None:
+        logger.info(seq_store.summary())
+        seq_store.close()
+
+    if manifest is not None:
+        logger.info(manifest.summary())
+        logger.info(f"The change manifest is written to {manifest.write(args.outdir)}")
+
+    if incomplete:
+        # a non-zero exit keeps the pipeline from recording the stage as done
+        logger.error(f"{len(set(incomplete))} organisms are incomplete, run again to fetch them: {' '.join(sorted(set(incomplete)))}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
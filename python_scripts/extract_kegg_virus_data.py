@@ -2,74 +2,86 @@
 import os
 import sys
 import argparse
-import logging
-from tqdm import tqdm, trange
-import pickle
-from itertools import chain
-import pandas as pd
-import pytaxonkit
-import requests
-from bs4 import BeautifulSoup
-from multiprocessing import Pool, cpu_count
-import time
 import re
+if __package__:
+    from .kegg_client import AsyncFetcher, KEGG_api_link, http_get, pack_queries
+    from .http_cache import add_cache_arguments, cache_from_args, RefreshingCache
+    from .rate_limit import add_rate_limit_arguments, limiter_from_args
+    from .kegg_flatfile import parse_get_response, parse_link_response, iter_fasta
+    from .table_store import add_store_arguments, write_entry_table, read_entry_table, entry_table_exists, pack_gene_tables, GeneTableWriter
+    from .seq_store import SequenceStore, add_seq_store_arguments
+    from .kegg_sync import diff_listing, SyncManifest
+    from .metrics import METRICS, progress, add_metrics_arguments, metrics_from_args
+    from .kegg_cli import get_logger, lazy_import
+else:
+    from kegg_client import AsyncFetcher, KEGG_api_link, http_get, pack_queries
+    from http_cache import add_cache_arguments, cache_from_args, RefreshingCache
+    from rate_limit import add_rate_limit_arguments, limiter_from_args
+    from kegg_flatfile import parse_get_response, parse_link_response, iter_fasta
+    from table_store import add_store_arguments, write_entry_table, read_entry_table, entry_table_exists, pack_gene_tables, GeneTableWriter
+    from seq_store import SequenceStore, add_seq_store_arguments
+    from kegg_sync import diff_listing, SyncManifest
+    from metrics import METRICS, progress, add_metrics_arguments, metrics_from_args
+    from kegg_cli import get_logger, lazy_import
+pd = lazy_import('pandas')
 
-def get_logger():
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s  [%(levelname)s]  %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
-    ch = logging.StreamHandler(sys.stdout)
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
-    return logger
-
-def extract_taxaid_seq(inlist):
-    temp = '|'.join(inlist)
-    if 'TAXONOMY' in temp:
-        taxaid = [re.sub('\s.*','',re.sub('TAXONOMY\s*TAX:','',line)) for line in inlist if 'TAXONOMY' in line][0]
-    else:
-        taxaid = None
-    if 'ORTHOLOGY' in temp:
-        koid = 'ko:'+[re.sub('\s.*','',re.sub('ORTHOLOGY\s*','',line)) for line in inlist if 'ORTHOLOGY' in line][0]
-    else:
-        koid = None
-    if 'AASEQ' in temp:
-        aaseq = re.sub('\d*','','|'.join(inlist).split('AASEQ       ')[1].split('|COMMENT     ')[0].split('|NTSEQ     ')[0]).replace('|            ','').replace('|','')
-    else:
-        aaseq = None
-    if 'NTSEQ' in temp:
-        ntseq = re.sub('\d*','','|'.join(inlist).split('NTSEQ       ')[1].split('|COMMENT     ')[0]).replace('|            ','').replace('|','')
+# the columns of gene_table.txt
+GENE_TABLE_COLUMNS = ['kegg_gene_id','taxaid','koid','aaseq','ntseq','desc']
+
+def process_query(result):
+    if result.status == 200:
+        return [(kegg_gene_id, record.taxaid, record.koid, record.aaseq, record.ntseq) for kegg_gene_id, record in parse_get_response(result.key, result.text)]
     else:
-        ntseq = None
-    return taxaid, koid, aaseq, ntseq
-
-def process_query(instr):
-    link = KEGG_api_link + f"/get/{instr}"
-    res = requests.get(link)
-    if res.status_code == 200:
-        print(f"Successuflly extract info from {link}")
-        res = [tuple([a])+b for a, b in zip(instr.split('+'),list(map(extract_taxaid_seq,[x.split('\n') for x in res.text.split('///')])))]
-        return res
+        print(f"Error: Fail to extract info from {result.url}", flush=True)
+        return []
+
+def process_aaseq_query(result):
+    if result.status == 200:
+        return [(kegg_gene_id, None, None, aaseq, None) for kegg_gene_id, aaseq in iter_fasta(result.text)]
     else:
-        print(f"Error: Fail to extract info from {link}")
+        print(f"Error: Fail to extract info from {result.url}", flush=True)
         return []
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog)
     parser.add_argument("--outdir", type=str, help="The output dir")
-    args = parser.parse_args()
-
-    KEGG_api_link = 'http://rest.kegg.jp'
+    parser.add_argument("--concurrency", type=int, help="The number of concurrent HTTP requests", default=20)
+    add_cache_arguments(parser)
+    add_rate_limit_arguments(parser)
+    parser.add_argument("--ko_only", "--ko-only", action='store_true', help="Only fill the koid column, from the /link/ko/vg and /link/ko/vp requests")
+    parser.add_argument("--aaseq_only", "--aaseq-only", action='store_true', help="Fill the koid and aaseq columns from /link/ko and /get/<ids>/aaseq, without nucleotide sequences")
+    parser.add_argument("--sync", action='store_true', help="Update an existing output folder to the current KEGG release, fetching only added or changed genes")
+    add_store_arguments(parser)
+    add_seq_store_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.ko_only and args.aaseq_only:
+        parser.error("--ko_only and --aaseq_only are mutually exclusive")
 
     logger = get_logger()
 
     if not os.path.exists(args.outdir):
         os.makedirs(args.outdir)
+    metrics_from_args(args, os.path.join(args.outdir, 'profile'), logger)
+    cache = cache_from_args(args, os.path.join(args.outdir, 'http_cache.sqlite'))
+    limiter_from_args(args)
+
+    manifest = SyncManifest() if args.sync else None
+    # a sync always compares against the current listings, not cached ones, and only fetches added or changed genes,
+    # whose cached responses would be those of the old release
+    list_cache = None if args.sync else cache
+    fetch_cache = RefreshingCache(cache) if args.sync and cache is not None else cache
 
     ## download KEGG organism table
-    if not os.path.exists(os.path.join(args.outdir,'virus_table.txt')):
+    virus_table_file = os.path.join(args.outdir,'virus_table.txt')
+    if args.sync and entry_table_exists(virus_table_file):
+        old_table = read_entry_table(virus_table_file, columns=['taxaid','name'])
+        old_viruses = dict(zip(old_table['taxaid'], old_table['name']))
+    else:
+        old_viruses = None
+    if not entry_table_exists(virus_table_file) or args.sync:
         link = KEGG_api_link + '/get/br:br08620'
-        res = requests.get(link)
+        res = http_get(link, cache=list_cache)
         if res.status_code == 200:
             logger.info('Virus table is sucessfully downloaded!')
             temp_list = []
@@ -87,48 +99,128 @@ if __name__ == "__main__":
             virus_table['gb_ncbi_seq_id'] = virus_table['gb_ncbi_seq_id'].str.replace('GN:','').str.split(' ')
             virus_table['taxaid'] = virus_table.taxaid.str.replace('TAX:','')
             virus_table['taxaid'] = virus_table['taxaid'].astype(int)
-            virus_table.to_csv(os.path.join(args.outdir,'virus_table.txt'),sep='\t',index=None)
+            write_entry_table(virus_table, virus_table_file, args.store)
+            if old_viruses is not None:
+                manifest.add_entries('viruses', *diff_listing(old_viruses, dict(zip(virus_table['taxaid'].astype(str), virus_table['name']))))
     else:
-        virus_table = pd.read_csv(os.path.join(args.outdir,'virus_table.txt'), sep='\t', header=0)
-        virus_table.loc[virus_table['rs_ncbi_seq_ids'].isnull(),'rs_ncbi_seq_ids'] = 'None'
-        virus_table['rs_ncbi_seq_ids'] = virus_table['rs_ncbi_seq_ids'].apply(lambda row: eval(row) if type(row) is str else row)
-        virus_table.loc[virus_table['gb_ncbi_seq_id'].isnull(),'gb_ncbi_seq_id'] = 'None'
-        virus_table['gb_ncbi_seq_id'] = virus_table['gb_ncbi_seq_id'].apply(lambda row: eval(row) if type(row) is str else row)
+        virus_table = read_entry_table(virus_table_file)
         virus_table['taxaid'] = virus_table['taxaid'].astype(int)
     
     ## extract gene/protein information from KEGG
     if not os.path.exists(os.path.join(args.outdir,'kegg_gene_info')):
         os.makedirs(os.path.join(args.outdir,'kegg_gene_info'))
 
-    gene_table = pd.DataFrame(columns=['kegg_gene_id','desc'])
+    ## the kegg_gene_id -> desc listing of vg and vp, joined to the records as they are written
+    gene_desc = dict()
     for i in ['vg','vp']:
         link = KEGG_api_link + f'/list/{i}'
-        res = requests.get(link)
+        res = http_get(link, cache=list_cache)
         if res.status_code == 200:
-            res.text.split('\n')
-            temp = pd.DataFrame([line.split('\t') for line in res.text.split('\n') if line.split('\t')[0]])
-            temp.columns = ['kegg_gene_id','desc']
-            gene_table = pd.concat([gene_table,temp]).reset_index(drop=True)
+            for line in res.text.split('\n'):
+                fields = line.split('\t')
+                if fields[0]:
+                    gene_desc[fields[0]] = fields[1] if len(fields) > 1 else None
         else:
+            # without the full listing a whole gene set would be missing from the table (or, with --sync, look removed)
             logger.error(f"Fail to access data from {link}")
+            sys.exit(1)
+
+    gene_table_file = os.path.join(args.outdir,'kegg_gene_info','gene_table.txt')
+    # the parsed records are streamed to gene_table.txt.partial in chunks; an interrupted run resumes from its checkpoint
+    # a partial table written with other column options (e.g. --ko_only, whose rows have no sequences) is not resumed
+    run = {'ko_only': args.ko_only, 'aaseq_only': args.aaseq_only, 'seq_store': args.seq_store is not None}
+    writer = GeneTableWriter(gene_table_file, GENE_TABLE_COLUMNS, run=run)
+    if writer.discarded:
+        logger.info("The partial gene table was written with other options, start it over")
+    if writer.done:
+        logger.info(f"Resume the gene table: {len(writer.done)} genes are already written")
+    todo = [x for x in gene_desc if x not in writer.done]
+    if args.sync and os.path.exists(gene_table_file):
+        ## keep the records of unchanged genes and only fetch the new or changed ones
+        old_genes = pd.read_csv(gene_table_file, sep='\t', header=0, dtype=str, keep_default_na=False, usecols=['kegg_gene_id','desc'])
+        added, removed, changed = diff_listing(dict(zip(old_genes['kegg_gene_id'], old_genes['desc'])), gene_desc)
+        del old_genes
+        manifest.add_genes('vg+vp', added, removed, changed)
+        dropped = set(removed + changed)
+        for kept_genes in pd.read_csv(gene_table_file, sep='\t', header=0, dtype=str, keep_default_na=False, chunksize=writer.chunk_rows):
+            kept_genes = kept_genes.loc[~kept_genes['kegg_gene_id'].isin(dropped) & ~kept_genes['kegg_gene_id'].isin(writer.done),:]
+            writer.add(kept_genes[GENE_TABLE_COLUMNS].itertuples(index=False, name=None))
+        fetched = set(added + changed)
+        todo = [x for x in todo if x in fetched]
+
+    ko_links = None
+    if args.ko_only or args.aaseq_only:
+        ## the koid column comes from one /link/ko request per virus gene set
+        ko_links = dict()
+        for i in ['vg','vp']:
+            link = KEGG_api_link + f'/link/ko/{i}'
+            res = http_get(link, cache=fetch_cache)
+            if res.status_code == 200:
+                ko_links.update(parse_link_response(res.text))
+            else:
+                # without the links every gene would be written without a KO; the partial table is kept uncommitted
+                logger.error(f"Fail to access data from {link}")
+                writer.close()
+                sys.exit(1)
 
-    kegg_gene_id_list = list(gene_table['kegg_gene_id'])
-    batch =list(range(0,len(kegg_gene_id_list),10))
-    batch.append(len(kegg_gene_id_list))
-    kegg_gene_id_list = ['+'.join(kegg_gene_id_list[batch[i-1]:batch[i]]) for i in range(1, len(batch))]
-    batch =list(range(0,len(kegg_gene_id_list),20))
-    batch.append(len(kegg_gene_id_list))
-
-    final_res = []
-    for i in trange(1, len(batch)):
-        start = batch[i-1]
-        end = batch[i]
-        with Pool(processes=20) as excutator:
-            res = excutator.map(process_query, kegg_gene_id_list[start:end])
-        final_res += [y for x in res for y in x]
-        time.sleep(5)
-    final_res = pd.DataFrame(final_res)
-    final_res.columns = ['kegg_gene_id','taxaid','koid','aaseq','ntseq']
-
-    final_gene_table = final_res.merge(gene_table, on='kegg_gene_id').reset_index(drop=True)
-    final_gene_table.to_csv(os.path.join(args.outdir,'kegg_gene_info','gene_table.txt'), sep='\t', index=None)
+    seq_store = SequenceStore(args.seq_store) if args.seq_store is not None else None
+
+    def write_records(records):
+        # the desc join: records of genes that are not in the listing are dropped
+        rows = [(kegg_gene_id, taxaid, ko_links.get(kegg_gene_id) if ko_links is not None else koid, aaseq, ntseq, gene_desc[kegg_gene_id])
+                for kegg_gene_id, taxaid, koid, aaseq, ntseq in records if kegg_gene_id in gene_desc]
+        if seq_store is not None:
+            # the sequences go to the store once per distinct sequence, the table keeps empty sequence columns
+            seq_store.add_genes((kegg_gene_id, aaseq, ntseq) for kegg_gene_id, _, _, aaseq, ntseq, _ in rows)
+            rows = [(kegg_gene_id, taxaid, koid, None, None, desc) for kegg_gene_id, taxaid, koid, _, _, desc in rows]
+        with METRICS.stage('write'):
+            writer.add(rows)
+        METRICS.inc('records_total', len(rows), stage='write')
+
+    if args.ko_only:
+        write_records((kegg_gene_id, None, None, None, None) for kegg_gene_id in todo)
+    else:
+        if args.aaseq_only:
+            query_suffix, parse_result = '/aaseq', process_aaseq_query
+        else:
+            query_suffix, parse_result = '', process_query
+        kegg_gene_id_list = list(pack_queries([('virus', todo)]))
+        fetcher = AsyncFetcher(concurrency=args.concurrency, logger=logger, cache=fetch_cache)
+        for result in progress(fetcher.fetch_all((instr, f"{KEGG_api_link}/get/{instr}{query_suffix}") for instr in kegg_gene_id_list), len(kegg_gene_id_list), 'requests', logger):
+            with METRICS.stage('parse'):
+                records = parse_result(result)
+            METRICS.inc('records_total', len(records), stage='parse')
+            write_records(records)
+        failed_file = os.path.join(args.outdir,'kegg_gene_info','failed_gene_ids.txt')
+        if fetcher.failed:
+            logger.error(f"{len(fetcher.failed)} requests still fail, their gene ids are written to {failed_file}")
+            with open(failed_file, 'w') as out_handle:
+                for instr, _ in fetcher.failed:
+                    out_handle.write('\n'.join(instr.split('+')) + '\n')
+        elif os.path.exists(failed_file):
+            os.remove(failed_file)
+    with METRICS.stage('write'):
+        writer.commit()
+
+    if args.store == 'parquet':
+        pack_gene_tables(os.path.join(args.outdir,'kegg_gene_info'), os.path.join(args.outdir,'kegg_gene_info.parquet'), logger)
+
+    if cache is not None:
+        logger.info(cache.summary())
+
+    if seq_store is not None:
+        logger.info(seq_store.summary())
+        seq_store.close()
+
+    if manifest is not None:
+        logger.info(manifest.summary())
+        logger.info(f"The change manifest is written to {manifest.write(args.outdir)}")
+
+    if not args.ko_only and fetcher.failed:
+        # the failed genes are not in the checkpoint, so a rerun fetches them; a non-zero exit keeps the pipeline from
+        # recording the stage as done
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
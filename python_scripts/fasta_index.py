@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+import os
+import sys
+import argparse
+import mmap
+import numpy as np
+if __package__:
+    from .ko_index import write_arrays, read_arrays
+else:
+    from ko_index import write_arrays, read_arrays
+
+MAGIC = b'KGFAI001'
+# the size of the blocks read by build_fasta_index
+BLOCK_SIZE = 64 * 2 ** 20
+
+
+def index_path(fasta_file):
+    """
+    :param fasta_file: e.g. kegg_genes_KO.faa
+    :return: the path of its sidecar index, e.g. kegg_genes_KO.faa.idx
+    """
+    return fasta_file + '.idx'
+
+
+def normalize_ko(ko):
+    # both 'K02588' and 'ko:K02588' are accepted
+    return ko if ko.startswith('ko:') else 'ko:' + ko
+
+
+class FastaIndexWriter:
+    """
+    Collect the record positions of a FASTA file written by convert_table_to_fasta.py while it is written.
+
+    Every record is a '>kegg_gene_id|desc|koid' header line and one sequence line. The positions are kept as numpy
+    arrays per block of records, so the writer does not hold a Python object per gene.
+    """
+
+    def __init__(self):
+        self._gene_ids = []
+        self._kos = []
+        self._offsets = []
+        self._lengths = []
+        self.size = 0
+
+    def add(self, data, offset):
+        """
+        Index a block of records
+        :param data: the bytes of whole records
+        :param offset: the position of the block in the FASTA file
+        :return: None
+        """
+        if not data:
+            return
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        newlines = np.flatnonzero(buffer == ord('\n'))
+        if data[:1] != b'>' or len(newlines) % 2 or newlines[-1] != len(data) - 1:
+            raise Exception(f"The block at offset {offset} does not hold whole two-line FASTA records")
+        header_ends = newlines[0::2]
+        ends = newlines[1::2] + 1
+        starts = np.concatenate([[0], ends[:-1]])
+        pipes = np.flatnonzero(buffer == ord('|'))
+        # the gene id ends at the first '|' of a header and the koid starts after the last one
+        id_ends = pipes[np.searchsorted(pipes, starts)]
+        ko_starts = pipes[np.searchsorted(pipes, header_ends) - 1] + 1
+        self._gene_ids.append(np.array([data[x + 1:y] for x, y in zip(starts.tolist(), id_ends.tolist())], dtype='S'))
+        self._kos.append(np.array([data[x:y] for x, y in zip(ko_starts.tolist(), header_ends.tolist())], dtype='S'))
+        self._offsets.append(starts.astype(np.int64) + offset)
+        self._lengths.append((ends - starts).astype(np.int64))
+        self.size = max(self.size, offset + len(data))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Start from the records of an existing index, e.g. to index the records appended to its FASTA file
+        :param path: the index file, see index_path
+        :return: a FastaIndexWriter
+        """
+        with open(path, 'rb') as fid:
+            arrays = read_arrays(fid.read(), path, magic=MAGIC, description='FASTA index')
+        writer = cls()
+        # the KO of every record, back from the postings lists
+        kos = np.zeros(len(arrays['gene_ids']), dtype=arrays['ko_ids'].dtype if len(arrays['ko_ids']) else 'S1')
+        kos[arrays['postings']] = np.repeat(arrays['ko_ids'], np.diff(arrays['posting_offsets']))
+        writer._gene_ids.append(arrays['gene_ids'])
+        writer._kos.append(kos)
+        writer._offsets.append(arrays['record_offsets'])
+        writer._lengths.append(arrays['record_lengths'])
+        writer.size = int(arrays['fasta_size'][0])
+        return writer
+
+    def remove_ranges(self, ranges):
+        """
+        Drop the records in byte ranges of the FASTA file and move the later records down, as when the ranges are cut out of it
+        :param ranges: a sorted list of non-overlapping (offset, length)
+        :return: None
+        """
+        if not ranges:
+            return
+        starts = np.array([x[0] for x in ranges], dtype=np.int64)
+        ends = starts + np.array([x[1] for x in ranges], dtype=np.int64)
+        # the number of bytes removed before each range end
+        removed = np.cumsum(ends - starts)
+        gene_ids, kos = np.concatenate(self._gene_ids), np.concatenate(self._kos)
+        offsets, lengths = np.concatenate(self._offsets), np.concatenate(self._lengths)
+        # the last range that starts at or before each record
+        position = np.searchsorted(starts, offsets, side='right') - 1
+        keep = (position < 0) | (offsets >= ends[np.maximum(position, 0)])
+        shift = np.where(position >= 0, removed[np.maximum(position, 0)], 0)
+        self._gene_ids, self._kos = [gene_ids[keep]], [kos[keep]]
+        self._offsets, self._lengths = [(offsets - shift)[keep]], [lengths[keep]]
+        self.size -= int(removed[-1])
+
+    def write(self, path):
+        """
+        Write the index loaded by FastaIndex
+        :param path: the index file, see index_path
+        :return: the number of records indexed
+        """
+        gene_ids = np.concatenate(self._gene_ids) if self._gene_ids else np.array([], dtype='S1')
+        kos = np.concatenate(self._kos) if self._kos else np.array([], dtype='S1')
+        offsets = np.concatenate(self._offsets) if self._offsets else np.array([], dtype=np.int64)
+        lengths = np.concatenate(self._lengths) if self._lengths else np.array([], dtype=np.int64)
+        # the records are sorted by gene id for the binary search
+        order = np.argsort(gene_ids, kind='stable')
+        gene_ids, kos, offsets, lengths = gene_ids[order], kos[order], offsets[order], lengths[order]
+        # the postings of a KO are in file order, so its records are read front to back
+        with_ko = np.flatnonzero(kos != b'')
+        postings = with_ko[np.lexsort((offsets[with_ko], kos[with_ko]))]
+        ko_ids, counts = np.unique(kos[postings], return_counts=True)
+        posting_offsets = np.zeros(len(ko_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=posting_offsets[1:])
+        write_arrays(path, {
+            'fasta_size': np.array([self.size], dtype=np.int64),
+            'gene_ids': gene_ids, 'record_offsets': offsets, 'record_lengths': lengths,
+            'ko_ids': ko_ids, 'posting_offsets': posting_offsets,
+            'postings': postings.astype(np.int64),
+        }, magic=MAGIC)
+        return len(gene_ids)
+
+
+def build_fasta_index(fasta_file, block_size=BLOCK_SIZE):
+    """
+    Index an existing FASTA file written by convert_table_to_fasta.py
+    :param fasta_file: the FASTA file
+    :param block_size: the number of bytes read at a time
+    :return: the number of records indexed
+    """
+    writer = FastaIndexWriter()
+    offset = 0
+    rest = b''
+    with open(fasta_file, 'rb') as fid:
+        while True:
+            block = fid.read(block_size)
+            data = rest + block
+            # cut the block after the last whole record
+            cut = len(data) if not block else data.rfind(b'\n>') + 1
+            writer.add(data[:cut], offset)
+            offset += cut
+            rest = data[cut:]
+            if not block:
+                break
+    return writer.write(index_path(fasta_file))
+
+
+class FastaIndex:
+    """
+    Random access to the records of a FASTA file written by convert_table_to_fasta.py, through its sidecar index.
+
+    Both files are memory-mapped: a gene id is found by a binary search over the sorted ids and a KO by a binary search
+    over the KO ids followed by its postings list, so a lookup reads only the records it returns.
+    """
+
+    def __init__(self, fasta_file):
+        self.fasta_file = fasta_file
+        self.path = index_path(fasta_file)
+        if not os.path.exists(self.path):
+            raise Exception(f"{fasta_file} has no index, build it with `python fasta_index.py --fasta {fasta_file} --build`")
+        self._index_fid = open(self.path, 'rb')
+        self._index_mm = mmap.mmap(self._index_fid.fileno(), 0, access=mmap.ACCESS_READ)
+        for name, values in read_arrays(self._index_mm, self.path, magic=MAGIC, description='FASTA index').items():
+            setattr(self, name, values)
+        if os.path.getsize(fasta_file) != self.fasta_size[0]:
+            raise Exception(f"The index {self.path} is out of date, {fasta_file} has changed since it was written")
+        self._fasta_fid = open(fasta_file, 'rb')
+        self._fasta_mm = mmap.mmap(self._fasta_fid.fileno(), 0, access=mmap.ACCESS_READ) if self.fasta_size[0] else b''
+
+    def close(self):
+        for name in list(vars(self)):
+            if isinstance(getattr(self, name), np.ndarray):
+                delattr(self, name)
+        if isinstance(self._fasta_mm, mmap.mmap):
+            self._fasta_mm.close()
+        self._index_mm.close()
+        self._fasta_fid.close()
+        self._index_fid.close()
+
+    def __len__(self):
+        return len(self.gene_ids)
+
+    @staticmethod
+    def _find(values, key):
+        key = key.encode()
+        if len(key) > values.dtype.itemsize:
+            return None
+        position = int(np.searchsorted(values, key))
+        if position < len(values) and values[position] == key:
+            return position
+        return None
+
+    def __contains__(self, kegg_gene_id):
+        return self._find(self.gene_ids, kegg_gene_id) is not None
+
+    def _record(self, position):
+        offset = self.record_offsets[position]
+        return self._fasta_mm[offset:offset + self.record_lengths[position]].decode()
+
+    def get(self, kegg_gene_id):
+        """
+        :param kegg_gene_id: e.g. 'aaa:Acav_0001'
+        :return: the FASTA record (header and sequence lines), or None when the gene is not in the file
+        """
+        position = self._find(self.gene_ids, kegg_gene_id)
+        return self._record(position) if position is not None else None
+
+    def gene_ids_for_ko(self, ko):
+        """
+        :param ko: e.g. 'K02588' or 'ko:K02588'
+        :return: the gene ids annotated with the KO, in file order
+        """
+        position = self._find(self.ko_ids, normalize_ko(ko))
+        if position is None:
+            return []
+        return [x.decode() for x in self.gene_ids[self.postings[self.posting_offsets[position]:self.posting_offsets[position + 1]]]]
+
+    def records_for_ko(self, ko):
+        """
+        :param ko: e.g. 'K02588' or 'ko:K02588'
+        :return: the FASTA records of all genes annotated with the KO, concatenated in file order
+        """
+        position = self._find(self.ko_ids, normalize_ko(ko))
+        if position is None:
+            return ''
+        return ''.join(self._record(x) for x in self.postings[self.posting_offsets[position]:self.posting_offsets[position + 1]])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fasta", type=str, help="A FASTA file written by convert_table_to_fasta.py, e.g. kegg_genes_KO.faa", required=True)
+    parser.add_argument("--build", action='store_true', help="(Re)build the index of the FASTA file")
+    parser.add_argument("--ko", type=str, nargs='*', help="Print the records of the genes annotated with these KOs, e.g. K02588", default=[])
+    parser.add_argument("--gene_id", type=str, nargs='*', help="Print the records of these genes, e.g. aaa:Acav_0001", default=[])
+    args = parser.parse_args()
+
+    if args.build:
+        print(f"{build_fasta_index(args.fasta)} records are indexed in {index_path(args.fasta)}", file=sys.stderr)
+    if args.ko or args.gene_id:
+        index = FastaIndex(args.fasta)
+        for ko in args.ko:
+            sys.stdout.write(index.records_for_ko(ko))
+        for kegg_gene_id in args.gene_id:
+            record = index.get(kegg_gene_id)
+            if record is None:
+                print(f"Error: {kegg_gene_id} is not in {args.fasta}", file=sys.stderr, flush=True)
+                continue
+            sys.stdout.write(record)
+        index.close()
@@ -2,62 +2,347 @@
 import os
 import sys
 import argparse
-import logging
-from tqdm import tqdm, trange
-import pickle
-from itertools import chain
-import pandas as pd
-import requests
-from bs4 import BeautifulSoup
 import time
 import re
-from glob import glob
 import json
+import csv
+import resource
+import multiprocessing
+from array import array
+if __package__:
+    from .kegg_client import AsyncFetcher, KEGG_api_link, http_get
+    from .http_cache import add_cache_arguments, cache_from_args
+    from .ko_index import write_index
+    from .metrics import METRICS, progress, add_metrics_arguments, metrics_from_args
+    from .kegg_cli import get_logger, lazy_import
+else:
+    from kegg_client import AsyncFetcher, KEGG_api_link, http_get
+    from http_cache import add_cache_arguments, cache_from_args
+    from ko_index import write_index
+    from metrics import METRICS, progress, add_metrics_arguments, metrics_from_args
+    from kegg_cli import get_logger, lazy_import
+pd = lazy_import('pandas')
 
 
-def get_logger():
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s  [%(levelname)s]  %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
-    ch = logging.StreamHandler(sys.stdout)
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
-    return logger
+def strip_brackets(name):
+    """
+    Remove the bracketed part of a BRITE node name, e.g. 'K00844 HK; hexokinase [EC:2.7.1.1]' -> 'K00844 HK; hexokinase'
+    (the same as re.sub(' \\[.*\\]', '', name))
+    """
+    start = name.find(' [')
+    if start == -1:
+        return name
+    end = name.rfind(']')
+    if end < start:
+        return name
+    return name[:start] + name[end + 1:]
 
 
-def organize_hierarchy(hiearchy_json, regex='^\w?\w?\d{5} ', prefix='', stop_level=None):
+class HierarchyBuilder:
+    """
+    Build the KO DAG of one or more BRITE hierarchies.
 
-    def _iterate_multidimensional(res, hiearchy_json, res_list):
-        if isinstance(hiearchy_json,dict):
-            for k,v in hiearchy_json.items():
-                if k == 'name':
-                    temp_name = re.sub(' \[.*\]','',hiearchy_json['name'])
-                    res += f"|{temp_name}"
-                    if re.search(regex, hiearchy_json['name']) is not None:
-                        res_list += [res]
-                elif k == 'children':
-                    for elem in hiearchy_json['children']:
-                        _iterate_multidimensional(res, elem, res_list)
+    Node names are interned to integer ids and every node of an added hierarchy is stored once, as an integer
+    (parent position, name id) pair, instead of as a '|'-joined path string. Within one hierarchy a leaf id that occurs
+    several times keeps its last position, as organize_hierarchy does. ``build`` turns the stored paths into the
+    duplicate-free edge arrays ``parents``/``children`` of node ids (``labels`` maps a node id back to its name).
+    """
+
+    def __init__(self, regex=r'^K\d{5} ', id_mapping=None):
+        self.pattern = re.compile(regex)
+        self.id_mapping = id_mapping if id_mapping is not None else dict()
+        self.names = dict()
+        self.labels = []
+        self.leaves = dict()
+        self.roots = dict()
+        self.parents = array('i')
+        self.children = array('i')
+        self._node_parent = array('i')
+        self._node_name = array('i')
+
+    def intern(self, name):
+        node_id = self.names.get(name)
+        if node_id is None:
+            node_id = len(self.labels)
+            self.names[name] = node_id
+            self.labels.append(name)
+        return node_id
+
+    def add_hierarchy(self, hiearchy_json, order=0):
+        """
+        Add the paths to the leaf ids of a BRITE hierarchy
+        :param hiearchy_json: the parsed /get/<brite_id>/json response
+        :param order: the rank of the hierarchy; build emits the edges in this order regardless of the order of the calls
+        :return: the number of distinct leaf ids found; a hierarchy without any is not kept
+        """
+        start = len(self._node_parent)
+        last = dict()
+        stack = [(hiearchy_json, -1)]
+        while stack:
+            node, parent = stack.pop()
+            if not isinstance(node, dict):
+                raise Exception(f"{node} is not dictionary")
+            position = len(self._node_parent)
+            self._node_parent.append(parent)
+            name = strip_brackets(node['name'])
+            name_id = self.names.get(name)
+            self._node_name.append(name_id if name_id is not None else self.intern(name))
+            if self.pattern.search(node['name']) is not None:
+                last[name.split(' ')[0]] = position
+            children = node.get('children')
+            if children:
+                stack.extend((child, position) for child in reversed(children))
+        if not last:
+            del self._node_parent[start:]
+            del self._node_name[start:]
+            return 0
+        for key, position in last.items():
+            self.leaves.setdefault(key, []).append((order, position))
+        self.roots[(order, start)] = self._node_name[start]
+        return len(last)
+
+    def path(self, position):
+        """
+        :param position: the position of a node of an added hierarchy
+        :return: the list of node names from the root of its hierarchy down to the node
+        """
+        names = []
+        while position != -1:
+            names.append(self.labels[self._node_name[position]])
+            position = self._node_parent[position]
+        return names[::-1]
+
+    def build(self):
+        """
+        Fill ``parents``/``children`` with the edges of every path (with the BRITE ids mapped by id_mapping and the leaf
+        node replaced by its id), followed by the edges from 'root' to each hierarchy root; duplicates are skipped
+        :return: the number of edges
+        """
+        seen = set()
+        expanded = bytearray(len(self._node_parent))
+        output_ids = dict()
+
+        def _output_id(position):
+            name_id = self._node_name[position]
+            node_id = output_ids.get(name_id)
+            if node_id is None:
+                label = self.labels[name_id]
+                node_id = output_ids[name_id] = self.intern(self.id_mapping.get(label, label))
+            return node_id
+
+        def _add_edge(parent, child):
+            key = (parent << 32) | child
+            if key not in seen:
+                seen.add(key)
+                self.parents.append(parent)
+                self.children.append(child)
+
+        del self.parents[:]
+        del self.children[:]
+        for key, positions in sorted(self.leaves.items(), key=lambda x: min(x[1])):
+            leaf = self.intern(key)
+            for _, position in sorted(positions):
+                # walk up until a node whose edges are already in, then add the new edges from the top down
+                chain = []
+                position = self._node_parent[position]
+                while position != -1 and not expanded[position]:
+                    chain.append(position)
+                    expanded[position] = 1
+                    position = self._node_parent[position]
+                parent = _output_id(position) if position != -1 else None
+                for position in reversed(chain):
+                    node_id = _output_id(position)
+                    if parent is not None:
+                        _add_edge(parent, node_id)
+                    parent = node_id
+                if parent is not None:
+                    _add_edge(parent, leaf)
+        root = self.intern('root')
+        for _, name_id in sorted(self.roots.items()):
+            label = self.labels[name_id]
+            _add_edge(root, self.intern(self.id_mapping.get(label, label)))
+        return len(self.parents)
+
+    def write_edge_list(self, path):
+        with open(path, 'w', newline='') as out_handle:
+            writer = csv.writer(out_handle, delimiter='\t', lineterminator='\n')
+            writer.writerow(['parent', 'child'])
+            labels = self.labels
+            writer.writerows((labels[parent], labels[child]) for parent, child in zip(self.parents, self.children))
+
+
+def organize_hierarchy(hiearchy_json, regex=r'^\w?\w?\d{5} ', prefix='', stop_level=None):
+    """
+    Collect the path to every leaf id of a BRITE hierarchy
+    :param hiearchy_json: the parsed /get/<brite_id>/json response
+    :param regex: the pattern of the leaf node names
+    :param prefix: a prefix added to the leaf ids
+    :param stop_level: keep only the first stop_level names of each path
+    :return: a dict of leaf id -> '|'-joined path of node names from the root down to the leaf
+    """
+    builder = HierarchyBuilder(regex)
+    builder.add_hierarchy(hiearchy_json)
+    res_dict = dict()
+    for key, positions in builder.leaves.items():
+        path = builder.path(positions[-1][1])
+        if stop_level is None:
+            res_dict[prefix + key] = '|'.join(path)
         else:
-            # FIXME: self is not defined
-            self.logger.error(f"{hiearchy_json} is not dictionary")
-            raise
+            res_dict[prefix + key.split('\t')[0]] = '|'.join(path[:stop_level])
+    return res_dict
+
+
+def brite_id_mapping(brite_list):
+    """
+    :param brite_list: (kegg_brite_id, desc) pairs from /list/brite
+    :return: a dict of BRITE node name (e.g. '04131 Membrane trafficking') -> BRITE id (e.g. 'ko04131')
+    """
+    return {f"{re.sub('^[a-z]*:[a-z]*','',x[0])} {x[1]}":x[0].split(':')[1] for x in brite_list}
+
+
+def _legacy_organize_hierarchy(hiearchy_json, regex='^\\w?\\w?\\d{5} ', prefix='', stop_level=None):
+    # the recursive path-string walker used before HierarchyBuilder, kept for the benchmark
+
+    def _iterate_multidimensional(res, hiearchy_json, res_list):
+        for k,v in hiearchy_json.items():
+            if k == 'name':
+                temp_name = re.sub(' \\[.*\\]','',hiearchy_json['name'])
+                res += f"|{temp_name}"
+                if re.search(regex, hiearchy_json['name']) is not None:
+                    res_list += [res]
+            elif k == 'children':
+                for elem in hiearchy_json['children']:
+                    _iterate_multidimensional(res, elem, res_list)
 
     res_list = []
     _iterate_multidimensional('', hiearchy_json, res_list)
-    if stop_level is None:
-        res_dict = {prefix+string.split('|')[-1].split(' ')[0]:'|'.join(string.split('|')[1:]) for string in res_list}
-        return res_dict
+    return {prefix+string.split('|')[-1].split(' ')[0]:'|'.join(string.split('|')[1:]) for string in res_list}
+
+
+def _legacy_edges(hierarchies, id_mapping):
+    ko_hierarchy_dict = dict()
+    for hierarchy_json in hierarchies:
+        temp_dict = _legacy_organize_hierarchy(hierarchy_json, regex='^K\\d{5} ')
+        for key in temp_dict:
+            if key in ko_hierarchy_dict:
+                ko_hierarchy_dict[key] += [temp_dict[key]]
+            else:
+                ko_hierarchy_dict[key] = [temp_dict[key]]
+    ko_edge_list = []
+    brite_root_id_list = []
+    for ko_id, hierarchy_list in ko_hierarchy_dict.items():
+        for item in hierarchy_list:
+            temp_list = [id_mapping.get(x,x) for x in item.split('|')[:-1]]
+            brite_root_id_list += [temp_list[0]]
+            temp_list += [ko_id]
+            ko_edge_list += [(temp_list[index-1], temp_list[index]) for index in range(1, len(temp_list))]
+    ko_edge_list += [('root', brite_root_id) for brite_root_id in dict.fromkeys(brite_root_id_list)]
+    kegg_ko_edge_df = pd.DataFrame(ko_edge_list)
+    kegg_ko_edge_df.columns = ['parent','child']
+    return kegg_ko_edge_df.drop_duplicates().reset_index(drop=True)
+
+
+def _builder_edges(hierarchies, id_mapping):
+    builder = HierarchyBuilder(regex=r'^K\d{5} ', id_mapping=id_mapping)
+    for order, hierarchy_json in enumerate(hierarchies):
+        builder.add_hierarchy(hierarchy_json, order)
+    builder.build()
+    return builder
+
+
+def render_fixture_hierarchy(edge_file):
+    """
+    Render an edge list written by this script back into a BRITE JSON hierarchy
+    :param edge_file: e.g. test/test_data/kegg_ko_edge_df_br:ko00001.txt
+    :return: (hierarchy JSON, /list/brite pairs for the BRITE ids that appear as nodes)
+    """
+    children = dict()
+    with open(edge_file) as fid:
+        next(fid)
+        for line in fid:
+            parent, child = line.rstrip('\n').split('\t')
+            if parent != 'root':
+                children.setdefault(parent, []).append(child)
+    brite_list = []
+
+    def _name(node):
+        if re.match(r'^K\d{5}$', node):
+            return f"{node} {node}"
+        if re.match(r'^[a-z]+\d{5}$', node) and node in children:
+            brite_list.append((f"br:{node}", node))
+            return f"{re.sub('^[a-z]*', '', node)} {node} [BR:{node}]"
+        return node
+
+    root = [x for x in children if not any(x in v for v in children.values())][0]
+    # iterative, so that deep hierarchies do not hit the recursion limit
+    hierarchy_json = {'name': root}
+    stack = [(root, hierarchy_json)]
+    while stack:
+        node, node_json = stack.pop()
+        if node in children:
+            node_json['children'] = [{'name': _name(child)} for child in children[node]]
+            stack.extend(zip(children[node], node_json['children']))
+    return hierarchy_json, brite_list
+
+
+def _benchmark_worker(method, hierarchy_text, brite_list, repeat):
+    # runs in a fresh process, so that ru_maxrss only covers this method
+    id_mapping = brite_id_mapping(brite_list)
+    hierarchies = [json.loads(hierarchy_text)]
+    del hierarchy_text
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = method(hierarchies, id_mapping)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    if isinstance(result, HierarchyBuilder):
+        edges = [(result.labels[p], result.labels[c]) for p, c in zip(result.parents, result.children)]
     else:
-        res_dict = {prefix+string.split('|')[-1].split(' ')[0].split('\t')[0]:'|'.join(string.split('|')[1:(stop_level+1)]) for string in res_list}
-        return res_dict
+        edges = [tuple(x) for x in result.to_numpy()]
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return best, peak / 1024, (peak - baseline) / 1024, edges
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+def benchmark(edge_file, repeat=3):
+    """
+    Compare the recursive path-string builder with HierarchyBuilder on a hierarchy rendered from an edge list
+    :param edge_file: the edge list of one BRITE hierarchy
+    :param repeat: the number of timed passes (the fastest one is reported)
+    :return: a dict of method -> (seconds, peak RSS in MB, RSS growth above the parsed JSON in MB)
+    """
+    hierarchy_json, brite_list = render_fixture_hierarchy(edge_file)
+    hierarchy_text = json.dumps(hierarchy_json)
+    stats = dict()
+    edges = dict()
+    context = multiprocessing.get_context('spawn')
+    for name, method in [('recursive', _legacy_edges), ('interned', _builder_edges)]:
+        with context.Pool(1) as pool:
+            elapsed, peak, growth, edges[name] = pool.apply(_benchmark_worker, (method, hierarchy_text, brite_list, repeat))
+        stats[name] = (elapsed, peak, growth)
+    if edges['recursive'] != edges['interned']:
+        raise Exception("HierarchyBuilder does not reproduce the edges of the recursive builder")
+    return stats
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog)
     parser.add_argument("--outdir", type=str, help="The output directory")
     parser.add_argument("--brite", type=str, help="BRITE ID for which to extract the subtree (eg. ko00001). Otherwise, create the full DAG", default=None)
-    args = parser.parse_args()
+    parser.add_argument("--concurrency", type=int, help="The number of BRITE hierarchies downloaded concurrently", default=20)
+    parser.add_argument("--benchmark", action='store_true', help="Compare the time and peak RSS of the hierarchy builder with the previous recursive one")
+    parser.add_argument("--edge_file", type=str, help="The edge list the benchmark hierarchy is rendered from",
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test', 'test_data', 'kegg_ko_edge_df_br:ko00001.txt'))
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.benchmark:
+        for method, (elapsed, peak, growth) in benchmark(args.edge_file).items():
+            print(f"{method}: {elapsed:.3f}s, peak RSS {peak:.1f} MB (+{growth:.1f} MB above the parsed JSON)")
+        sys.exit(0)
+
     brite = args.brite
     out_dir = args.outdir
     if not brite:
@@ -66,73 +351,69 @@ if __name__ == "__main__":
         parse_all = False
     if brite and not brite.startswith("br:"):
         brite = "br:" + brite
-    KEGG_api_link = 'http://rest.kegg.jp'
 
     logger = get_logger()
+    metrics_from_args(args, os.path.join(out_dir, 'profile'), logger)
+    cache = cache_from_args(args, os.path.join(out_dir, 'http_cache.sqlite'))
 
     # get brite table
     link = f"{KEGG_api_link}/list/brite"
-    res = requests.get(link)
+    res = http_get(link, cache=cache)
     if res.status_code == 200:
         brite_table = pd.DataFrame([x.split('\t') for x in res.text.split('\n') if x.split('\t')[0]])
         brite_table.columns = ['kegg_brite_id','desc']
     else:
         logger.error(f"Fail to download KEGG brite information from {link}")
-        exit()
-
-    # download KEGG KO associated hierarchy and process hierarchy
-    logger.info(f"Download KEGG KO associated hierarchy")
-    ko_hierarchy_dict = dict()
-    for brite_id, desc in brite_table.to_numpy():
-        # only process if we want to parse all of them, or if the brite_id matches what was given on the input
-        if not parse_all and brite_id != brite:
-            continue
-        logger.info(f"Processing brite id {brite_id}")
-        check_link = f"{KEGG_api_link}/get/{brite_id}"
-        res = requests.get(check_link)
-        if res.status_code == 200:
-            m = re.search('K\d{5}', res.text)
-        else:
-            logger.error(f"Fail to download KEGG brite information from {check_link}")
-            continue
-        if m is None:
-            logger.warning(f"Brite ID {brite_id} doesn't contain KO ids and thus skip it.")
-            continue
-        link = f"{KEGG_api_link}/get/{brite_id}/json"
-        json_res = requests.get(link)
-        if json_res.status_code == 200:
-            temp_dict = organize_hierarchy(json_res.json(), regex='^K\d{5} ')
-            for key in temp_dict:
-                if key in ko_hierarchy_dict:
-                    ko_hierarchy_dict[key] += [temp_dict[key]]
-                else:
-                    ko_hierarchy_dict[key] = [temp_dict[key]]
-        else:
-            logger.error(f"Fail to download KEGG brite information from {link}")
+        sys.exit(1)
 
     # set up identifier mapping
-    id_mapping = {f"{re.sub('^[a-z]*:[a-z]*','',x[0])} {x[1]}":x[0].split(':')[1] for x in brite_table.to_numpy()}
+    id_mapping = brite_id_mapping(brite_table.to_numpy())
 
-    # convert hierarchy to edge list
-    ko_edge_list = []
-    brite_root_id_list = []
-    for ko_id, hierarchy_list in ko_hierarchy_dict.items():
-        for item in hierarchy_list:
-            temp_list = [id_mapping.get(x,x) for x in item.split('|')[:-1]]
-            brite_root_id_list += [temp_list[0]]
-            temp_list += [ko_id]
-            ko_edge_list += [(temp_list[index-1], temp_list[index]) for index in range(1, len(temp_list))]
-                
-    # add meta-root to all Brite categories
-    ko_edge_list += [('root', brite_root_id) for brite_root_id in list(set(brite_root_id_list))]
+    # download KEGG KO associated hierarchy and process hierarchy
+    logger.info(f"Download KEGG KO associated hierarchy")
+    # only process if we want to parse all of them, or if the brite_id matches what was given on the input
+    brite_id_list = [brite_id for brite_id in brite_table['kegg_brite_id'] if parse_all or brite_id == brite]
+    brite_order = {brite_id: index for index, brite_id in enumerate(brite_id_list)}
+    builder = HierarchyBuilder(regex=r'^K\d{5} ', id_mapping=id_mapping)
+    fetcher = AsyncFetcher(concurrency=args.concurrency, logger=logger, cache=cache)
+    unparsed = []
+    for result in progress(fetcher.fetch_all((brite_id, f"{KEGG_api_link}/get/{brite_id}/json") for brite_id in brite_id_list), len(brite_id_list), 'brite ids', logger):
+        # the edges are emitted in the /list/brite order, so the output does not depend on the download order
+        with METRICS.stage('parse'):
+            try:
+                hierarchy_json = json.loads(result.text)
+            except ValueError:
+                # e.g. a truncated response; reported like a failed download, and dropped from the cache so that a
+                # rerun downloads it again
+                unparsed.append((result.key, result.url))
+                if cache is not None and not cache.offline:
+                    cache.delete(result.url)
+                continue
+            n_kos = builder.add_hierarchy(hierarchy_json, order=brite_order[result.key])
+        if n_kos == 0:
+            logger.warning(f"Brite ID {result.key} doesn't contain KO ids and thus skip it.")
+    for brite_id, link in fetcher.failed + unparsed:
+        logger.error(f"Fail to download KEGG brite information from {link}")
 
-    kegg_ko_edge_df = pd.DataFrame(ko_edge_list)
-    kegg_ko_edge_df.columns = ['parent','child']
-    kegg_ko_edge_df = kegg_ko_edge_df.drop_duplicates().reset_index(drop=True)
-    if parse_all:
-        kegg_ko_edge_df.to_csv(os.path.join(out_dir, 'kegg_ko_edge_df.txt'), sep='\t', index=None)
-    else:
-        kegg_ko_edge_df.to_csv(os.path.join(out_dir, f"kegg_ko_edge_df_{brite}.txt"), sep='\t', index=None)
+    # convert hierarchy to edge list, with a meta-root above all Brite categories
+    with METRICS.stage('write'):
+        n_edges = builder.build()
+        logger.info(f"{n_edges} edges between {len(builder.labels)} nodes")
+        if parse_all:
+            builder.write_edge_list(os.path.join(out_dir, 'kegg_ko_edge_df.txt'))
+            index_file = os.path.join(out_dir, 'kegg_ko_index.bin')
+        else:
+            builder.write_edge_list(os.path.join(out_dir, f"kegg_ko_edge_df_{brite}.txt"))
+            index_file = os.path.join(out_dir, f"kegg_ko_index_{brite}.bin")
+        # the memory-mapped index of the same DAG for ko_index.KOHierarchyIndex
+        write_index(index_file, builder.parents, builder.children, builder.labels)
+    METRICS.inc('records_total', n_edges, stage='write')
 
+    if fetcher.failed or unparsed:
+        # the edge list lacks the failed hierarchies; a non-zero exit keeps the pipeline from recording the stage as done
+        logger.error(f"{len(fetcher.failed) + len(unparsed)} hierarchies are missing from the edge list, run the script again")
+        sys.exit(1)
 
 
+if __name__ == "__main__":
+    main()
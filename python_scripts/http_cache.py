@@ -0,0 +1,155 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+
+class CachedResponse:
+    """
+    The subset of requests.Response that the scripts use (status_code, text, json())
+    """
+
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class ResponseCache:
+    """
+    A persistent HTTP response cache keyed by URL and stored in one SQLite file.
+
+    Bodies are zlib-compressed. Entries older than ``ttl`` seconds are treated as missing, and once the stored bodies
+    exceed ``max_bytes`` the least recently used entries are evicted. In ``offline`` mode expired entries are still
+    replayed and a miss never goes to the network.
+    """
+
+    def __init__(self, path, ttl=None, max_bytes=None, offline=False):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, status INTEGER, body BLOB, size INTEGER, created REAL, accessed REAL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self._total_bytes = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, url):
+        """
+        Look up a cached response
+        :param url: the request URL
+        :return: CachedResponse or None when the entry is missing or expired
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT status, body, created FROM responses WHERE url = ?', (url,)).fetchone()
+            if row is None or (not self.offline and self.ttl is not None and now - row[2] > self.ttl):
+                self.misses += 1
+                return None
+            self._conn.execute('UPDATE responses SET accessed = ? WHERE url = ?', (now, url))
+            self.hits += 1
+        return CachedResponse(row[0], zlib.decompress(row[1]).decode())
+
+    def put(self, url, status_code, text):
+        """
+        Store a response body
+        :param url: the request URL
+        :param status_code: the HTTP status code
+        :param text: the response body
+        :return: None
+        """
+        body = zlib.compress(text.encode(), 6)
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute('SELECT size FROM responses WHERE url = ?', (url,)).fetchone()
+            self._conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)', (url, status_code, body, len(body), now, now))
+            self._total_bytes += len(body) - (old[0] if old is not None else 0)
+            if self.max_bytes is not None and self._total_bytes > self.max_bytes:
+                self._evict(int(self.max_bytes * 0.9))
+
+    def delete(self, url):
+        """
+        Drop a stored response, e.g. one whose body turned out to be truncated
+        :param url: the request URL
+        :return: None
+        """
+        with self._lock:
+            old = self._conn.execute('SELECT size FROM responses WHERE url = ?', (url,)).fetchone()
+            if old is not None:
+                self._conn.execute('DELETE FROM responses WHERE url = ?', (url,))
+                self._total_bytes -= old[0]
+
+    def _evict(self, target_bytes):
+        freed = 0
+        to_free = self._total_bytes - target_bytes
+        urls = []
+        for url, size in self._conn.execute('SELECT url, size FROM responses ORDER BY accessed'):
+            if freed >= to_free:
+                break
+            urls.append((url,))
+            freed += size
+        self._conn.executemany('DELETE FROM responses WHERE url = ?', urls)
+        self._total_bytes -= freed
+
+    def summary(self):
+        return f"HTTP cache {self.path}: {self.hits} hits, {self.misses} misses, {self._total_bytes / 1e6:.1f} MB stored"
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RefreshingCache:
+    """
+    A view of a ResponseCache for responses that must be current, e.g. the pages of the entries a sync found changed:
+    the stored responses are skipped and the downloaded ones replace them. In offline mode the stored ones are replayed.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.offline = cache.offline
+
+    def get(self, url):
+        return self.cache.get(url) if self.offline else None
+
+    def put(self, url, status_code, text):
+        self.cache.put(url, status_code, text)
+
+    def delete(self, url):
+        self.cache.delete(url)
+
+
+def add_cache_arguments(parser):
+    parser.add_argument("--cache", type=str, help="The SQLite file used to cache HTTP responses", default=None)
+    parser.add_argument("--no_cache", action='store_true', help="Do not cache HTTP responses")
+    parser.add_argument("--cache_ttl_days", type=float, help="Cached responses older than this are downloaded again", default=30)
+    parser.add_argument("--cache_max_gb", type=float, help="Evict the least recently used responses beyond this size of compressed bodies (0: unlimited)", default=5)
+    parser.add_argument("--offline", action='store_true', help="Replay responses from the cache only and never use the network")
+
+
+def cache_from_args(args, default_path):
+    """
+    Open the response cache described by the add_cache_arguments options
+    :param args: the parsed command line arguments
+    :param default_path: the cache file to use when --cache is not given
+    :return: ResponseCache or None when caching is disabled
+    """
+    if args.no_cache:
+        if args.offline:
+            raise Exception("--offline requires the response cache")
+        return None
+    return ResponseCache(args.cache if args.cache is not None else default_path,
+                         ttl=args.cache_ttl_days * 86400 if args.cache_ttl_days else None,
+                         max_bytes=args.cache_max_gb * 1e9 if args.cache_max_gb else None,
+                         offline=args.offline)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+import sys
+import logging
+import argparse
+import importlib
+import importlib.util
+
+# the subcommands of kegg-extract: name -> (script, description). A script is only imported when its subcommand runs,
+# so `kegg-extract --help` does not load pandas and friends
+COMMANDS = {
+    'organisms': ('extract_kegg_organism_data', "Download the KEGG organism table and the gene tables of the selected organisms"),
+    'viruses': ('extract_kegg_virus_data', "Download the KEGG virus table and the virus gene table"),
+    'ko-hierarchy': ('get_ko_hierarchy', "Download the KO hierarchy (BRITE) as an edge list"),
+    'seqs': ('download_seq_fasta', "Download the NCBI sequences of an organism or virus table"),
+    'fasta': ('convert_table_to_fasta', "Convert the gene tables to FASTA files"),
+    'sketch': ('sketch', "Sketch gene tables or FASTA files into a sourmash signature database"),
+    'pipeline': ('pipeline', "Run all of the above as main.sh does, each stage as soon as its inputs are ready"),
+}
+LOG_HANDLER = 'kegg_extract'
+
+
+def get_logger():
+    """
+    :return: the root logger, logging to stdout; the handler is only added once per process, so a worker process can
+             call it whether it was forked from a script that already did or spawned afresh
+    """
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+    if not any(x.get_name() == LOG_HANDLER for x in logger.handlers):
+        formatter = logging.Formatter('%(asctime)s  [%(levelname)s]  %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
+        ch = logging.StreamHandler(sys.stdout)
+        ch.set_name(LOG_HANDLER)
+        ch.setFormatter(formatter)
+        logger.addHandler(ch)
+    return logger
+
+
+class LazyModule:
+    """
+    A stand-in for a module that imports it on first attribute access, so that importing a script (e.g. for its --help)
+    does not pay for the heavy libraries it only needs to do its work. The attributes are kept once looked up, so a
+    loaded LazyModule costs no more than the module itself.
+    """
+
+    def __init__(self, name):
+        self._lazy_name = name
+        self._lazy_module = None
+
+    def __getattr__(self, attr):
+        # only called for attributes that are not looked up yet
+        if self._lazy_module is None:
+            self._lazy_module = importlib.import_module(self._lazy_name)
+        value = getattr(self._lazy_module, attr)
+        setattr(self, attr, value)
+        return value
+
+    def __repr__(self):
+        return f"<lazy module '{self._lazy_name}'>"
+
+
+def lazy_import(name, optional=False):
+    """
+    Import a module on first use, e.g. ``pd = lazy_import('pandas')`` instead of ``import pandas as pd``
+    :param name: the module, e.g. 'pandas' or 'pyarrow.dataset'
+    :param optional: return None when the package is not installed, as ``except ImportError`` would
+    :return: the module if it is already imported, otherwise a LazyModule
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    if optional and importlib.util.find_spec(name.split('.')[0]) is None:
+        return None
+    return LazyModule(name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='kegg-extract', formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description="Download KEGG organism and virus data, their NCBI sequences and the KO hierarchy",
+                                     epilog="commands:\n" + '\n'.join(f"  {name:<14}{description}" for name, (_, description) in COMMANDS.items()) +
+                                            "\n\nRun `kegg-extract <command> --help` for the options of a command.")
+    parser.add_argument("command", choices=list(COMMANDS), metavar='command', help="One of the commands below")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="The options of the command")
+    args = parser.parse_args(argv)
+
+    script = COMMANDS[args.command][0]
+    # relative to the kegg_extract package once installed, as the scripts import each other
+    prefix = f"{__package__}." if __package__ else ''
+    module = importlib.import_module(prefix + script)
+    # the metrics and profile files are named after the script, as when it is run on its own
+    importlib.import_module(prefix + 'metrics').METRICS.script = script
+    return module.main(args.args, prog=f"kegg-extract {args.command}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
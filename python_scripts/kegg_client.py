@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+import os
+import sys
+import argparse
+import asyncio
+import logging
+import queue
+import random
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+if __package__:
+    from .http_cache import CachedResponse
+    from .rate_limit import RetryPolicy, NO_RETRY, limiter_for, alias_host
+    from .metrics import METRICS, endpoint_of
+else:
+    from http_cache import CachedResponse
+    from rate_limit import RetryPolicy, NO_RETRY, limiter_for, alias_host
+    from metrics import METRICS, endpoint_of
+
+# the services can be pointed at a local stand-in (see mock_services.py) through the environment
+KEGG_api_link = os.environ.get('KEGG_API_LINK', 'http://rest.kegg.jp')
+GENOME_link = os.environ.get('KEGG_GENOME_LINK', 'https://www.genome.jp')
+EUTILS_link = os.environ.get('NCBI_EUTILS_LINK', 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils')
+# a stand-in is throttled like the service it replaces
+for _link, _host in [(KEGG_api_link, 'rest.kegg.jp'), (GENOME_link, 'www.genome.jp'), (EUTILS_link, 'eutils.ncbi.nlm.nih.gov')]:
+    alias_host(urlparse(_link).netloc, _host)
+
+# urllib3 logs a line per request at DEBUG, the level of the scripts' root logger; progress is reported by metrics.Progress instead
+logging.getLogger('urllib3').setLevel(logging.WARNING)
+
+FetchResult = namedtuple('FetchResult', ['key', 'url', 'status', 'text', 'error', 'elapsed'])
+# the end-of-items marker of the AsyncFetcher and prefetch queues
+_STOP = object()
+
+
+def make_session(pool_size=20):
+    """
+    Create one requests session whose connection pool is large enough to keep a keep-alive socket per worker
+    :param pool_size: the number of connections kept open per host
+    :return: requests.Session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def http_get(url, cache=None, session=None, timeout=60, retry=None):
+    """
+    GET a URL through the response cache and the host's shared rate limiter
+    :param url: the request URL
+    :param cache: an optional http_cache.ResponseCache; successful responses are stored in it
+    :param session: an optional requests.Session to send the request with
+    :param timeout: the request timeout in seconds
+    :param retry: the rate_limit.RetryPolicy for connection errors and throttling responses (default: RetryPolicy())
+    :return: requests.Response or http_cache.CachedResponse (status 504 for an offline cache miss)
+    """
+    if cache is not None:
+        cached = cache.get(url)
+        if cached is not None:
+            METRICS.inc('http_cache_hits_total', endpoint=endpoint_of(url))
+            return cached
+        if cache.offline:
+            return CachedResponse(504, '')
+    retry = retry if retry is not None else RetryPolicy()
+    limiter = limiter_for(url)
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        start = time.monotonic()
+        try:
+            res = (session if session is not None else requests).get(url, timeout=timeout)
+        except requests.RequestException:
+            METRICS.record_request(url, None, time.monotonic() - start)
+            if limiter is not None:
+                limiter.update(None)
+            if attempt >= retry.max_retries:
+                raise
+        else:
+            METRICS.record_request(url, res.status_code, time.monotonic() - start, len(res.content))
+            if limiter is not None:
+                limiter.update(res.status_code)
+            if not retry.should_retry(res.status_code) or attempt >= retry.max_retries:
+                break
+        METRICS.inc('http_retries_total', endpoint=endpoint_of(url))
+        time.sleep(retry.delay(attempt))
+        attempt += 1
+    if res.status_code == 200 and cache is not None:
+        cache.put(url, res.status_code, res.text)
+    return res
+
+
+class PackingStats:
+    def __init__(self, batch_size=10):
+        self.batch_size = batch_size
+        self.ids = 0
+        self.requests = 0
+        self.unpacked_requests = 0
+
+    def summary(self):
+        packed = self.ids / (self.requests * self.batch_size) if self.requests else 0.0
+        unpacked = self.ids / (self.unpacked_requests * self.batch_size) if self.unpacked_requests else 0.0
+        return f"{self.ids} ids in {self.requests} requests (fill ratio {packed:.3f}); batching per group would need {self.unpacked_requests} requests (fill ratio {unpacked:.3f})"
+
+
+def pack_queries(groups, batch_size=10, stats=None):
+    """
+    Pack the ids of many groups (e.g. organisms) into '+'-joined /get queries that are always full, except the last one
+    :param groups: an iterable of (group key, list of ids); it is consumed lazily
+    :param batch_size: the number of ids per query (KEGG /get accepts at most 10)
+    :param stats: an optional PackingStats to count ids and requests in
+    :return: a generator of queries
+    """
+    batch = []
+    for _, ids in groups:
+        if stats is not None:
+            stats.ids += len(ids)
+            stats.unpacked_requests += -(-len(ids) // batch_size)
+        for x in ids:
+            batch.append(x)
+            if len(batch) == batch_size:
+                if stats is not None:
+                    stats.requests += 1
+                yield '+'.join(batch)
+                batch = []
+    if batch:
+        if stats is not None:
+            stats.requests += 1
+        yield '+'.join(batch)
+
+
+class FetchStats:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, result):
+        with self._lock:
+            self.requests += 1
+            if result.status != 200:
+                self.errors += 1
+            if result.text is not None:
+                self.bytes += len(result.text)
+
+    def rate(self):
+        elapsed = time.monotonic() - self.start
+        return self.requests / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        elapsed = time.monotonic() - self.start
+        return f"{self.requests} requests ({self.errors} failed, {self.retries} retried, {self.bytes / 1e6:.1f} MB) in {elapsed:.1f}s: {self.rate():.1f} requests/sec"
+
+
+def prefetch(items, maxsize=1):
+    """
+    Iterate over items in a background thread, up to maxsize items ahead of the caller
+    :param items: an iterable whose items are slow to produce, e.g. because producing one blocks on a lock or a download
+    :param maxsize: the number of items produced ahead
+    :return: a generator of the items; an exception raised by items is re-raised to the caller in its place
+    """
+    item_queue = queue.Queue(maxsize=maxsize)
+    failure = []
+
+    def _target():
+        try:
+            for item in items:
+                item_queue.put(item)
+        except BaseException as e:
+            failure.append(e)
+        finally:
+            item_queue.put(_STOP)
+
+    threading.Thread(target=_target, daemon=True).start()
+    while True:
+        item = item_queue.get()
+        if item is _STOP:
+            break
+        yield item
+    if failure:
+        raise failure[0]
+
+
+class AsyncFetcher:
+    """
+    Fetch many URLs over one pooled keep-alive session with a fixed number of requests in flight.
+
+    The event loop runs in a background thread and hands finished responses to the caller through a bounded queue,
+    so a plain ``for`` loop can consume (and parse) results while the next requests are already on the wire.
+    Requests go through the host's shared rate_limit limiter; throttled or failed requests are retried with jittered
+    backoff (without holding a worker thread), and the ones that still fail are kept in ``failed`` for a later pass.
+    """
+
+    def __init__(self, concurrency=20, session=None, timeout=60, retry=None, report_every=60, logger=None, cache=None):
+        self.concurrency = concurrency
+        self.cache = cache
+        self.session = session if session is not None else make_session(concurrency)
+        self.timeout = timeout
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.report_every = report_every
+        self.logger = logger
+        self.stats = FetchStats()
+        self.failed = []
+
+    def _get(self, key, url):
+        start = time.monotonic()
+        try:
+            res = http_get(url, cache=self.cache, session=self.session, timeout=self.timeout, retry=NO_RETRY)
+        except requests.RequestException as e:
+            return FetchResult(key, url, None, None, str(e), time.monotonic() - start)
+        return FetchResult(key, url, res.status_code, res.text, None, time.monotonic() - start)
+
+    async def _worker(self, loop, executor, in_queue, out_queue):
+        offline = self.cache is not None and self.cache.offline
+        while True:
+            item = await loop.run_in_executor(executor, in_queue.get)
+            if item is _STOP:
+                return
+            key, url = item
+            attempt = 0
+            while True:
+                result = await loop.run_in_executor(executor, self._get, key, url)
+                if offline or not self.retry.should_retry(result.status) or attempt >= self.retry.max_retries:
+                    break
+                METRICS.inc('http_retries_total', endpoint=endpoint_of(url))
+                await asyncio.sleep(self.retry.delay(attempt))
+                attempt += 1
+            self.stats.retries += attempt
+            if result.status != 200:
+                self.failed.append((key, url))
+            self.stats.add(result)
+            # blocking put gives back-pressure when the consumer falls behind
+            await loop.run_in_executor(executor, out_queue.put, result)
+
+    def _feed(self, items, in_queue, failure):
+        # the items are produced in their own thread: a generator that reads and writes tables (or waits on a lock) would
+        # otherwise hold up the event loop and with it every request in flight
+        try:
+            for item in items:
+                in_queue.put(item)
+        except BaseException as e:
+            failure.append(e)
+        finally:
+            for _ in range(self.concurrency):
+                in_queue.put(_STOP)
+
+    async def _run(self, items, out_queue):
+        loop = asyncio.get_running_loop()
+        # the workers share a bounded queue, so each one pulls the next item as soon as it is free
+        in_queue = queue.Queue(maxsize=self.concurrency * 2)
+        failure = []
+        feeder = threading.Thread(target=self._feed, args=(items, in_queue, failure), daemon=True)
+        feeder.start()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            workers = [self._worker(loop, executor, in_queue, out_queue) for _ in range(self.concurrency)]
+            await asyncio.gather(*workers)
+        feeder.join()
+        if failure:
+            raise failure[0]
+
+    def fetch(self, items):
+        """
+        Fetch the given URLs concurrently and yield results in completion order
+        :param items: an iterable of (key, url) pairs; it is consumed lazily
+        :return: a generator of FetchResult
+        """
+        out_queue = queue.Queue(maxsize=self.concurrency * 4)
+        done = object()
+        failure = []
+
+        def _target():
+            try:
+                asyncio.run(self._run(items, out_queue))
+            except BaseException as e:
+                failure.append(e)
+            finally:
+                out_queue.put(done)
+
+        thread = threading.Thread(target=_target, daemon=True)
+        thread.start()
+        last_report = time.monotonic()
+        while True:
+            result = out_queue.get()
+            if result is done:
+                break
+            yield result
+            if self.logger is not None and time.monotonic() - last_report > self.report_every:
+                self.logger.info(self.stats.summary())
+                last_report = time.monotonic()
+        thread.join()
+        if failure:
+            raise failure[0]
+        if self.logger is not None:
+            self.logger.info(self.stats.summary())
+
+    def fetch_all(self, items, passes=2):
+        """
+        Fetch the given URLs and re-queue the failed ones for up to ``passes`` passes
+        :param items: an iterable of (key, url) pairs
+        :param passes: the number of passes over the failed requests
+        :return: a generator of the successful FetchResult; the requests that still fail are left in ``failed``
+        """
+        self.failed = []
+        pending = items
+        for i in range(passes):
+            for result in self.fetch(pending):
+                if result.status == 200:
+                    yield result
+            if not self.failed or i == passes - 1:
+                break
+            if self.logger is not None:
+                self.logger.warning(f"Re-queue {len(self.failed)} failed requests")
+            pending, self.failed = self.failed, []
+
+
+def _start_stand_in_server(latency, error_rate=0.0):
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    record = "ENTRY       b0001\nORTHOLOGY   K08278  thr operon leader peptide\nAASEQ       21\n            MKRISTTITTTITITTGNGAG\n///\n"
+
+    class _Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            time.sleep(latency)
+            if random.random() < error_rate:
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = (record * max(1, self.path.count('+') + 1)).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _legacy_get(url):
+    return requests.get(url).status_code
+
+
+def benchmark(n_requests=1000, concurrency=20, latency=0.05):
+    """
+    Compare the per-group multiprocessing Pool pattern against AsyncFetcher on a local stand-in server
+    :param n_requests: the number of /get requests to issue with each method
+    :param concurrency: the pool size / number of requests in flight
+    :param latency: artificial server latency per request in seconds
+    :return: a dict of requests/sec per method
+    """
+    from multiprocessing import Pool
+
+    server = _start_stand_in_server(latency)
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    urls = [f"{base}/get/eco:b{i:04d}+eco:b{i + 1:04d}" for i in range(n_requests)]
+    rates = dict()
+
+    start = time.monotonic()
+    for i in range(0, len(urls), concurrency):
+        with Pool(processes=concurrency) as excutator:
+            excutator.map(_legacy_get, urls[i:i + concurrency])
+    rates['pool_per_group'] = n_requests / (time.monotonic() - start)
+
+    fetcher = AsyncFetcher(concurrency=concurrency)
+    for _ in fetcher.fetch(enumerate(urls)):
+        pass
+    rates['async_fetcher'] = fetcher.stats.rate()
+
+    server.shutdown()
+    return rates
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action='store_true', help="Benchmark the fetch engine against a local stand-in server")
+    parser.add_argument("--requests", type=int, help="The number of requests to issue in benchmark mode", default=1000)
+    parser.add_argument("--concurrency", type=int, help="The number of concurrent requests", default=20)
+    parser.add_argument("--latency", type=float, help="The stand-in server latency per request (seconds)", default=0.05)
+    args = parser.parse_args()
+
+    if not args.benchmark:
+        parser.print_help()
+        sys.exit(0)
+
+    rates = benchmark(args.requests, args.concurrency, args.latency)
+    for method, rate in rates.items():
+        print(f"{method}: {rate:.1f} requests/sec")
+    print(f"speedup: {rates['async_fetcher'] / rates['pool_per_group']:.2f}x")
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+import os
+import sys
+import argparse
+import re
+import time
+import tracemalloc
+
+# the field label occupies the first 12 columns of a KEGG flat-file line
+LABEL_WIDTH = 12
+GENE_FIELDS = frozenset(['ENTRY', 'ORTHOLOGY', 'TAXONOMY', 'AASEQ', 'NTSEQ'])
+
+
+class KEGGRecord:
+    """
+    One entry of a KEGG /get flat-file response.
+
+    ``fields`` maps every kept field label to its value lines (label columns removed); the commonly used fields are
+    exposed as attributes.
+    """
+    __slots__ = ('fields',)
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def _first_token(self, label):
+        lines = self.fields.get(label)
+        if not lines:
+            return None
+        tokens = lines[0].split()
+        return tokens[0] if tokens else None
+
+    @property
+    def entry(self):
+        return self._first_token('ENTRY')
+
+    @property
+    def org_code(self):
+        return self._first_token('ORGANISM')
+
+    @property
+    def koid(self):
+        ko = self._first_token('ORTHOLOGY')
+        return f"ko:{ko}" if ko is not None else None
+
+    @property
+    def taxaid(self):
+        tax = self._first_token('TAXONOMY')
+        return tax.replace('TAX:', '') if tax is not None else None
+
+    def _sequence(self, label):
+        lines = self.fields.get(label)
+        if lines is None:
+            return None
+        # the first line holds the sequence length, the sequence follows on the continuation lines
+        return ''.join(line.strip() for line in lines[1:])
+
+    @property
+    def aaseq(self):
+        return self._sequence('AASEQ')
+
+    @property
+    def ntseq(self):
+        return self._sequence('NTSEQ')
+
+    def get(self, label):
+        lines = self.fields.get(label)
+        return '\n'.join(lines) if lines is not None else None
+
+
+def iter_lines(text):
+    """
+    Yield the lines of a string without splitting the whole string up front
+    :param text: a response body
+    :return: a generator of lines (without the newline)
+    """
+    start = 0
+    end = text.find('\n')
+    while end != -1:
+        yield text[start:end]
+        start = end + 1
+        end = text.find('\n', start)
+    if start < len(text):
+        yield text[start:]
+
+
+def iter_records(lines, fields=None):
+    """
+    Parse KEGG flat-file lines in one pass
+    :param lines: an iterable of lines, e.g. iter_lines(response.text) or an open file
+    :param fields: an optional set of field labels to keep; other fields are skipped without being copied
+    :return: a generator of KEGGRecord
+    """
+    values = dict()
+    current = None
+    for line in lines:
+        if line.startswith('///'):
+            if values:
+                yield KEGGRecord(values)
+            values = dict()
+            current = None
+            continue
+        label = line[:LABEL_WIDTH].strip()
+        if label:
+            if fields is not None and label not in fields:
+                current = None
+                continue
+            current = values.setdefault(label, [])
+            current.append(line[LABEL_WIDTH:].rstrip())
+        elif current is not None:
+            current.append(line[LABEL_WIDTH:].rstrip())
+    if values:
+        yield KEGGRecord(values)
+
+
+def parse_get_response(query, text, fields=GENE_FIELDS):
+    """
+    Match the records of a /get response to the '+'-joined gene ids that were requested
+    :param query: the requested ids, e.g. 'eco:b0001+eco:b0002'
+    :param text: the response body
+    :param fields: the field labels to keep (ORGANISM is always read, to match the records)
+    :return: a generator of (kegg_gene_id, KEGGRecord)
+    """
+    # ENTRY only carries the part of the id after the organism prefix, so a record is matched by the organism code of
+    # its ORGANISM field and its ENTRY; the ids of a packed query from several organisms can share the ENTRY part
+    requested = dict()
+    by_entry = dict()
+    for gene_id in query.split('+'):
+        org_code, _, entry = gene_id.rpartition(':')
+        requested[(org_code, entry)] = gene_id
+        by_entry.setdefault(entry, []).append(org_code)
+    if fields is not None:
+        fields = fields | {'ORGANISM'}
+    for record in iter_records(iter_lines(text), fields=fields):
+        kegg_gene_id = requested.pop((record.org_code, record.entry), None)
+        if kegg_gene_id is None:
+            # without a usable ORGANISM field, fall back to the ENTRY part, in the order the ids were requested
+            pending = [org_code for org_code in by_entry.get(record.entry, []) if (org_code, record.entry) in requested]
+            if not pending:
+                continue
+            kegg_gene_id = requested.pop((pending[0], record.entry))
+        yield kegg_gene_id, record
+
+
+def parse_link_response(text):
+    """
+    Parse a KEGG /link response, e.g. /link/ko/eco
+    :param text: the response body with one 'source<TAB>target' pair per line
+    :return: a dict of source id -> first target id
+    """
+    links = dict()
+    for line in iter_lines(text):
+        source, _, target = line.partition('\t')
+        if target and source not in links:
+            links[source] = target.strip()
+    return links
+
+
+def iter_fasta(text):
+    """
+    Parse a FASTA response, e.g. /get/eco:b0001+eco:b0002/aaseq
+    :param text: the response body
+    :return: a generator of (id, sequence) where id is the first word of the header
+    """
+    header = None
+    chunks = []
+    for line in iter_lines(text):
+        if line.startswith('>'):
+            if header is not None:
+                yield header, ''.join(chunks)
+            header = line[1:].split(' ', 1)[0]
+            chunks = []
+        elif line:
+            chunks.append(line.strip())
+    if header is not None:
+        yield header, ''.join(chunks)
+
+
+def _legacy_extract_taxaid_seq(inlist):
+    # the per-record parser that the extractors used before this module, kept for the benchmark
+    temp = '|'.join(inlist)
+    if 'TAXONOMY' in temp:
+        taxaid = [re.sub(r'\s.*', '', re.sub(r'TAXONOMY\s*TAX:', '', line)) for line in inlist if 'TAXONOMY' in line][0]
+    else:
+        taxaid = None
+    if 'ORTHOLOGY' in temp:
+        koid = 'ko:' + [re.sub(r'\s.*', '', re.sub(r'ORTHOLOGY\s*', '', line)) for line in inlist if 'ORTHOLOGY' in line][0]
+    else:
+        koid = None
+    if 'AASEQ' in temp:
+        aaseq = re.sub(r'\d*', '', '|'.join(inlist).split('AASEQ       ')[1].split('|COMMENT     ')[0].split('|NTSEQ     ')[0]).replace('|            ', '').replace('|', '')
+    else:
+        aaseq = None
+    if 'NTSEQ' in temp:
+        ntseq = re.sub(r'\d*', '', '|'.join(inlist).split('NTSEQ       ')[1].split('|COMMENT     ')[0]).replace('|            ', '').replace('|', '')
+    else:
+        ntseq = None
+    return taxaid, koid, aaseq, ntseq
+
+
+def _read_fasta(path):
+    records = dict()
+    header = None
+    with open(path) as fid:
+        for line in fid:
+            if line.startswith('>'):
+                header = line[1:].rstrip('\n')
+            elif header is not None:
+                records[header] = line.strip()
+    return records
+
+
+def _wrap(label, lines):
+    return [f"{label:<{LABEL_WIDTH}}{lines[0]}"] + [' ' * LABEL_WIDTH + line for line in lines[1:]]
+
+
+def render_record(kegg_gene_id, desc, koid, aaseq, ntseq, taxaid=None):
+    """
+    Render one gene as a KEGG /get flat-file record
+    :param kegg_gene_id: e.g. 'eco:b0001'
+    :param desc: the gene description
+    :param koid: e.g. 'ko:K08278', or '' / None without a KO
+    :param aaseq: the amino acid sequence, or '' / None
+    :param ntseq: the nucleotide sequence, or '' / None
+    :param taxaid: the NCBI taxonomy id written to the TAXONOMY field (viral genes), or None
+    :return: the record text, ending with '///'
+    """
+    org_code, gene = kegg_gene_id.split(':', 1)
+    lines = [f"{'ENTRY':<{LABEL_WIDTH}}{gene:<18}CDS       T00000", f"{'NAME':<{LABEL_WIDTH}}{desc}"]
+    if koid:
+        lines.append(f"{'ORTHOLOGY':<{LABEL_WIDTH}}{koid.replace('ko:', '')}  {desc}")
+    lines.append(f"{'ORGANISM':<{LABEL_WIDTH}}{org_code}")
+    if taxaid:
+        lines.append(f"{'TAXONOMY':<{LABEL_WIDTH}}TAX:{taxaid}")
+    for label, seq in [('AASEQ', aaseq), ('NTSEQ', ntseq)]:
+        if seq:
+            lines += _wrap(label, [str(len(seq))] + [seq[i:i + 60] for i in range(0, len(seq), 60)])
+    return '\n'.join(lines) + '\n///\n'
+
+
+def render_fixture_responses(fasta_dir, batch_size=10):
+    """
+    Render the FASTA files produced by convert_table_to_fasta.py back into KEGG /get flat-file responses
+    :param fasta_dir: the directory with kegg_genes_KO.faa/.fna
+    :param batch_size: the number of records per response
+    :return: a list of (query, response text)
+    """
+    aa = _read_fasta(os.path.join(fasta_dir, 'kegg_genes_KO.faa'))
+    nt = _read_fasta(os.path.join(fasta_dir, 'kegg_genes_KO.fna'))
+    records = []
+    for header, aaseq in aa.items():
+        kegg_gene_id, desc, koid = header.split('|')
+        records.append((kegg_gene_id, render_record(kegg_gene_id, desc, koid, aaseq, nt.get(header))))
+    responses = []
+    for i in range(0, len(records), batch_size):
+        batch = records[i:i + batch_size]
+        responses.append(('+'.join(x[0] for x in batch), ''.join(x[1] for x in batch)))
+    return responses
+
+
+def _parse_legacy(query, text):
+    return [tuple([a]) + b for a, b in zip(query.split('+'), list(map(_legacy_extract_taxaid_seq, [x.split('\n') for x in text.split('///')])))]
+
+
+def _parse_streaming(query, text):
+    return [(kegg_gene_id, record.taxaid, record.koid, record.aaseq, record.ntseq) for kegg_gene_id, record in parse_get_response(query, text)]
+
+
+def benchmark(responses, repeat=3):
+    """
+    Measure the per-record parse cost and the peak memory of parsing one response with the legacy parser and iter_records
+    :param responses: a list of (query, response text)
+    :param repeat: the number of timed passes (the fastest one is reported)
+    :return: a dict of method -> (microseconds per record, peak KB above the response body)
+    """
+    stats = dict()
+    for name, method in [('legacy', _parse_legacy), ('streaming', _parse_streaming)]:
+        best = None
+        for _ in range(repeat):
+            n_rows = 0
+            start = time.perf_counter()
+            for query, text in responses:
+                n_rows += len(method(query, text))
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        peak = 0
+        for query, text in responses:
+            tracemalloc.start()
+            method(query, text)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        stats[name] = (best / n_rows * 1e6, peak / 1024)
+    for query, text in responses:
+        if _parse_legacy(query, text) != _parse_streaming(query, text):
+            raise Exception(f"The streaming parser does not reproduce the legacy parser output for {query}")
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action='store_true', help="Compare the streaming parser with the legacy per-record parser")
+    parser.add_argument("--fasta_dir", type=str, help="The folder of FASTA files used to render /get responses for the benchmark",
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_data', 'output'))
+    parser.add_argument("--responses", type=str, help="A file of recorded /get responses to benchmark on instead (records separated by ///)", default=None)
+    args = parser.parse_args()
+
+    if not args.benchmark:
+        parser.print_help()
+        sys.exit(0)
+
+    if args.responses is not None:
+        with open(args.responses) as fid:
+            text = fid.read()
+        query = '+'.join(f"org:{record.entry}" for record in iter_records(iter_lines(text)))
+        responses = [(query, text)]
+    else:
+        responses = render_fixture_responses(args.fasta_dir)
+    n_records = sum(query.count('+') + 1 for query, _ in responses)
+    print(f"{n_records} records in {len(responses)} responses ({sum(len(text) for _, text in responses) / 1e6:.1f} MB)")
+    for method, (per_record, peak) in benchmark(responses).items():
+        print(f"{method}: {per_record:.1f} us/record, peak {peak:.0f} KB")
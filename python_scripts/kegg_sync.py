@@ -0,0 +1,63 @@
+import os
+import json
+import time
+if __package__:
+    from .kegg_flatfile import iter_lines
+else:
+    from kegg_flatfile import iter_lines
+
+
+def parse_list_response(text, key_column=0, value_column=-1):
+    """
+    Parse a KEGG /list response into an ordered dict
+    :param text: the response body with tab-separated columns
+    :param key_column: the column used as key (e.g. 1 for the org_code of /list/organism)
+    :param value_column: the column compared between releases (e.g. the gene description)
+    :return: a dict of key -> value
+    """
+    listing = dict()
+    for line in iter_lines(text):
+        columns = line.split('\t')
+        if columns[0]:
+            listing[columns[key_column]] = columns[value_column]
+    return listing
+
+
+def diff_listing(old, new):
+    """
+    Compare a stored listing with a fresh one
+    :param old: a dict of id -> value from the stored snapshot
+    :param new: a dict of id -> value from the fresh listing
+    :return: (added, removed, changed) lists of ids; changed ids are in both listings with different values
+    """
+    added = [x for x in new if x not in old]
+    removed = [x for x in old if x not in new]
+    changed = [x for x in new if x in old and old[x] != new[x]]
+    return added, removed, changed
+
+
+class SyncManifest:
+    """
+    The record of what a --sync run added, removed or re-fetched, written as JSON next to the tables
+    """
+
+    def __init__(self):
+        self.data = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'entries': dict(), 'genes': dict()}
+
+    def add_entries(self, kind, added, removed, changed):
+        self.data['entries'][kind] = {'added': list(added), 'removed': list(removed), 'changed': list(changed)}
+
+    def add_genes(self, group, added, removed, changed):
+        if added or removed or changed:
+            self.data['genes'][group] = {'added': list(added), 'removed': list(removed), 'changed': list(changed)}
+
+    def summary(self):
+        counts = [sum(len(x[key]) for x in self.data['genes'].values()) for key in ['added', 'removed', 'changed']]
+        entries = '; '.join(f"{kind}: {len(x['added'])} added, {len(x['removed'])} removed, {len(x['changed'])} changed" for kind, x in self.data['entries'].items())
+        return f"{entries}; genes: {counts[0]} added, {counts[1]} removed, {counts[2]} changed in {len(self.data['genes'])} groups"
+
+    def write(self, outdir):
+        path = os.path.join(outdir, f"sync_manifest_{time.strftime('%Y%m%d-%H%M%S')}.json")
+        with open(path, 'w') as out_handle:
+            json.dump(self.data, out_handle, indent=1)
+        return path
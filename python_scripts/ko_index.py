@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+import sys
+import argparse
+import json
+import mmap
+import struct
+import numpy as np
+
+MAGIC = b'KOIDX003'
+ROOT = 'root'
+
+
+def read_edge_list(edge_file):
+    """
+    Read an edge list written by get_ko_hierarchy.py
+    :param edge_file: e.g. kegg_ko_edge_df.txt
+    :return: (parents, children, labels) where parents/children are node ids into labels
+    """
+    names = dict()
+    parents = []
+    children = []
+    with open(edge_file) as fid:
+        next(fid, '')
+        for line in fid:
+            parent, child = line.rstrip('\n').split('\t')
+            parents.append(names.setdefault(parent, len(names)))
+            children.append(names.setdefault(child, len(names)))
+    return parents, children, list(names)
+
+
+def _csr(keys, values, n):
+    order = np.argsort(keys, kind='stable')
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=n), out=offsets[1:])
+    return offsets, values[order].astype(np.int32)
+
+
+def build_index(parents, children, labels):
+    """
+    Compute the arrays of the KO hierarchy index
+    :param parents: the parent node id of every edge
+    :param children: the child node id of every edge
+    :param labels: the node names by node id; nodes without edges are dropped and the rest renumbered
+    :return: a dict of array name -> numpy array
+    """
+    parents = np.asarray(parents, dtype=np.int64)
+    children = np.asarray(children, dtype=np.int64)
+    used, inverse = np.unique(np.concatenate([parents, children]), return_inverse=True)
+    parents, children = inverse[:len(parents)], inverse[len(parents):]
+    labels = [labels[x] for x in used]
+    n = len(labels)
+    if ROOT not in labels:
+        raise Exception(f"The hierarchy has no '{ROOT}' node")
+
+    encoded = [x.encode() for x in labels]
+    label_offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in encoded], out=label_offsets[1:])
+    name_order = np.array(sorted(range(n), key=lambda x: encoded[x]), dtype=np.int32)
+
+    child_offsets, child_ids = _csr(parents, children, n)
+    parent_offsets, parent_ids = _csr(children, parents, n)
+    # the edge of every parent entry; within a parent, the edge ids are in the order of its children
+    parent_edges = np.argsort(children, kind='stable').astype(np.int32)
+
+    # the length of the longest root path of every node, in topological order (-1: not below the root)
+    root = labels.index(ROOT)
+    depth = [-1] * n
+    depth[root] = 0
+    n_parents = np.diff(parent_offsets).tolist()
+    child_offsets_list, child_ids_list = child_offsets.tolist(), child_ids.tolist()
+    ready = [x for x in range(n) if n_parents[x] == 0]
+    topological = []
+    while ready:
+        node = ready.pop()
+        topological.append(node)
+        for child in child_ids_list[child_offsets_list[node]:child_offsets_list[node + 1]]:
+            if depth[node] >= 0:
+                depth[child] = max(depth[child], depth[node] + 1)
+            n_parents[child] -= 1
+            if n_parents[child] == 0:
+                ready.append(child)
+    if len(topological) < n:
+        raise Exception("The hierarchy has a cycle")
+
+    # the reachability labels: the sorted ids of all ancestors of every node, built from those of its parents in
+    # topological order; their total size is that of the transitive closure, not the number of root paths
+    parent_offsets_list, parent_ids_list = parent_offsets.tolist(), parent_ids.tolist()
+    closure = [None] * n
+    empty = np.zeros(0, dtype=np.int32)
+    for node in topological:
+        node_parents = parent_ids_list[parent_offsets_list[node]:parent_offsets_list[node + 1]]
+        if not node_parents:
+            closure[node] = empty
+        elif len(node_parents) == 1:
+            closure[node] = np.union1d(closure[node_parents[0]], node_parents).astype(np.int32)
+        else:
+            closure[node] = np.unique(np.concatenate([closure[x] for x in node_parents] + [np.array(node_parents, dtype=np.int32)])).astype(np.int32)
+    ancestor_offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in closure], out=ancestor_offsets[1:])
+    ancestor_ids = np.concatenate(closure) if n else empty
+
+    # the pre-order rank of every node in a walk of the DAG from the root that visits each node once, which breaks
+    # ties between lowest common ancestors of the same depth
+    rank = np.full(n, n, dtype=np.int32)
+    stack = [root]
+    visited = 0
+    while stack:
+        node = stack.pop()
+        if rank[node] < n:
+            continue
+        rank[node] = visited
+        visited += 1
+        stack.extend(reversed(child_ids_list[child_offsets_list[node]:child_offsets_list[node + 1]]))
+
+    return {
+        'label_offsets': label_offsets, 'label_blob': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+        'name_order': name_order,
+        'child_offsets': child_offsets, 'child_ids': child_ids,
+        'parent_offsets': parent_offsets, 'parent_ids': parent_ids, 'parent_edges': parent_edges,
+        'ancestor_offsets': ancestor_offsets, 'ancestor_ids': ancestor_ids,
+        'depth': np.array(depth, dtype=np.int32), 'rank': rank,
+    }
+
+
+def write_arrays(path, arrays, magic=MAGIC):
+    """
+    Write named numpy arrays to a file that read_arrays can memory-map
+    :param path: the output file
+    :param arrays: a dict of array name -> 1-d numpy array
+    :param magic: the 8 bytes that identify the file type
+    :return: None
+    """
+    toc = dict()
+    offset = 0
+    for name, values in arrays.items():
+        toc[name] = [values.dtype.str, offset, len(values)]
+        # keep every array 8-byte aligned in the file
+        offset += -(-values.nbytes // 8) * 8
+    header = json.dumps(toc).encode()
+    header += b' ' * (-(len(magic) + 8 + len(header)) % 8)
+    start = len(magic) + 8 + len(header)
+    with open(path, 'wb') as out_handle:
+        out_handle.write(magic + struct.pack('<Q', len(header)) + header)
+        for name, values in arrays.items():
+            out_handle.seek(start + toc[name][1])
+            out_handle.write(values.tobytes())
+        out_handle.truncate(start + offset)
+
+
+def read_arrays(mm, path, magic=MAGIC, description='KO hierarchy index'):
+    """
+    :param mm: the memory map of a file written by write_arrays
+    :param path: the file name, for the error message
+    :param magic: the expected file type
+    :param description: the file type, for the error message
+    :return: a dict of array name -> numpy array backed by the memory map
+    """
+    if mm[:len(magic)] != magic:
+        raise Exception(f"{path} is not a {description}")
+    header_size = struct.unpack('<Q', mm[len(magic):len(magic) + 8])[0]
+    start = len(magic) + 8 + header_size
+    toc = json.loads(mm[len(magic) + 8:start].decode())
+    return {name: np.frombuffer(mm, dtype=dtype, count=count, offset=start + offset) for name, (dtype, offset, count) in toc.items()}
+
+
+def write_index(path, parents, children, labels):
+    """
+    Write the KO hierarchy index file loaded by KOHierarchyIndex
+    :param path: the output file, e.g. kegg_ko_index.bin
+    :param parents: the parent node id of every edge
+    :param children: the child node id of every edge
+    :param labels: the node names by node id
+    :return: None
+    """
+    write_arrays(path, build_index(parents, children, labels))
+
+
+class KOHierarchyIndex:
+    """
+    Read-only queries on a KO hierarchy index written by write_index, memory-mapped instead of loaded.
+
+    Nodes are addressed by name (e.g. 'K00844', 'ko00001' or '09100 Metabolism'). The index holds the DAG itself, as
+    CSR arrays of children and parents, so a node shared by several BRITE hierarchies is stored once, and as reachability
+    labels: the sorted ancestor ids of every node. is_ancestor is a binary search in these labels, O(log n), and lca
+    intersects the labels of the nodes with numpy, linear in their number of ancestors (a few dozen for a KO).
+    descendants and root_paths walk the DAG on demand, in the size of their result. Name lookup is a binary search.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fid = open(path, 'rb')
+        self._mm = mmap.mmap(self._fid.fileno(), 0, access=mmap.ACCESS_READ)
+        for name, values in read_arrays(self._mm, path).items():
+            setattr(self, name, values)
+        self.n_nodes = len(self.name_order)
+
+    def close(self):
+        for name in list(vars(self)):
+            if isinstance(getattr(self, name), np.ndarray):
+                delattr(self, name)
+        self._mm.close()
+        self._fid.close()
+
+    def name(self, node):
+        return bytes(self.label_blob[self.label_offsets[node]:self.label_offsets[node + 1]]).decode()
+
+    def node_id(self, name):
+        """
+        :param name: a node name
+        :return: the node id, or None when the name is not in the hierarchy
+        """
+        target = name.encode()
+        low, high = 0, self.n_nodes
+        while low < high:
+            middle = (low + high) // 2
+            node = self.name_order[middle]
+            if bytes(self.label_blob[self.label_offsets[node]:self.label_offsets[node + 1]]) < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.n_nodes and self.name(self.name_order[low]) == name:
+            return int(self.name_order[low])
+        return None
+
+    def _id(self, name):
+        node = self.node_id(name)
+        if node is None:
+            raise KeyError(name)
+        return node
+
+    def __contains__(self, name):
+        return self.node_id(name) is not None
+
+    def _children(self, node):
+        return self.child_ids[self.child_offsets[node]:self.child_offsets[node + 1]]
+
+    def _parents(self, node):
+        return self.parent_ids[self.parent_offsets[node]:self.parent_offsets[node + 1]]
+
+    def children(self, name):
+        return [self.name(x) for x in self._children(self._id(name))]
+
+    def parents(self, name):
+        return [self.name(x) for x in self._parents(self._id(name))]
+
+    def _ancestor_ids(self, node):
+        # sorted, see build_index
+        return self.ancestor_ids[self.ancestor_offsets[node]:self.ancestor_offsets[node + 1]]
+
+    def ancestors(self, name):
+        """
+        :return: the set of names of all nodes above the node (including 'root')
+        """
+        return {self.name(x) for x in self._ancestor_ids(self._id(name))}
+
+    def descendants(self, name):
+        """
+        :return: the set of names of all nodes below the node
+        """
+        result = set()
+        stack = [self._id(name)]
+        while stack:
+            for child in self._children(stack.pop()).tolist():
+                if child not in result:
+                    result.add(child)
+                    stack.append(child)
+        return {self.name(x) for x in result}
+
+    def root_paths(self, name):
+        """
+        Walk up from the node to the root along every parent
+        :return: a list of paths, one per root path of the node; each is a list of names from the BRITE root down to the node
+        """
+        root = self.node_id(ROOT)
+        paths = []
+        # (node, the nodes below it, the edges below it); the edge ids from the root down sort the paths in pre-order
+        stack = [(self._id(name), [], [])]
+        while stack:
+            node, path, edges = stack.pop()
+            if node == root:
+                paths.append((edges[::-1], [self.name(x) for x in path[::-1]]))
+                continue
+            start = self.parent_offsets[node]
+            for parent, edge in zip(self._parents(node).tolist(), self.parent_edges[start:self.parent_offsets[node + 1]].tolist()):
+                stack.append((parent, path + [node], edges + [edge]))
+        return [path for _, path in sorted(paths)]
+
+    def is_ancestor(self, ancestor, name):
+        """
+        :return: True if ancestor is above name on at least one root path
+        """
+        node = self._id(ancestor)
+        ancestors = self._ancestor_ids(self._id(name))
+        position = np.searchsorted(ancestors, node)
+        return bool(position < len(ancestors) and ancestors[position] == node)
+
+    def lca(self, names):
+        """
+        Find the lowest common ancestor of one or more nodes
+        :param names: a list of node names
+        :return: the name of the deepest node that is an ancestor (or the node itself) of every given node, where the
+                 depth of a node is the length of its longest root path; 'root' when they share no BRITE hierarchy
+        """
+        candidates = None
+        for name in names:
+            node = self._id(name)
+            common = np.union1d(self._ancestor_ids(node), [node])
+            candidates = common if candidates is None else np.intersect1d(candidates, common, assume_unique=True)
+        candidates = candidates[self.depth[candidates] >= 0]
+        # the deepest candidate, the first in pre-order among equally deep ones
+        best = np.lexsort((self.rank[candidates], -self.depth[candidates]))[0]
+        return self.name(candidates[best])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--edge_file", type=str, help="Build the index from an edge list written by get_ko_hierarchy.py", default=None)
+    parser.add_argument("--index", type=str, help="The index file to write (with --edge_file) or query", required=True)
+    parser.add_argument("--query", type=str, nargs='*', help="Print the root paths of these nodes and their lowest common ancestor", default=None)
+    args = parser.parse_args()
+
+    if args.edge_file is not None:
+        write_index(args.index, *read_edge_list(args.edge_file))
+    if args.query:
+        index = KOHierarchyIndex(args.index)
+        for name in args.query:
+            if name not in index:
+                print(f"Error: {name} is not in the index", flush=True)
+                sys.exit(1)
+            for path in index.root_paths(name):
+                print('\t'.join(path))
+        print(f"LCA\t{index.lca(args.query)}")
+        index.close()
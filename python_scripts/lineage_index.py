@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+import os
+import csv
+import json
+import logging
+import numpy as np
+if __package__:
+    from .ko_index import write_arrays, read_arrays
+    from .kegg_cli import lazy_import
+else:
+    from ko_index import write_arrays, read_arrays
+    from kegg_cli import lazy_import
+pd = lazy_import('pandas')
+
+MAGIC = b'KGLIN001'
+# the levels of a KEGG lineage, e.g. Prokaryotes;Bacteria;Firmicutes - Bacilli;Bacillus
+LINEAGE_RANKS = ['domain', 'kingdom', 'group', 'subgroup']
+
+
+def lineage_index_path(table_file):
+    """
+    :param table_file: e.g. outdir/organism_table.txt
+    :return: the path of its cached lineage index, e.g. outdir/organism_table.lineage.idx
+    """
+    return os.path.splitext(table_file)[0] + '.lineage.idx'
+
+
+def _signature(path):
+    if path is None or not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def lineage_terms(lineage):
+    """
+    :param lineage: a KEGG lineage, e.g. 'Prokaryotes;Bacteria;Firmicutes - Bacilli;Bacillus'
+    :return: the terms that select it: every level ('firmicutes - bacilli'), the parts of a level ('firmicutes',
+             'bacilli') and every level with its rank ('group=firmicutes - bacilli'), in lower case
+    """
+    terms = set()
+    for rank, level in zip(LINEAGE_RANKS, str(lineage).lower().split(';')):
+        level = level.strip()
+        if not level:
+            continue
+        terms.update([level, f"{rank}={level}"])
+        terms.update(x.strip() for x in level.split(' - '))
+    return terms
+
+
+def read_taxdump(taxdump_dir, taxids):
+    """
+    Look up the ancestors of taxids in NCBI's taxonomy
+    :param taxdump_dir: the folder of the extracted taxdump.tar.gz, with nodes.dmp and names.dmp
+    :param taxids: the taxids to look up
+    :return: a dict of taxid -> list of (taxid, rank, scientific name) from the taxid up to the root
+    """
+    # the fields are separated by '\t|\t', so with '\t' as separator they are every second column
+    nodes = pd.read_csv(os.path.join(taxdump_dir, 'nodes.dmp'), sep='\t', header=None, usecols=[0, 2, 4], names=['taxid', 'parent', 'rank'],
+                        dtype={'taxid': np.int64, 'parent': np.int64, 'rank': str}, quoting=csv.QUOTE_NONE)
+    parent = np.zeros(nodes['taxid'].max() + 1, dtype=np.int64)
+    parent[nodes['taxid'].values] = nodes['parent'].values
+    rank_codes, ranks = pd.factorize(nodes['rank'])
+    rank = np.full(len(parent), -1, dtype=np.int64)
+    rank[nodes['taxid'].values] = rank_codes
+    paths = dict()
+    for taxid in taxids:
+        path = []
+        node = taxid
+        while 0 < node < len(parent) and rank[node] >= 0:
+            path.append(node)
+            if parent[node] == node:
+                break
+            node = parent[node]
+        paths[taxid] = path
+    needed = {x for path in paths.values() for x in path}
+    names = pd.read_csv(os.path.join(taxdump_dir, 'names.dmp'), sep='\t', header=None, usecols=[0, 2, 6], names=['taxid', 'name', 'name_class'],
+                        dtype={'taxid': np.int64, 'name': str, 'name_class': str}, quoting=csv.QUOTE_NONE)
+    names = names.loc[(names['name_class'] == 'scientific name') & names['taxid'].isin(needed), :]
+    names = dict(zip(names['taxid'], names['name']))
+    return {taxid: [(x, ranks[rank[x]], names.get(x, '')) for x in path] for taxid, path in paths.items()}
+
+
+def _groups(codes, n):
+    # the rows of each of the n codes of pd.factorize, with one sort instead of a scan per code
+    order = np.argsort(codes, kind='stable')
+    counts = np.bincount(codes[codes >= 0], minlength=n)
+    return np.split(order[len(codes) - counts.sum():], np.cumsum(counts)[:-1])
+
+
+def _taxid(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class LineageIndex:
+    """
+    An inverted index from lineage terms to the organisms of an organism table.
+
+    The terms of an organism are those of its KEGG lineage (see lineage_terms), 'taxid=<taxid>' and, with NCBI's
+    taxdump, 'taxid=<ancestor>' for every ancestor (its subtree) and the name of every ancestor, alone and as
+    '<rank>=<name>' (e.g. 'phylum=bacillota'). The terms are sorted for a binary search and point to postings lists of
+    organisms, so a selection is a few lookups and set operations on arrays, whatever the number of organisms.
+    """
+
+    def __init__(self, arrays):
+        for name, values in arrays.items():
+            setattr(self, name, values)
+
+    @classmethod
+    def build(cls, table, source=None, taxdump=None):
+        """
+        :param table: an organism table with the org_code, lineage and taxaid columns
+        :param source: the table file, whose size and mtime are kept to tell when the index is out of date
+        :param taxdump: the folder of NCBI's taxdump, for the taxid subtrees and NCBI ranks
+        :return: a LineageIndex
+        """
+        org_codes = table['org_code'].astype(str).values
+        term_ids = dict()
+        pairs = []
+        # the distinct lineages and taxids are expanded once, then mapped to their rows
+        lineage_codes, lineages = pd.factorize(table['lineage'].fillna(''))
+        for lineage, rows in zip(lineages, _groups(lineage_codes, len(lineages))):
+            for term in lineage_terms(lineage):
+                pairs.append((term_ids.setdefault(term, len(term_ids)), rows))
+        taxids = [_taxid(x) for x in table['taxaid']]
+        taxid_codes, distinct_taxids = pd.factorize(pd.Series([x if x is not None else -1 for x in taxids]))
+        paths = read_taxdump(taxdump, [x for x in distinct_taxids if x > 0]) if taxdump is not None else dict()
+        for taxid, rows in zip(distinct_taxids, _groups(taxid_codes, len(distinct_taxids))):
+            if taxid <= 0:
+                continue
+            terms = {f"taxid={taxid}"}
+            for ancestor, rank, name in paths.get(taxid, []):
+                terms.add(f"taxid={ancestor}")
+                if name:
+                    terms.add(name.lower())
+                    if rank != 'no rank':
+                        terms.add(f"{rank}={name.lower()}")
+            for term in terms:
+                pairs.append((term_ids.setdefault(term, len(term_ids)), rows))
+
+        terms = np.array([x.encode() for x in term_ids], dtype='S') if term_ids else np.array([], dtype='S1')
+        keys = np.repeat(np.array([term for term, _ in pairs], dtype=np.int64), [len(rows) for _, rows in pairs])
+        values = np.concatenate([rows for _, rows in pairs]) if pairs else np.array([], dtype=np.int64)
+        # sorted by term, then by organism, and without the duplicates of terms found twice (e.g. 'bacteria')
+        rank_of = np.empty(len(terms), dtype=np.int64)
+        order = np.argsort(terms, kind='stable')
+        rank_of[order] = np.arange(len(terms))
+        pairs = np.unique(rank_of[keys] * len(org_codes) + values)
+        posting_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pairs // max(len(org_codes), 1), minlength=len(terms)), out=posting_offsets[1:])
+        source_info = json.dumps({'table': _signature(source), 'taxdump': _taxdump_signature(taxdump)})
+        return cls({
+            'source': np.array([source_info.encode()], dtype='S'),
+            'org_codes': np.array([x.encode() for x in org_codes], dtype='S') if len(org_codes) else np.array([], dtype='S1'),
+            'terms': terms[order],
+            'posting_offsets': posting_offsets,
+            'postings': (pairs % max(len(org_codes), 1)).astype(np.int32),
+        })
+
+    @classmethod
+    def load(cls, path, source=None, taxdump=None):
+        """
+        :param path: the index file, see lineage_index_path
+        :param source: the table file it was built from
+        :param taxdump: the taxdump folder it was built with
+        :return: the LineageIndex, or None when there is none or the table or taxdump changed since it was built
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as fid:
+            try:
+                arrays = read_arrays(fid.read(), path, magic=MAGIC, description='lineage index')
+            except Exception:
+                return None
+        if json.loads(arrays['source'][0].decode()) != {'table': _signature(source), 'taxdump': _taxdump_signature(taxdump)}:
+            return None
+        return cls(arrays)
+
+    def write(self, path):
+        """
+        :param path: the index file, see lineage_index_path
+        :return: None
+        """
+        # written next to the target and renamed, so that a concurrent reader never loads a partial index; the pipeline's
+        # extractor and download may both build it at the same time
+        tmp_file = f"{path}.{os.getpid()}.tmp"
+        write_arrays(tmp_file, {x: getattr(self, x) for x in ['source', 'org_codes', 'terms', 'posting_offsets', 'postings']}, magic=MAGIC)
+        os.replace(tmp_file, path)
+
+    def lookup(self, term):
+        """
+        :param term: a KEGG lineage level or part (e.g. 'Bacilli'), '<rank>=<name>' (e.g. 'kingdom=Bacteria') or a
+                     taxid (e.g. '1239' or 'taxid=1239'), case-insensitive
+        :return: the rows of the organisms it selects, or None when it selects none
+        """
+        term = term.strip().lower()
+        if term.isdigit():
+            term = f"taxid={term}"
+        key = term.encode()
+        if len(key) > self.terms.dtype.itemsize:
+            return None
+        position = int(np.searchsorted(self.terms, key))
+        if position == len(self.terms) or self.terms[position] != key:
+            return None
+        return self.postings[self.posting_offsets[position]:self.posting_offsets[position + 1]]
+
+    def select(self, include=None, exclude=None, logger=None):
+        """
+        :param include: the terms of the organisms to select (see lookup); all organisms when None
+        :param exclude: the terms of the organisms to leave out, e.g. include=['Firmicutes'], exclude=['Bacilli']
+        :param logger: reports the terms that match no organism; this module's logger by default
+        :return: the set of selected org codes
+        """
+        logger = logger if logger is not None else logging.getLogger(__name__)
+
+        def rows(terms):
+            found = []
+            for term in terms:
+                postings = self.lookup(term)
+                if postings is None:
+                    logger.warning(f"No organism matches {term}")
+                    continue
+                found.append(postings)
+            return np.unique(np.concatenate(found)) if found else np.array([], dtype=np.int32)
+
+        selected = np.arange(len(self.org_codes)) if include is None else rows(include)
+        if exclude:
+            selected = np.setdiff1d(selected, rows(exclude), assume_unique=True)
+        return {x.decode() for x in self.org_codes[selected]}
+
+
+def _taxdump_signature(taxdump):
+    if taxdump is None:
+        return None
+    return [_signature(os.path.join(taxdump, x)) for x in ['nodes.dmp', 'names.dmp']]
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import time
+import atexit
+import cProfile
+import pstats
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from urllib.parse import urlparse
+if __package__:
+    from .rate_limit import host_of
+else:
+    from rate_limit import host_of
+
+# the upper bounds of the request latency buckets in seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# the prefix of the metric names in the Prometheus textfile
+PREFIX = 'kegg_'
+
+
+def endpoint_of(url):
+    """
+    :param url: a request URL
+    :return: the host and the operation, e.g. rest.kegg.jp/get, www.genome.jp/show_organism or eutils.ncbi.nlm.nih.gov/efetch.fcgi
+    """
+    host = host_of(url)
+    path = urlparse(url).path.strip('/')
+    # KEGG REST names the operation first (/get/<ids>), the other services last
+    operation = path.split('/')[0] if host == 'rest.kegg.jp' else path.rsplit('/', 1)[-1]
+    return f"{host}/{operation}"
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # the last count is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        :param q: e.g. 0.95
+        :return: the upper bound of the bucket that holds the q-quantile (inf when it is beyond the last bucket)
+        """
+        seen = 0
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            seen += n
+            if seen >= q * self.count:
+                return bound
+        return 0.0
+
+
+def _format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class Metrics:
+    """
+    Thread-safe counters, latency histograms and stage timings of one script run.
+
+    Names and labels follow the Prometheus conventions, so ``write`` exports them either as JSON or as a Prometheus
+    textfile (e.g. for the node_exporter textfile collector). ``stage`` times a block of code and, once ``profile_dir``
+    is set, also runs it under cProfile; one profile is kept per stage name, accumulated over all its blocks.
+    """
+
+    def __init__(self, script=None):
+        self.script = script if script is not None else os.path.splitext(os.path.basename(sys.argv[0]))[0]
+        self.start = time.time()
+        # (name, sorted label items) -> value
+        self.counters = dict()
+        self.histograms = dict()
+        self.profile_dir = None
+        self._profilers = dict()
+        self._profiling = False
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def record_request(self, url, status, elapsed, n_bytes=0):
+        """
+        Count one HTTP request that went to the network
+        :param url: the request URL
+        :param status: the HTTP status code, or None when the request raised a connection error
+        :param elapsed: the latency in seconds
+        :param n_bytes: the size of the response body
+        :return: None
+        """
+        endpoint = endpoint_of(url)
+        self.observe('http_request_duration_seconds', elapsed, endpoint=endpoint)
+        self.inc('http_requests_total', endpoint=endpoint, status=str(status) if status is not None else 'error')
+        if n_bytes:
+            self.inc('http_response_bytes_total', n_bytes, endpoint=endpoint)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a block of code as part of a stage, e.g. ``with METRICS.stage('parse'):``
+        :param name: the stage name
+        """
+        profiler = None
+        # cProfile only sees the thread it is enabled in, and profiles do not nest
+        if self.profile_dir is not None and not self._profiling and threading.current_thread() is threading.main_thread():
+            profiler = self._profilers.setdefault(name, cProfile.Profile())
+            self._profiling = True
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                self._profiling = False
+            self.inc('stage_seconds_total', elapsed, stage=name)
+            self.inc('stage_calls_total', stage=name)
+
+    def _values(self, name):
+        with self._lock:
+            return {dict(labels).get('endpoint', dict(labels).get('stage')): value for (x, labels), value in self.counters.items() if x == name}
+
+    def summary(self):
+        lines = []
+        with self._lock:
+            requests = dict()
+            for (name, labels), value in self.counters.items():
+                if name == 'http_requests_total':
+                    labels = dict(labels)
+                    total, failed = requests.get(labels['endpoint'], (0, 0))
+                    requests[labels['endpoint']] = (total + value, failed + (value if labels['status'] != '200' else 0))
+            latencies = {dict(labels)['endpoint']: histogram for (name, labels), histogram in self.histograms.items() if name == 'http_request_duration_seconds'}
+        retries, n_bytes, hits = self._values('http_retries_total'), self._values('http_response_bytes_total'), self._values('http_cache_hits_total')
+        for endpoint in sorted(set(requests) | set(hits)):
+            total, failed = requests.get(endpoint, (0, 0))
+            text = f"{endpoint}: {total} requests ({failed} failed, {retries.get(endpoint, 0)} retried, {n_bytes.get(endpoint, 0) / 1e6:.1f} MB, {hits.get(endpoint, 0)} from the cache)"
+            if endpoint in latencies:
+                text += f", latency p50 <= {latencies[endpoint].quantile(0.5)}s, p95 <= {latencies[endpoint].quantile(0.95)}s"
+            lines.append(text)
+        seconds, calls, records = self._values('stage_seconds_total'), self._values('stage_calls_total'), self._values('records_total')
+        for stage in sorted(seconds):
+            text = f"stage {stage}: {seconds[stage]:.2f}s in {calls[stage]} calls"
+            if stage in records:
+                text += f", {records[stage]} records ({records[stage] / seconds[stage] if seconds[stage] > 0 else 0.0:.1f}/s)"
+            lines.append(text)
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        with self._lock:
+            return {'script': self.script, 'start': self.start, 'elapsed': time.time() - self.start,
+                    'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.counters.items())],
+                    'histograms': [{'name': name, 'labels': dict(labels), 'buckets': list(histogram.buckets), 'counts': histogram.counts,
+                                    'sum': histogram.sum, 'count': histogram.count} for (name, labels), histogram in sorted(self.histograms.items(), key=lambda x: x[0])]}
+
+    def to_prometheus(self):
+        lines = []
+        script = [('script', self.script)]
+        with self._lock:
+            for name in sorted({x for x, _ in self.counters}):
+                lines.append(f"# TYPE {PREFIX}{name} counter")
+                for (x, labels), value in sorted(self.counters.items()):
+                    if x == name:
+                        lines.append(f"{PREFIX}{name}{_format_labels(script + list(labels))} {value}")
+            for name in sorted({x for x, _ in self.histograms}):
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                for (x, labels), histogram in sorted(self.histograms.items(), key=lambda x: x[0]):
+                    if x != name:
+                        continue
+                    labels = script + list(labels)
+                    seen = 0
+                    for bound, n in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                        seen += n
+                        lines.append(f"{PREFIX}{name}_bucket{_format_labels(labels, [('le', bound)])} {seen}")
+                    lines.append(f"{PREFIX}{name}_sum{_format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{PREFIX}{name}_count{_format_labels(labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Export the metrics
+        :param path: a .prom file is written in the Prometheus textfile format, any other as JSON
+        :return: None
+        """
+        text = self.to_prometheus() if path.endswith('.prom') else json.dumps(self.to_dict(), indent=1)
+        # written next to the target and renamed, so that a collector never reads a partial file
+        with open(path + '.tmp', 'w') as out_handle:
+            out_handle.write(text)
+        os.replace(path + '.tmp', path)
+
+    def write_profiles(self):
+        """
+        Write the profile of every stage as <profile_dir>/<script>_<stage>.pstats and the top functions by cumulative time as .txt
+        :return: the list of .pstats files
+        """
+        if self.profile_dir is None:
+            return []
+        if not os.path.exists(self.profile_dir):
+            os.makedirs(self.profile_dir)
+        files = []
+        for name, profiler in self._profilers.items():
+            path = os.path.join(self.profile_dir, f"{self.script}_{name}")
+            profiler.dump_stats(path + '.pstats')
+            with open(path + '.txt', 'w') as out_handle:
+                pstats.Stats(profiler, stream=out_handle).sort_stats('cumulative').print_stats(40)
+            files.append(path + '.pstats')
+        return files
+
+
+# the metrics of this process, shared by all modules
+METRICS = Metrics()
+
+
+class Progress:
+    """
+    Report the progress of a loop at most every ``interval`` seconds, instead of a line (or a progress bar redraw) per item
+    """
+
+    # set for all reports by --progress_every
+    interval = 30
+
+    def __init__(self, total=None, desc='progress', logger=None):
+        self.total = total
+        self.desc = desc
+        self.logger = logger
+        self.done = 0
+        self.start = time.monotonic()
+        self._last_report = self.start
+        self._reported = None
+
+    def update(self, n=1):
+        self.done += n
+        now = time.monotonic()
+        if now - self._last_report >= self.interval:
+            self._report(now)
+
+    def _report(self, now):
+        self._last_report = now
+        self._reported = self.done
+        rate = self.done / (now - self.start) if now > self.start else 0.0
+        text = f"{self.desc}: {self.done}"
+        if self.total:
+            text += f"/{self.total} ({self.done / self.total:.1%})"
+        text += f", {rate:.1f}/s"
+        if self.total and rate > 0 and self.done < self.total:
+            text += f", {(self.total - self.done) / rate:.0f}s left"
+        if self.logger is not None:
+            self.logger.info(text)
+        else:
+            print(text, flush=True)
+
+    def close(self):
+        if self._reported != self.done:
+            self._report(time.monotonic())
+
+
+def progress(iterable, total=None, desc='progress', logger=None):
+    """
+    Iterate and report the progress with Progress, e.g. ``for x in progress(items, len(items), 'organisms', logger):``
+    """
+    report = Progress(total, desc, logger)
+    try:
+        for item in iterable:
+            yield item
+            report.update()
+    finally:
+        report.close()
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument("--metrics", type=str, help="Write the request latencies, counters and stage timings to this file at exit: as JSON, or in the Prometheus textfile format for a .prom file", default=None)
+    parser.add_argument("--profile", action='store_true', help="Profile the parse and write stages with cProfile and write <script>_<stage>.pstats/.txt to the profile folder of the output")
+    parser.add_argument("--progress_every", type=float, help="Log a progress summary every this many seconds", default=30)
+
+
+def configure_metrics(args, profile_dir, script=None):
+    """
+    Apply the add_metrics_arguments options to this process, without writing anything at exit; a worker process calls it
+    itself, since a spawned worker does not inherit the settings of its parent
+    :param args: the parsed command line arguments
+    :param profile_dir: the folder the profiles are written to with --profile
+    :param script: the name of the metrics and profile files (default: the script that was run)
+    :return: METRICS
+    """
+    Progress.interval = args.progress_every
+    if args.profile:
+        METRICS.profile_dir = profile_dir
+    if script is not None:
+        METRICS.script = script
+    return METRICS
+
+
+def metrics_from_args(args, profile_dir, logger=None):
+    """
+    Set up the add_metrics_arguments options; the metrics and profiles are written when the script exits
+    :param args: the parsed command line arguments
+    :param profile_dir: the folder the profiles are written to with --profile
+    :param logger: the metrics summary is logged at exit (printed without a logger)
+    :return: METRICS
+    """
+    configure_metrics(args, profile_dir)
+
+    def _finish():
+        summary = METRICS.summary()
+        if summary:
+            if logger is not None:
+                logger.info(summary)
+            else:
+                print(summary, flush=True)
+        if args.metrics is not None:
+            METRICS.write(args.metrics)
+        for path in METRICS.write_profiles():
+            print(f"The profile is written to {path}", flush=True)
+
+    atexit.register(_finish)
+    return METRICS
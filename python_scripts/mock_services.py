@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+import os
+import sys
+import argparse
+import json
+import random
+import sqlite3
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+if __package__:
+    from .kegg_flatfile import render_record
+    from .get_ko_hierarchy import render_fixture_hierarchy
+else:
+    from kegg_flatfile import render_record
+    from get_ko_hierarchy import render_fixture_hierarchy
+
+SERVICES = ['kegg', 'genome', 'ncbi']
+# the host of each service, used to replay responses recorded in an http_cache.ResponseCache
+SERVICE_HOSTS = {'rest.kegg.jp': 'kegg', 'www.genome.jp': 'genome', 'eutils.ncbi.nlm.nih.gov': 'ncbi'}
+# the environment variables of kegg_client that point the scripts at a service
+SERVICE_LINKS = {'kegg': ('KEGG_API_LINK', ''), 'genome': ('KEGG_GENOME_LINK', ''), 'ncbi': ('NCBI_EUTILS_LINK', '/entrez/eutils')}
+# the status each service answers when a client goes over its rate limit
+THROTTLE_STATUS = {'kegg': 403, 'genome': 403, 'ncbi': 429}
+LINEAGE = 'Prokaryotes;Bacteria;Betaproteobacteria;Acidovorax'
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_data', 'output')
+EDGE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test', 'test_data', 'kegg_ko_edge_df_br:ko00001.txt')
+
+
+def _wrap(seq, width):
+    return '\n'.join(seq[i:i + width] for i in range(0, len(seq), width))
+
+
+def _org_code(i):
+    # aaa is the organism of the fixture, its copies are zaab, zaac, ...
+    if i == 0:
+        return 'aaa'
+    return 'z' + ''.join(chr(ord('a') + i // 26 ** k % 26) for k in (2, 1, 0))
+
+
+def _fixture_genes(fasta_dir):
+    sequences = [dict(), dict()]
+    for i, name in enumerate(['kegg_genes_KO.faa', 'kegg_genes_No_KO.faa', 'kegg_genes_KO.fna', 'kegg_genes_No_KO.fna']):
+        header = None
+        with open(os.path.join(fasta_dir, name)) as fid:
+            for line in fid:
+                if line.startswith('>'):
+                    header = line[1:].rstrip('\n')
+                elif header is not None:
+                    sequences[i // 2][header] = line.strip()
+    aa, nt = sequences
+    genes = []
+    for header in dict.fromkeys(list(aa) + list(nt)):
+        kegg_gene_id, desc, koid = header.split('|')
+        genes.append((kegg_gene_id, desc, koid, aa.get(header, ''), nt.get(header, '')))
+    return genes
+
+
+class Fixtures:
+    """
+    The responses served by MockServices.
+
+    ``paths`` maps a KEGG path (e.g. '/list/organism') to its body; ``genes`` holds the records that /get answers with,
+    for any combination of '+'-joined ids; ``pages`` the genome.jp show_organism page of each organism and ``genomes``
+    the (description, sequence) that efetch returns for each accession. ``recorded`` maps (service, path with query) to
+    a (status, body) replayed as is, before any of the others.
+    """
+
+    def __init__(self):
+        self.paths = dict()
+        self.genes = dict()
+        self.pages = dict()
+        self.genomes = dict()
+        self.recorded = dict()
+
+    def add_listing(self, path, rows):
+        self.paths[path] = ''.join('\t'.join(row) + '\n' for row in rows)
+
+
+def render_fixtures(fasta_dir=FIXTURE_DIR, edge_file=EDGE_FILE, n_organisms=1, n_viruses=10, virus_genes=200):
+    """
+    Render the responses of the three services from the test fixtures
+    :param fasta_dir: the FASTA files of test_data/output, whose genes (organism aaa) are served for every organism
+    :param edge_file: the edge list the br:ko00001 hierarchy is rendered from
+    :param n_organisms: the number of organisms; aaa and copies of it under other organism codes
+    :param n_viruses: the number of viruses in br:br08620
+    :param virus_genes: the number of genes (taken from the fixture) split between /list/vg and /list/vp
+    :return: Fixtures
+    """
+    fixtures = Fixtures()
+    genes = _fixture_genes(fasta_dir)
+    # one genome per organism, the fixture's coding sequences joined; all organisms share the string
+    genome = _wrap(''.join(x[4] for x in genes).upper(), 70)
+
+    organisms = []
+    for i in range(n_organisms):
+        org_code = _org_code(i)
+        organisms.append((f"T{i + 1:05d}", org_code, f"Acidovorax citrulli AAC00-1 ({org_code})", LINEAGE))
+        renamed = [(f"{org_code}:{kegg_gene_id.split(':', 1)[1]}", desc, koid, aaseq, ntseq) for kegg_gene_id, desc, koid, aaseq, ntseq in genes]
+        fixtures.add_listing(f"/list/{org_code}", [(x[0], x[1]) for x in renamed])
+        fixtures.add_listing(f"/link/ko/{org_code}", [(x[0], x[2]) for x in renamed if x[2]])
+        for kegg_gene_id, desc, koid, aaseq, ntseq in renamed:
+            fixtures.genes[kegg_gene_id] = (desc, koid, aaseq, ntseq, None)
+        genbank, refseq = f"CP{i + 1:06d}", f"NC_{i + 1:06d}"
+        fixtures.pages[org_code] = (f"<html><body><table>\n"
+                                    f"<tr><td>Taxonomy</td><td><a href=\"https://www.ncbi.nlm.nih.gov/Taxonomy/Browser/wwwtax.cgi?id=397945\">397945</a></td></tr>\n"
+                                    f"<tr><td>Chromosome</td><td><a href=\"https://www.ncbi.nlm.nih.gov/nuccore/{genbank}\">{genbank}</a> "
+                                    f"<a href=\"https://www.genome.jp/dbget-bin/www_bget?refseq:{refseq}\">{refseq}</a></td></tr>\n"
+                                    f"</table></body></html>\n")
+        for accession in (genbank, refseq):
+            fixtures.genomes[accession] = (f"{accession}.1 Acidovorax citrulli AAC00-1 ({org_code}), complete genome", genome)
+    fixtures.add_listing('/list/organism', organisms)
+
+    # viruses: the first virus_genes genes of the fixture as viral genes, half in vg and half in vp
+    lines = ['+D\tVirus', '!', 'A<b>Viruses</b>', 'B  Mock viruses']
+    virus_genome = genome[:30000]
+    viral = {'vg': [], 'vp': []}
+    for i, (_, desc, koid, aaseq, ntseq) in enumerate(genes[:virus_genes]):
+        taxaid = str(10001 + i % max(n_viruses, 1))
+        kegg_gene_id = f"vg:{1000001 + i}" if i % 2 == 0 else f"vp:YP_{9000001 + i}"
+        viral[kegg_gene_id.split(':')[0]].append((kegg_gene_id, desc, koid))
+        fixtures.genes[kegg_gene_id] = (desc, koid, aaseq, ntseq, taxaid)
+    for j in range(n_viruses):
+        refseq, genbank = f"NC_9{j + 1:05d}", f"AB9{j + 1:05d}"
+        lines.append(f"C    Mock virus {j + 1} [TAX:{10001 + j}] [RS:{refseq}] [GN:{genbank}]")
+        for accession in (refseq, genbank):
+            fixtures.genomes[accession] = (f"{accession}.1 Mock virus {j + 1}, complete genome", virus_genome)
+    fixtures.paths['/get/br:br08620'] = '\n'.join(lines + ['!']) + '\n'
+    for gene_set, rows in viral.items():
+        fixtures.add_listing(f"/list/{gene_set}", [(x[0], x[1]) for x in rows])
+        fixtures.add_listing(f"/link/ko/{gene_set}", [(x[0], x[2]) for x in rows if x[2]])
+
+    # BRITE: ko00001 and the hierarchies it refers to, which hold no KO ids
+    hierarchy_json, brite_list = render_fixture_hierarchy(edge_file)
+    brite_list = [('br:ko00001', 'KEGG Orthology (KO)')] + [x for x in brite_list if x[0] != 'br:ko00001']
+    fixtures.add_listing('/list/brite', brite_list)
+    fixtures.paths['/get/br:ko00001/json'] = json.dumps(hierarchy_json)
+    for brite_id, name in brite_list[1:]:
+        fixtures.paths[f"/get/{brite_id}/json"] = json.dumps({'name': brite_id[3:], 'children': [{'name': name}]})
+    return fixtures
+
+
+def load_recorded(fixtures, cache_file):
+    """
+    Add the responses of an http_cache.ResponseCache file (e.g. <outdir>/http_cache.sqlite of a real run) to fixtures
+    :param fixtures: Fixtures
+    :param cache_file: the SQLite cache file
+    :return: the number of responses added
+    """
+    conn = sqlite3.connect(cache_file)
+    n_responses = 0
+    for url, status, body in conn.execute('SELECT url, status, body FROM responses'):
+        parsed = urlparse(url)
+        if parsed.hostname in SERVICE_HOSTS:
+            path = parsed.path + (f"?{parsed.query}" if parsed.query else '')
+            fixtures.recorded[(SERVICE_HOSTS[parsed.hostname], path)] = (status, zlib.decompress(body).decode())
+            n_responses += 1
+    conn.close()
+    return n_responses
+
+
+class ServiceStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.bytes = 0
+
+
+class MockServices:
+    """
+    Local stand-ins for rest.kegg.jp, www.genome.jp and NCBI efetch, each on its own port.
+
+    Every request waits ``latency`` seconds, fails with 503 with probability ``error_rate`` and, beyond ``rate``
+    requests/sec per service, is answered the way the service throttles (403 for KEGG and genome.jp, 429 for NCBI).
+    ``environment()`` gives the variables that point kegg_client (and so every script) at the stand-ins.
+    """
+
+    def __init__(self, fixtures, latency=0.0, error_rate=0.0, rate=None, seed=0):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate = rate
+        self.stats = {x: ServiceStats() for x in SERVICES}
+        self.servers = dict()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # token buckets: service -> (tokens, last refill)
+        self._buckets = {x: (rate, time.monotonic()) for x in SERVICES} if rate else None
+
+    def start(self, port=0):
+        """
+        :param port: the port of the KEGG stand-in, genome.jp and NCBI use the next two (0: any free ports)
+        :return: self
+        """
+        for i, service in enumerate(SERVICES):
+            server = ThreadingHTTPServer(('127.0.0.1', port + i if port else 0), self._handler(service))
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers[service] = server
+        return self
+
+    def shutdown(self):
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+
+    def link(self, service):
+        return f"http://127.0.0.1:{self.servers[service].server_address[1]}{SERVICE_LINKS[service][1]}"
+
+    def environment(self):
+        return {SERVICE_LINKS[x][0]: self.link(x) for x in SERVICES}
+
+    def snapshot(self):
+        with self._lock:
+            return {x: vars(self.stats[x]).copy() for x in SERVICES}
+
+    def _admit(self, service):
+        # returns the status to answer instead of the response, or None
+        with self._lock:
+            self.stats[service].requests += 1
+            if self._buckets is not None:
+                tokens, last = self._buckets[service]
+                now = time.monotonic()
+                tokens = min(self.rate, tokens + (now - last) * self.rate)
+                if tokens < 1:
+                    self._buckets[service] = (tokens, now)
+                    self.stats[service].throttled += 1
+                    return THROTTLE_STATUS[service]
+                self._buckets[service] = (tokens - 1, now)
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.stats[service].errors += 1
+                return 503
+        return None
+
+    def respond(self, service, path, params):
+        """
+        :param service: 'kegg', 'genome' or 'ncbi'
+        :param path: the request path with its query string
+        :param params: the query (or form) parameters
+        :return: (status, body)
+        """
+        if service == 'ncbi' and '?' not in path and 'id' in params:
+            # efetch is POSTed; it is recorded under its GET form (see download_seq_fasta.download_seq)
+            path += '?' + '&'.join(f"{x}={params[x][0]}" for x in ['db', 'id', 'rettype', 'retmode'] if x in params)
+        if (service, path) in self.fixtures.recorded:
+            return self.fixtures.recorded[(service, path)]
+        route = unquote(urlparse(path).path)
+        if service == 'kegg':
+            return self._kegg(route)
+        if service == 'genome':
+            org_code = params.get('org', [None])[0]
+            if route == '/kegg-bin/show_organism' and org_code in self.fixtures.pages:
+                return 200, self.fixtures.pages[org_code]
+            return 404, ''
+        if route.endswith('/efetch.fcgi'):
+            records = []
+            for accession in ','.join(params.get('id', [])).split(','):
+                genome = self.fixtures.genomes.get(accession.split('.')[0])
+                if genome is not None:
+                    records.append(f">{genome[0]}\n{genome[1]}\n\n")
+            if records:
+                return 200, ''.join(records)
+            return 400, 'Error: ID list is empty or invalid\n'
+        return 404, ''
+
+    def _kegg(self, route):
+        if route in self.fixtures.paths:
+            return 200, self.fixtures.paths[route]
+        if not route.startswith('/get/'):
+            return 404, ''
+        query = route[len('/get/'):]
+        option = None
+        if '/' in query:
+            query, option = query.split('/', 1)
+        found = [x for x in query.split('+') if x in self.fixtures.genes]
+        if not found or option not in (None, 'aaseq', 'ntseq'):
+            return 404, ''
+        if option is None:
+            return 200, ''.join(render_record(x, *self.fixtures.genes[x]) for x in found)
+        index = 2 if option == 'aaseq' else 3
+        return 200, ''.join(f">{x} {self.fixtures.genes[x][0]}\n{_wrap(self.fixtures.genes[x][index], 60)}\n"
+                            for x in found if self.fixtures.genes[x][index])
+
+    def _handler(self, service):
+        services = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _serve(self, params):
+                if services.latency:
+                    time.sleep(services.latency)
+                status = services._admit(service)
+                body = ''
+                if status is None:
+                    status, body = services.respond(service, self.path, params)
+                data = body.encode()
+                with services._lock:
+                    services.stats[service].bytes += len(data)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json' if self.path.endswith('/json') else 'text/plain')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._serve(parse_qs(urlparse(self.path).query))
+
+            def do_POST(self):
+                form = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+                self._serve(parse_qs(form))
+
+            def log_message(self, format, *args):
+                pass
+
+        return _Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, help="The port of the KEGG stand-in; genome.jp and NCBI efetch use the next two", default=8801)
+    parser.add_argument("--organisms", type=int, help="The number of organisms (copies of the fixture organism aaa)", default=1)
+    parser.add_argument("--viruses", type=int, help="The number of viruses", default=10)
+    parser.add_argument("--latency", type=float, help="The delay of every response in seconds", default=0.0)
+    parser.add_argument("--error_rate", type=float, help="The fraction of requests answered with 503", default=0.0)
+    parser.add_argument("--rate", type=float, help="The requests/sec per service beyond which requests are throttled", default=None)
+    parser.add_argument("--replay", type=str, nargs='*', help="http_cache.sqlite files of real runs whose responses are replayed", default=[])
+    args = parser.parse_args()
+
+    fixtures = render_fixtures(n_organisms=args.organisms, n_viruses=args.viruses)
+    for cache_file in args.replay:
+        print(f"{load_recorded(fixtures, cache_file)} responses are replayed from {cache_file}", file=sys.stderr)
+    services = MockServices(fixtures, latency=args.latency, error_rate=args.error_rate, rate=args.rate).start(args.port)
+    for name, link in services.environment().items():
+        print(f"export {name}={link}")
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        services.shutdown()
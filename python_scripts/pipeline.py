@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import subprocess
+if __package__:
+    from .kegg_cli import get_logger
+else:
+    from kegg_cli import get_logger
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PENDING, RUNNING, DONE, SKIPPED, FAILED, BLOCKED = 'pending', 'running', 'done', 'skipped', 'failed', 'blocked'
+
+
+def signature(path):
+    """
+    :param path: a file or a folder
+    :return: the size and modification time of a file, a digest of those of the files in a folder, or None when it does not exist
+    """
+    if os.path.isdir(path):
+        digest = hashlib.sha1()
+        for name in sorted(os.listdir(path)):
+            stat = os.stat(os.path.join(path, name))
+            digest.update(f"{name}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode())
+        return digest.hexdigest()
+    if os.path.exists(path):
+        stat = os.stat(path)
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+    return None
+
+
+class Stage:
+    """
+    One step of the pipeline: a command, the files or folders it reads and the ones it writes.
+
+    ``early`` outputs are written once and atomically while the command goes on (e.g. the organism table, long before
+    the gene tables), so the stages that read them start as soon as they exist rather than when this stage finishes.
+    ``pool`` names the budget the stage runs under; the command itself carries its concurrency and rate options.
+    """
+
+    def __init__(self, name, command, inputs=(), outputs=(), early=(), pool=None):
+        self.name = name
+        self.command = list(command)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs) + [x for x in early if x not in outputs]
+        self.early = set(early)
+        self.pool = pool
+        self.state = PENDING
+        self.process = None
+        self.start = None
+        # the mtime of the stage's start marker, and the signatures of its inputs when it started
+        self.start_mtime = None
+        self.input_signatures = None
+
+
+class Pipeline:
+    """
+    Run the stages of a DAG, each as soon as its inputs are complete and its pool has a free slot.
+
+    The edges are implied by the paths: a stage depends on the stage that lists one of its inputs as an output. Like
+    make, a stage is skipped when its outputs exist and neither its command nor its inputs changed since it last
+    succeeded, which is recorded in <state_dir>/<stage>.json. The output of each command goes to <state_dir>/<stage>.log.
+    """
+
+    def __init__(self, stages, state_dir, pools=None, poll=1.0, logger=None):
+        self.stages = stages
+        self.state_dir = state_dir
+        self.pools = pools if pools is not None else dict()
+        self.poll = poll
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.producer = dict()
+        for stage in stages:
+            for path in stage.outputs:
+                if path in self.producer:
+                    raise ValueError(f"{path} is written by both {self.producer[path].name} and {stage.name}")
+                self.producer[path] = stage
+        if not os.path.exists(state_dir):
+            os.makedirs(state_dir)
+
+    def _stamp_file(self, stage):
+        return os.path.join(self.state_dir, f"{stage.name}.json")
+
+    def _stamp(self, stage, input_signatures=None):
+        if input_signatures is None:
+            input_signatures = {x: signature(x) for x in stage.inputs}
+        return {'command': stage.command, 'inputs': input_signatures}
+
+    def up_to_date(self, stage):
+        """
+        :param stage: a stage whose inputs are complete
+        :return: True when its outputs exist and its command and inputs are those of its last successful run
+        """
+        if not all(os.path.exists(x) for x in stage.outputs):
+            return False
+        try:
+            with open(self._stamp_file(stage)) as fid:
+                return json.load(fid) == self._stamp(stage)
+        except (OSError, ValueError):
+            return False
+
+    def _inputs_state(self, stage):
+        """
+        :return: DONE when all inputs are complete, BLOCKED when one will never be, PENDING otherwise
+        """
+        state = DONE
+        for path in stage.inputs:
+            producer = self.producer.get(path)
+            if producer is None:
+                if not os.path.exists(path):
+                    self.logger.error(f"{stage.name}: the input {path} does not exist")
+                    return BLOCKED
+            elif producer.state in (FAILED, BLOCKED):
+                return BLOCKED
+            elif producer.state in (PENDING, RUNNING):
+                # an early output left by an earlier run does not count until the running producer has rewritten it
+                if not (producer.state == RUNNING and path in producer.early and os.path.exists(path)
+                        and os.stat(path).st_mtime_ns > producer.start_mtime):
+                    state = PENDING
+        return state
+
+    def _upstream_runs(self, stage):
+        # in a dry run, a stage whose inputs would be written again would run as well
+        return any(self.producer[x].state == DONE for x in stage.inputs if x in self.producer)
+
+    def _start(self, stage):
+        self.logger.info(f"Start {stage.name}: {' '.join(stage.command)}")
+        # the inputs the stage reads; an early input that its producer rewrites later is then seen as changed next time
+        stage.input_signatures = {x: signature(x) for x in stage.inputs}
+        # touched, rather than taken from the clock, so that it compares with the mtimes of the outputs
+        start_file = os.path.join(self.state_dir, f"{stage.name}.start")
+        with open(start_file, 'w'):
+            pass
+        stage.start_mtime = os.stat(start_file).st_mtime_ns
+        with open(os.path.join(self.state_dir, f"{stage.name}.log"), 'a') as log_handle:
+            stage.process = subprocess.Popen(stage.command, stdout=log_handle, stderr=subprocess.STDOUT)
+        stage.start = time.monotonic()
+        stage.state = RUNNING
+
+    def _finish(self, stage, returncode):
+        elapsed = time.monotonic() - stage.start
+        missing = [x for x in stage.outputs if not os.path.exists(x)]
+        if returncode != 0 or missing:
+            stage.state = FAILED
+            reason = f"exit code {returncode}" if returncode != 0 else f"{', '.join(missing)} was not written"
+            self.logger.error(f"{stage.name} failed after {elapsed:.0f}s ({reason}), see {os.path.join(self.state_dir, stage.name + '.log')}")
+            # the stamp of an earlier run would let the next run skip a stage whose outputs are now incomplete
+            if os.path.exists(self._stamp_file(stage)):
+                os.remove(self._stamp_file(stage))
+            return
+        stage.state = DONE
+        with open(self._stamp_file(stage) + '.tmp', 'w') as out_handle:
+            json.dump(self._stamp(stage, stage.input_signatures), out_handle, indent=1)
+        os.replace(self._stamp_file(stage) + '.tmp', self._stamp_file(stage))
+        self.logger.info(f"{stage.name} finished in {elapsed:.0f}s")
+
+    def run(self, force=(), dry_run=False):
+        """
+        :param force: the names of stages to run even when they are up to date
+        :param dry_run: only log which stages would run, assuming each of them succeeds
+        :return: a dict of stage name -> done, skipped, failed or blocked
+        """
+        unknown = set(force) - {x.name for x in self.stages}
+        if unknown:
+            raise ValueError(f"Unknown stages: {' '.join(sorted(unknown))}")
+        try:
+            while any(x.state in (PENDING, RUNNING) for x in self.stages):
+                changed = False
+                for stage in self.stages:
+                    if stage.state == RUNNING and stage.process.poll() is not None:
+                        self._finish(stage, stage.process.returncode)
+                        changed = True
+                for stage in self.stages:
+                    if stage.state != PENDING:
+                        continue
+                    inputs = self._inputs_state(stage)
+                    if inputs == BLOCKED:
+                        stage.state = BLOCKED
+                        self.logger.error(f"{stage.name} is not run, one of its inputs is missing")
+                        changed = True
+                    elif inputs == DONE and stage.name not in force and not (dry_run and self._upstream_runs(stage)) and self.up_to_date(stage):
+                        stage.state = SKIPPED
+                        self.logger.info(f"{stage.name} is up to date")
+                        changed = True
+                    elif inputs == DONE and dry_run:
+                        stage.state = DONE
+                        self.logger.info(f"{stage.name} would run: {' '.join(stage.command)}")
+                        changed = True
+                    elif inputs == DONE:
+                        running = sum(1 for x in self.stages if x.state == RUNNING and x.pool == stage.pool)
+                        if stage.pool is None or running < self.pools.get(stage.pool, 1):
+                            self._start(stage)
+                            changed = True
+                if not changed:
+                    time.sleep(self.poll)
+        finally:
+            # the scripts resume where they stopped, so an interrupted pipeline is simply run again
+            for stage in self.stages:
+                if stage.state == RUNNING:
+                    stage.process.terminate()
+                    stage.process.wait()
+                    stage.state = FAILED
+        return {x.name: x.state for x in self.stages}
+
+
+def default_stages(args):
+    """
+    The stages of main.sh: the organism and virus extractors, the NCBI downloads of their genome sequences, the
+    FASTA conversion of the organism gene tables and, with --sketch, their sourmash sketches
+    :param args: the parsed command line arguments
+    :return: a list of Stage
+    """
+    organism_dir = os.path.join(args.outdir, 'kegg_organisms')
+    virus_dir = os.path.join(args.outdir, 'kegg_viruses')
+
+    def script(name):
+        return [sys.executable, os.path.join(SCRIPT_DIR, name)]
+
+    # the KEGG budget is split between the extractors, which run at the same time
+    max_rate = args.max_rate / args.kegg_stages
+    kegg = ['--concurrency', str(args.concurrency), '--rate', str(min(3, max_rate)), '--max_rate', str(max_rate)]
+    # the NCBI API key is passed on in the environment (NCBI_API_KEY), so that it is not written to the stamps and logs
+    ncbi = (['--threads', str(args.ncbi_threads)] if args.ncbi_threads is not None else []) + (['--email', args.email] if args.email else [])
+    select = ['--organisms'] + args.organisms + (['--exclude'] + args.exclude if args.exclude else []) + (['--taxdump', args.taxdump] if args.taxdump else [])
+    organism_table = os.path.join(organism_dir, 'organism_table.txt')
+    virus_table = os.path.join(virus_dir, 'virus_table.txt')
+    organism_fasta = [os.path.join(organism_dir, x) for x in ['rs_ncbi_organism.fasta', 'gb_ncbi_organism.fasta']]
+    virus_fasta = [os.path.join(virus_dir, x) for x in ['rs_ncbi_virus.fasta', 'gb_ncbi_virus.fasta']]
+    fasta_dir = os.path.join(args.outdir, 'kegg_genes_fasta')
+    stages = [
+        Stage('organisms', script('extract_kegg_organism_data.py') + select + ['--outdir', organism_dir] + kegg,
+              outputs=[os.path.join(organism_dir, 'kegg_gene_info')], early=[organism_table], pool='kegg'),
+        Stage('viruses', script('extract_kegg_virus_data.py') + ['--outdir', virus_dir] + kegg,
+              outputs=[os.path.join(virus_dir, 'kegg_gene_info')], early=[virus_table], pool='kegg'),
+        Stage('organism_sequences', script('download_seq_fasta.py') + ['--table', organism_table, '--col', 'rs_ncbi_seq_ids', 'gb_ncbi_seq_id']
+              + select + ['--outfile'] + organism_fasta + ncbi, inputs=[organism_table], outputs=organism_fasta, pool='ncbi'),
+        Stage('virus_sequences', script('download_seq_fasta.py') + ['--table', virus_table, '--col', 'rs_ncbi_seq_ids', 'gb_ncbi_seq_id',
+              '--outfile'] + virus_fasta + ncbi, inputs=[virus_table], outputs=virus_fasta, pool='ncbi'),
+        Stage('organism_fasta', script('convert_table_to_fasta.py') + ['--gene_dir', os.path.join(organism_dir, 'kegg_gene_info'), '--out_dir', fasta_dir,
+              '--processes', str(args.processes)], inputs=[os.path.join(organism_dir, 'kegg_gene_info')],
+              outputs=[os.path.join(fasta_dir, x) for x in ['kegg_genes_KO.faa', 'kegg_genes_No_KO.faa', 'kegg_genes_KO.fna', 'kegg_genes_No_KO.fna']], pool='cpu'),
+    ]
+    if args.sketch:
+        # straight from the gene tables, one protein signature per organism
+        sketches = os.path.join(args.outdir, 'kegg_sketches')
+        stages.append(Stage('organism_sketches', script('sketch.py') + ['--gene_dir', os.path.join(organism_dir, 'kegg_gene_info'), '--table', organism_table,
+                            '--group', 'organism', '--moltype', 'protein', '--processes', str(args.processes), '--output', os.path.join(sketches, 'kegg_organisms.sig.zip')],
+                            inputs=[os.path.join(organism_dir, 'kegg_gene_info'), organism_table],
+                            outputs=[os.path.join(sketches, x) for x in ['kegg_organisms.sig.zip', 'kegg_organisms.lineages.csv']], pool='cpu'))
+    return stages
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument("--outdir", type=str, help="The output dir, with the kegg_organisms, kegg_viruses and kegg_genes_fasta folders")
+    parser.add_argument("--organisms", type=str, nargs='*', help="The organisms to extract, see extract_kegg_organism_data.py (e.g. Archaea Bacteria Fungi)", default=['Archaea', 'Bacteria', 'Fungi'])
+    parser.add_argument("--exclude", type=str, nargs='*', help="The organisms to leave out, e.g. Bacilli", default=None)
+    parser.add_argument("--taxdump", type=str, help="The folder of the extracted NCBI taxdump, for --organisms/--exclude by taxid subtree or NCBI rank", default=None)
+    parser.add_argument("--concurrency", type=int, help="The number of concurrent HTTP requests of each extractor", default=20)
+    parser.add_argument("--max_rate", type=float, help="The KEGG requests per second of all extractors together", default=10)
+    parser.add_argument("--kegg_stages", type=int, help="The number of extractors that run at the same time, each with an equal share of --max_rate", default=2)
+    parser.add_argument("--ncbi_threads", type=int, help="The number of efetch requests in flight; the NCBI downloads run one at a time", default=None)
+    parser.add_argument("--api_key", type=str, help="NCBI API key, which raises the request limit from 3 to 10 per second", default=os.environ.get('NCBI_API_KEY'))
+    parser.add_argument("--email", type=str, help="The contact address sent to NCBI with the sequence downloads", default=os.environ.get('NCBI_EMAIL'))
+    parser.add_argument("--processes", type=int, help="The number of tables the FASTA conversion converts in parallel", default=os.cpu_count())
+    parser.add_argument("--sketch", action='store_true', help="Also sketch the organism gene tables into a sourmash signature database, one signature per organism")
+    parser.add_argument("--force", type=str, nargs='*', help="Run these stages even when they are up to date", default=[])
+    parser.add_argument("--dry_run", action='store_true', help="Only show which stages would run")
+    args = parser.parse_args(argv)
+
+    logger = get_logger()
+    if args.api_key:
+        os.environ['NCBI_API_KEY'] = args.api_key
+    for path in [os.path.join(args.outdir, x) for x in ['kegg_organisms', 'kegg_viruses']]:
+        os.makedirs(path, exist_ok=True)
+    pipeline = Pipeline(default_stages(args), os.path.join(args.outdir, '.pipeline'), pools={'kegg': args.kegg_stages, 'ncbi': 1, 'cpu': 1}, logger=logger)
+    states = pipeline.run(force=args.force, dry_run=args.dry_run)
+    if any(x in (FAILED, BLOCKED) for x in states.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+# responses that mean "slow down" (or a transient server failure) rather than "this id does not exist"
+RETRY_STATUS = frozenset([403, 429, 500, 502, 503, 504])
+
+# (initial requests/sec, maximum requests/sec) per host; hosts that are not listed are not throttled
+DEFAULT_RATES = {
+    'rest.kegg.jp': (3, 10),
+    'www.genome.jp': (3, 10),
+    'eutils.ncbi.nlm.nih.gov': (3, 3),
+}
+
+
+class AdaptiveTokenBucket:
+    """
+    A thread-safe token bucket whose rate adapts to the server's answers.
+
+    Every throttling or server error response halves the rate (at most once per second, so a burst of in-flight
+    failures counts once) and every successful response adds ``increase`` requests/sec, up to ``max_rate``.
+    """
+
+    def __init__(self, rate, max_rate=None, min_rate=0.2, increase=0.05, decrease=0.5):
+        self.rate = float(rate)
+        self.max_rate = float(max_rate) if max_rate is not None else float(rate)
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.burst = max(1.0, self.rate)
+        self.tokens = self.burst
+        self.throttled = 0
+        self._updated = time.monotonic()
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take one token
+        :return: the number of seconds to wait before sending the request
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def update(self, status_code):
+        """
+        Adapt the rate to a response
+        :param status_code: the HTTP status code, or None when the request raised a connection error
+        :return: None
+        """
+        with self._lock:
+            now = time.monotonic()
+            if status_code is None or status_code in RETRY_STATUS:
+                self.throttled += 1
+                if now - self._last_decrease > 1:
+                    self.rate = max(self.min_rate, self.rate * self.decrease)
+                    self._last_decrease = now
+            elif status_code == 200:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter: attempt n waits a random time in [0, min(max_delay, base_delay * 2 ** n)]
+    """
+
+    def __init__(self, max_retries=5, base_delay=2, max_delay=300):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def should_retry(self, status_code):
+        return status_code is None or status_code in RETRY_STATUS
+
+
+NO_RETRY = RetryPolicy(max_retries=0)
+
+_limiters = dict()
+_limiters_lock = threading.Lock()
+# netloc -> the host whose limiter it shares, e.g. a local stand-in server for rest.kegg.jp
+_aliases = dict()
+
+
+def configure_limiter(host, rate, max_rate=None):
+    """
+    Set the request rate for a host, replacing its current limiter
+    :param host: the host name, e.g. rest.kegg.jp
+    :param rate: the initial requests/sec
+    :param max_rate: the rate the limiter may ramp up to while the host answers successfully
+    :return: AdaptiveTokenBucket
+    """
+    with _limiters_lock:
+        _limiters[host] = AdaptiveTokenBucket(rate, max_rate if max_rate is not None else rate)
+        return _limiters[host]
+
+
+def alias_host(netloc, host):
+    """
+    Throttle the requests to another address with the limiter of a host
+    :param netloc: the address, e.g. 127.0.0.1:8001
+    :param host: the host whose rate applies to it, e.g. rest.kegg.jp
+    :return: None
+    """
+    with _limiters_lock:
+        _aliases[netloc] = host
+
+
+def host_of(url):
+    """
+    :param url: the request URL
+    :return: the host name the URL counts as, e.g. rest.kegg.jp for the URL of its local stand-in
+    """
+    parsed = urlparse(url)
+    return _aliases.get(parsed.netloc, parsed.hostname)
+
+
+def limiter_for(url):
+    """
+    Get the shared limiter of the host that serves a URL
+    :param url: the request URL
+    :return: AdaptiveTokenBucket, or None when the host is not throttled
+    """
+    host = host_of(url)
+    with _limiters_lock:
+        if host not in _limiters:
+            if host not in DEFAULT_RATES:
+                return None
+            _limiters[host] = AdaptiveTokenBucket(*DEFAULT_RATES[host])
+        return _limiters[host]
+
+
+def add_rate_limit_arguments(parser):
+    parser.add_argument("--rate", type=float, help="The initial number of KEGG requests per second", default=DEFAULT_RATES['rest.kegg.jp'][0])
+    parser.add_argument("--max_rate", type=float, help="The KEGG request rate to ramp up to while KEGG answers successfully", default=DEFAULT_RATES['rest.kegg.jp'][1])
+
+
+def limiter_from_args(args):
+    return configure_limiter('rest.kegg.jp', args.rate, args.max_rate)
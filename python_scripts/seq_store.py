@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+import os
+import argparse
+import hashlib
+import mmap
+import sqlite3
+from glob import glob
+import numpy as np
+if __package__:
+    from .kegg_cli import lazy_import
+else:
+    from kegg_cli import lazy_import
+pd = lazy_import('pandas')
+
+# how a sequence is stored in the pack file
+RAW, TWO_BIT_LOWER, TWO_BIT_UPPER = 0, 1, 2
+_ALPHABETS = {TWO_BIT_LOWER: b'acgt', TWO_BIT_UPPER: b'ACGT'}
+_CODES = {encoding: np.full(256, 255, dtype=np.uint8) for encoding in _ALPHABETS}
+for _encoding, _alphabet in _ALPHABETS.items():
+    _CODES[_encoding][list(_alphabet)] = np.arange(4, dtype=np.uint8)
+# the number of hashes per SQL lookup, below SQLite's default variable limit
+_QUERY_SIZE = 900
+
+
+def sequence_hash(seq):
+    return hashlib.blake2b(seq.encode(), digest_size=16).digest()
+
+
+def encode_sequence(seq):
+    """
+    Pack a sequence for the pack file
+    :param seq: an amino acid or nucleotide sequence
+    :return: (encoding, bytes); sequences of only acgt (or only ACGT) are packed four bases per byte
+    """
+    data = seq.encode()
+    for encoding in (TWO_BIT_LOWER, TWO_BIT_UPPER):
+        codes = _CODES[encoding][np.frombuffer(data, dtype=np.uint8)]
+        if len(codes) and not (codes == 255).any():
+            codes = np.concatenate([codes, np.zeros(-len(codes) % 4, dtype=np.uint8)]).reshape(-1, 4)
+            return encoding, (codes[:, 0] << 6 | codes[:, 1] << 4 | codes[:, 2] << 2 | codes[:, 3]).astype(np.uint8).tobytes()
+    return RAW, data
+
+
+def decode_sequence(encoding, data, length):
+    """
+    :param encoding: the encoding returned by encode_sequence
+    :param data: the packed bytes
+    :param length: the number of characters of the sequence
+    :return: the sequence
+    """
+    if encoding == RAW:
+        return bytes(data).decode()
+    packed = np.frombuffer(data, dtype=np.uint8)
+    codes = np.stack([packed >> 6, (packed >> 4) & 3, (packed >> 2) & 3, packed & 3], axis=1).reshape(-1)[:length]
+    return np.frombuffer(_ALPHABETS[encoding], dtype=np.uint8)[codes].tobytes().decode()
+
+
+class SequenceStore:
+    """
+    A content-addressed store of the amino acid and nucleotide sequences of KEGG genes.
+
+    Every distinct sequence is appended once to ``sequences.pack`` and indexed by its hash in ``index.sqlite``, which
+    also maps each kegg_gene_id to the hashes of its aaseq and ntseq. Sequences are written from one process; any number
+    of processes can read, the pack file is memory-mapped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.pack_file = os.path.join(path, 'sequences.pack')
+        self._conn = sqlite3.connect(os.path.join(path, 'index.sqlite'), check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS sequences (hash BLOB PRIMARY KEY, offset INTEGER, size INTEGER, length INTEGER, encoding INTEGER) WITHOUT ROWID')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS genes (kegg_gene_id TEXT PRIMARY KEY, aa_hash BLOB, nt_hash BLOB) WITHOUT ROWID')
+        self._pack = None
+        self._mm = None
+
+    def _existing(self, hashes):
+        existing = set()
+        hashes = list(hashes)
+        for i in range(0, len(hashes), _QUERY_SIZE):
+            chunk = hashes[i:i + _QUERY_SIZE]
+            existing.update(x[0] for x in self._conn.execute(f"SELECT hash FROM sequences WHERE hash IN ({','.join('?' * len(chunk))})", chunk))
+        return existing
+
+    def add_genes(self, rows):
+        """
+        Store the sequences of a batch of genes
+        :param rows: (kegg_gene_id, aaseq, ntseq) tuples; a missing sequence is None or ''
+        :return: the number of sequences appended to the pack file
+        """
+        new = dict()
+        gene_rows = []
+        for kegg_gene_id, aaseq, ntseq in rows:
+            hashes = []
+            for seq in (aaseq, ntseq):
+                if isinstance(seq, str) and seq:
+                    seq_hash = sequence_hash(seq)
+                    new.setdefault(seq_hash, seq)
+                    hashes.append(seq_hash)
+                else:
+                    hashes.append(None)
+            gene_rows.append((kegg_gene_id, *hashes))
+        for seq_hash in self._existing(new):
+            del new[seq_hash]
+        if self._pack is None:
+            self._pack = open(self.pack_file, 'ab')
+        seq_rows = []
+        for seq_hash, seq in new.items():
+            encoding, data = encode_sequence(seq)
+            seq_rows.append((seq_hash, self._pack.tell(), len(data), len(seq), encoding))
+            self._pack.write(data)
+        # the pack file is flushed before the index points into it
+        self._pack.flush()
+        with self._conn:
+            self._conn.executemany('INSERT OR IGNORE INTO sequences VALUES (?, ?, ?, ?, ?)', seq_rows)
+            self._conn.executemany('INSERT OR REPLACE INTO genes VALUES (?, ?, ?)', gene_rows)
+        return len(seq_rows)
+
+    def _read(self, offset, size, length, encoding):
+        if self._mm is None or offset + size > len(self._mm):
+            if self._pack is not None:
+                self._pack.flush()
+            with open(self.pack_file, 'rb') as fid:
+                self._mm = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+        return decode_sequence(encoding, self._mm[offset:offset + size], length)
+
+    def get_genes(self, kegg_gene_ids):
+        """
+        Look up the sequences of genes
+        :param kegg_gene_ids: a list of KEGG gene ids
+        :return: a dict of kegg_gene_id -> (aaseq, ntseq) for the ids in the store; a missing sequence is ''
+        """
+        result = dict()
+        kegg_gene_ids = list(kegg_gene_ids)
+        for i in range(0, len(kegg_gene_ids), _QUERY_SIZE):
+            chunk = kegg_gene_ids[i:i + _QUERY_SIZE]
+            rows = self._conn.execute(f"SELECT g.kegg_gene_id, a.offset, a.size, a.length, a.encoding, n.offset, n.size, n.length, n.encoding "
+                                      f"FROM genes g LEFT JOIN sequences a ON a.hash = g.aa_hash LEFT JOIN sequences n ON n.hash = g.nt_hash "
+                                      f"WHERE g.kegg_gene_id IN ({','.join('?' * len(chunk))})", chunk)
+            for row in rows:
+                aaseq = self._read(*row[1:5]) if row[1] is not None else ''
+                ntseq = self._read(*row[5:9]) if row[5] is not None else ''
+                result[row[0]] = (aaseq, ntseq)
+        return result
+
+    def summary(self):
+        genes, distinct = [self._conn.execute(f"SELECT COUNT(*) FROM {x}").fetchone()[0] for x in ['genes', 'sequences']]
+        # the bytes the sequences would take stored once per gene, as in the gene tables
+        logical = sum(self._conn.execute(f"SELECT COALESCE(SUM(s.length), 0) FROM genes g JOIN sequences s ON s.hash = g.{x}").fetchone()[0] for x in ['aa_hash', 'nt_hash'])
+        stored = os.path.getsize(self.pack_file) if os.path.exists(self.pack_file) else 0
+        unique = self._conn.execute("SELECT COALESCE(SUM(length), 0) FROM sequences").fetchone()[0]
+        ratio = logical / unique if unique else 0.0
+        return (f"Sequence store {self.path}: {genes} genes, {distinct} distinct sequences, {logical / 1e6:.1f} MB of sequences "
+                f"stored in {stored / 1e6:.1f} MB (deduplication ratio {ratio:.2f}, {(logical - stored) / 1e6:.1f} MB saved)")
+
+    def close(self):
+        if self._pack is not None:
+            self._pack.close()
+            self._pack = None
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        self._conn.close()
+
+
+def add_seq_store_arguments(parser):
+    parser.add_argument("--seq_store", type=str, default=None,
+                        help="Store the sequences once per distinct sequence in this folder (see seq_store.py) and leave the aaseq/ntseq columns of the gene tables empty")
+
+
+def import_gene_tables(store, gene_dir, chunksize=100000):
+    """
+    Move the sequences of existing gene tables into a store
+    :param store: SequenceStore
+    :param gene_dir: the folder of gene tables with kegg_gene_id, aaseq and ntseq columns
+    :param chunksize: the number of rows read at a time
+    :return: the number of genes imported
+    """
+    n_genes = 0
+    for gene_table_file in sorted(glob(os.path.join(gene_dir, '*.txt'))):
+        try:
+            reader = pd.read_csv(gene_table_file, sep='\t', header=0, dtype=str, keep_default_na=False, usecols=['kegg_gene_id', 'aaseq', 'ntseq'], chunksize=chunksize)
+        except ValueError:
+            # not annotated yet
+            continue
+        with reader:
+            for df in reader:
+                store.add_genes(zip(df['kegg_gene_id'], df['aaseq'], df['ntseq']))
+                n_genes += len(df)
+    return n_genes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seq_store", type=str, help="The sequence store folder", required=True)
+    parser.add_argument("--import_tables", type=str, help="Import the sequences of the gene tables in this folder", default=None)
+    args = parser.parse_args()
+
+    store = SequenceStore(args.seq_store)
+    if args.import_tables is not None:
+        print(f"{import_gene_tables(store, args.import_tables)} genes are imported")
+    print(store.summary())
+    store.close()
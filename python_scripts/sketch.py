@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+import os
+import sys
+import csv
+import glob
+import argparse
+from collections import deque
+from multiprocessing import Pool, cpu_count
+if __package__:
+    from .seq_store import SequenceStore
+    from .table_store import read_entry_table
+    from .metrics import METRICS, Progress, add_metrics_arguments, metrics_from_args
+    from .kegg_cli import get_logger, lazy_import
+else:
+    from seq_store import SequenceStore
+    from table_store import read_entry_table
+    from metrics import METRICS, Progress, add_metrics_arguments, metrics_from_args
+    from kegg_cli import get_logger, lazy_import
+pd = lazy_import('pandas')
+# sourmash takes about a second to import, so it is only loaded once there is something to sketch
+sourmash = lazy_import('sourmash')
+save_load = lazy_import('sourmash.save_load')
+
+# the defaults of `sourmash sketch dna` and `sourmash sketch protein`
+DEFAULT_KSIZE = {'dna': 31, 'protein': 10}
+DEFAULT_SCALED = {'dna': 1000, 'protein': 200}
+# the number of sequence characters sent to a worker at a time
+BATCH_SIZE = 4 * 2 ** 20
+# the FASTA files that hold amino acid sequences, like the .faa outputs of convert_table_to_fasta.py
+PROTEIN_SUFFIXES = ('.faa',)
+
+
+class Taxonomy:
+    """
+    The organisms of an organism table (by org_code) and the viruses of a virus table (by taxid), with the NCBI
+    accessions of their genomes, to name signatures and to group sequences by organism
+    """
+
+    def __init__(self, table_files=()):
+        # key -> (taxid, name, lineage)
+        self.entries = dict()
+        # accession without version -> key
+        self.accessions = dict()
+        for path in table_files:
+            table = read_entry_table(path)
+            keys = table['org_code'] if 'org_code' in table else table['taxaid']
+            lineages = table['lineage'] if 'lineage' in table else ['Viruses'] * len(table)
+            for key, taxid, name, lineage, *seq_ids in zip(keys, table['taxaid'], table['name'], lineages, table['rs_ncbi_seq_ids'], table['gb_ncbi_seq_id']):
+                self.entries[key] = (taxid, name, lineage)
+                for accession in [y for x in seq_ids if x is not None for y in x]:
+                    self.accessions[accession.split('.')[0]] = key
+
+    def key_of(self, ident, taxid=None):
+        """
+        :param ident: a KEGG gene id (e.g. 'aaa:Acav_0001') or an NCBI accession (e.g. 'NC_000913.3')
+        :param taxid: the taxid of a virus gene, from the taxaid column of the virus gene table
+        :return: the org_code or virus taxid the sequence belongs to, the ident itself when it is not known
+        """
+        if taxid:
+            return taxid
+        if ':' in ident:
+            return ident.split(':')[0]
+        return self.accessions.get(ident.split('.')[0], ident)
+
+    def lineage_row(self, ident, key):
+        taxid, name, lineage = self.entries.get(key, ('', '', ''))
+        return [ident, taxid, name, lineage]
+
+
+def table_records(file_names, moltype, taxonomy, seq_store=None, chunksize=100000):
+    """
+    Stream the genes of KEGG gene tables, the organism <org>_kegg_genes.txt or the virus gene_table.txt
+    :param file_names: the gene tables
+    :param moltype: 'protein' reads the aaseq column, 'dna' the ntseq column
+    :param taxonomy: a Taxonomy
+    :param seq_store: the folder of a seq_store.SequenceStore that holds the sequences left empty in the tables
+    :param chunksize: the number of rows read at a time
+    :return: yields (ident, name, key, sequence) for every gene with a sequence
+    """
+    column = 'aaseq' if moltype == 'protein' else 'ntseq'
+    store = SequenceStore(seq_store) if seq_store is not None else None
+    for filename in file_names:
+        header = pd.read_csv(filename, sep='\t', nrows=0).columns
+        usecols = [x for x in ['kegg_gene_id', 'desc', 'taxaid', column] if x in header]
+        reader = pd.read_csv(filename, sep='\t', lineterminator='\n', header=0, keep_default_na=False, dtype=str, usecols=usecols, chunksize=chunksize)
+        with reader:
+            for df in reader:
+                if store is not None:
+                    seqs = store.get_genes(df['kegg_gene_id'])
+                    i = 0 if moltype == 'protein' else 1
+                    df[column] = [seq if seq else seqs[kegg_gene_id][i] if kegg_gene_id in seqs else ''
+                                  for kegg_gene_id, seq in zip(df['kegg_gene_id'], df[column])]
+                taxids = df['taxaid'] if 'taxaid' in df else [None] * len(df)
+                descs = df['desc'] if 'desc' in df else [''] * len(df)
+                for kegg_gene_id, desc, taxid, seq in zip(df['kegg_gene_id'], descs, taxids, df[column]):
+                    if seq:
+                        yield kegg_gene_id, f"{kegg_gene_id} {desc}".strip(), taxonomy.key_of(kegg_gene_id, taxid), seq
+    if store is not None:
+        store.close()
+
+
+def fasta_records(file_names, taxonomy):
+    """
+    Stream the records of FASTA files, the outputs of convert_table_to_fasta.py or download_seq_fasta.py
+    :param file_names: the FASTA files
+    :param taxonomy: a Taxonomy
+    :return: yields (ident, name, key, sequence), the ident being the KEGG gene id or the accession of the header
+    """
+    for filename in file_names:
+        with open(filename) as fid:
+            header, lines = None, []
+            for line in fid:
+                if line.startswith('>'):
+                    if header is not None:
+                        yield _fasta_record(header, ''.join(lines), taxonomy)
+                    header, lines = line[1:].rstrip('\n'), []
+                else:
+                    lines.append(line.rstrip('\n'))
+            if header is not None:
+                yield _fasta_record(header, ''.join(lines), taxonomy)
+
+
+def _fasta_record(header, seq, taxonomy):
+    # convert_table_to_fasta.py writes '>kegg_gene_id|desc|koid', NCBI '>accession description'
+    ident = header.split('|')[0] if '|' in header else header.split(' ')[0]
+    return ident, header, taxonomy.key_of(ident), seq
+
+
+def sketch_batch(records, ksize, scaled, moltype, protein_input, group):
+    """
+    Sketch a batch of sequences, in a worker process
+    :param records: a list of (ident, name, key, sequence)
+    :param ksize: the k-mer size, in amino acids for the protein moltype
+    :param scaled: the scaled value of the sketches
+    :param moltype: 'dna' or 'protein'
+    :param protein_input: the sequences are amino acids (otherwise nucleotides, translated for the protein moltype)
+    :param group: one sketch per key instead of one per record
+    :return: a list of (ident, name, key, MinHash); with group, the sketches of the keys that occur in the batch
+    """
+    template = sourmash.MinHash(n=0, ksize=ksize, scaled=scaled, is_protein=moltype == 'protein')
+    sketches = dict()
+    for i, (ident, name, key, seq) in enumerate(records):
+        slot = key if group else i
+        if slot not in sketches:
+            sketches[slot] = (key if group else ident, name, key, template.copy_and_clear())
+        minhash = sketches[slot][3]
+        if protein_input:
+            minhash.add_protein(seq)
+        else:
+            minhash.add_sequence(seq, force=True)
+    return list(sketches.values())
+
+
+def _batches(records, batch_size=BATCH_SIZE):
+    batch, size = [], 0
+    for record in records:
+        batch.append(record)
+        size += len(record[3])
+        if size >= batch_size:
+            yield batch
+            batch, size = [], 0
+    if batch:
+        yield batch
+
+
+def sketch(records, output, lineage_file, taxonomy, ksize, scaled, moltype='dna', protein_input=False, group=False, processes=1, batch_size=BATCH_SIZE, logger=None):
+    """
+    Sketch sequences into a sourmash signature database, on a pool of worker processes
+    :param records: an iterable of (ident, name, key, sequence), see table_records and fasta_records
+    :param output: the signature database, e.g. kegg_organisms.sig.zip (any location sourmash can save to)
+    :param lineage_file: the lineage CSV written next to it, with one ident,taxid,name,lineage row per signature
+    :param taxonomy: a Taxonomy for the names and lineages of the organisms
+    :param group: one signature per organism (the key of the records) instead of one per sequence
+    :param processes: the number of worker processes
+    :param batch_size: the number of sequence characters sent to a worker at a time
+    :return: the number of signatures
+    """
+    pool = Pool(processes) if processes > 1 else None
+    # the batches in flight, in order; bounded so that the reader does not run ahead of the workers
+    in_flight = deque()
+    groups = dict()
+    progress = Progress(None, 'sequences', logger)
+    n_signatures = 0
+    with save_load.SaveSignaturesToLocation(output) as save, open(lineage_file, 'w', newline='') as lineage_handle:
+        writer = csv.writer(lineage_handle)
+        writer.writerow(['ident', 'taxid', 'name', 'lineage'])
+
+        def _collect(results, n_records):
+            nonlocal n_signatures
+            progress.update(n_records)
+            METRICS.inc('records_total', n_records, stage='sketch')
+            for ident, name, key, minhash in results:
+                if group:
+                    if key in groups:
+                        groups[key].merge(minhash)
+                    else:
+                        groups[key] = minhash
+                    continue
+                with METRICS.stage('write'):
+                    save.add(sourmash.SourmashSignature(minhash, name=name))
+                    writer.writerow(taxonomy.lineage_row(ident, key))
+                n_signatures += 1
+
+        for batch in _batches(records, batch_size):
+            args = (batch, ksize, scaled, moltype, protein_input, group)
+            if pool is None:
+                with METRICS.stage('sketch'):
+                    _collect(sketch_batch(*args), len(batch))
+                continue
+            in_flight.append((pool.apply_async(sketch_batch, args), len(batch)))
+            if len(in_flight) >= processes * 2:
+                result, n_records = in_flight.popleft()
+                _collect(result.get(), n_records)
+        while in_flight:
+            result, n_records = in_flight.popleft()
+            _collect(result.get(), n_records)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        progress.close()
+
+        with METRICS.stage('write'):
+            for key in sorted(groups):
+                name = taxonomy.entries.get(key, ('', '', ''))[1]
+                save.add(sourmash.SourmashSignature(groups[key], name=f"{key} {name}".strip()))
+                writer.writerow(taxonomy.lineage_row(key, key))
+                n_signatures += 1
+    return n_signatures
+
+
+def gene_tables(gene_dir):
+    """
+    :param gene_dir: a kegg_gene_info folder of the organism or the virus extractor
+    :return: its gene tables, sorted
+    """
+    return sorted(glob.glob(os.path.join(gene_dir, '*_kegg_genes.txt')) + glob.glob(os.path.join(gene_dir, 'gene_table.txt')))
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument("--gene_dir", type=str, help="Sketch the gene tables of this kegg_gene_info folder of the organism or virus extractor", default=None)
+    parser.add_argument("--fasta", type=str, nargs='*', help="Sketch these FASTA files instead, e.g. the outputs of convert_table_to_fasta.py or download_seq_fasta.py; .faa files hold amino acid sequences", default=[])
+    parser.add_argument("--table", type=str, nargs='*', help="The organism and/or virus tables, for the names, taxids and lineages and to group accessions by organism", default=[])
+    parser.add_argument("--group", type=str, choices=['record', 'organism'], help="One signature per gene or FASTA record, or one per organism (per virus taxid)", default='record')
+    parser.add_argument("--moltype", type=str, choices=['dna', 'protein'], help="Sketch nucleotide or amino acid k-mers; nucleotide input is translated for protein", default='dna')
+    parser.add_argument("--ksize", type=int, help="The k-mer size, in amino acids for protein (default: 31 for dna, 10 for protein)", default=None)
+    parser.add_argument("--scaled", type=int, help="The scaled value (default: 1000 for dna, 200 for protein)", default=None)
+    parser.add_argument("--seq_store", type=str, help="The sequence store the extractors wrote the sequences to (see seq_store.py)", default=None)
+    parser.add_argument("--processes", type=int, help="The number of worker processes", default=cpu_count())
+    parser.add_argument("--output", type=str, help="The signature database, e.g. kegg_organisms.sig.zip", required=True)
+    parser.add_argument("--lineages", type=str, help="The lineage CSV (default: the output name with .lineages.csv)", default=None)
+    add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+    if (args.gene_dir is None) == (not args.fasta):
+        parser.error("give either --gene_dir or --fasta")
+
+    logger = get_logger()
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    metrics_from_args(args, os.path.join(os.path.dirname(os.path.abspath(args.output)), 'profile'), logger)
+    ksize = args.ksize if args.ksize is not None else DEFAULT_KSIZE[args.moltype]
+    scaled = args.scaled if args.scaled is not None else DEFAULT_SCALED[args.moltype]
+    if args.lineages is None:
+        base = args.output[:-len('.sig.zip')] if args.output.endswith('.sig.zip') else os.path.splitext(args.output)[0]
+        args.lineages = base + '.lineages.csv'
+
+    ## read the organism/virus tables
+    taxonomy = Taxonomy(args.table)
+
+    ## stream the sequences to the workers
+    if args.gene_dir is not None:
+        file_names = gene_tables(args.gene_dir)
+        if not file_names:
+            print(f"Error: There are no gene tables in {args.gene_dir}", flush=True)
+            sys.exit(1)
+        records = table_records(file_names, args.moltype, taxonomy, seq_store=args.seq_store)
+        protein_input = args.moltype == 'protein'
+        logger.info(f"Sketch {len(file_names)} gene tables")
+    else:
+        protein_input = all(x.endswith(PROTEIN_SUFFIXES) for x in args.fasta)
+        if not protein_input and any(x.endswith(PROTEIN_SUFFIXES) for x in args.fasta):
+            parser.error("amino acid (.faa) and nucleotide FASTA files can not be sketched together")
+        if protein_input and args.moltype != 'protein':
+            parser.error("amino acid (.faa) FASTA files need --moltype protein")
+        records = fasta_records(args.fasta, taxonomy)
+        logger.info(f"Sketch {len(args.fasta)} FASTA files")
+    n_signatures = sketch(records, args.output, args.lineages, taxonomy, ksize, scaled, moltype=args.moltype, protein_input=protein_input,
+                          group=args.group == 'organism', processes=args.processes, logger=logger)
+    logger.info(f"{n_signatures} signatures are written to {args.output} and their lineages to {args.lineages}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+import os
+import ast
+import json
+import shutil
+import hashlib
+import argparse
+from glob import glob
+if __package__:
+    from .lineage_index import LineageIndex, lineage_index_path
+    from .kegg_cli import lazy_import
+else:
+    from lineage_index import LineageIndex, lineage_index_path
+    from kegg_cli import lazy_import
+pd = lazy_import('pandas')
+# pyarrow is only needed for the parquet store; None when it is not installed
+pa = lazy_import('pyarrow', optional=True)
+ds = lazy_import('pyarrow.dataset', optional=True)
+pq = lazy_import('pyarrow.parquet', optional=True)
+
+# columns that hold a list of NCBI sequence ids per organism/virus
+SEQ_ID_COLUMNS = ['rs_ncbi_seq_ids', 'gb_ncbi_seq_id']
+# low-cardinality columns that are stored dictionary-encoded
+DICTIONARY_COLUMNS = ['lineage', 'koid', 'taxaid']
+GENE_COLUMNS = ['kegg_gene_id', 'desc', 'taxaid', 'koid', 'aaseq', 'ntseq']
+PARTITIONING = 'org_code'
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise Exception("The parquet store needs pyarrow, install it with `conda install -c conda-forge pyarrow`")
+
+
+def parquet_path(path):
+    """
+    :param path: a table path, e.g. outdir/organism_table.txt
+    :return: the path of its columnar version, e.g. outdir/organism_table.parquet
+    """
+    return os.path.splitext(path)[0] + '.parquet'
+
+
+def entry_table_exists(path):
+    return os.path.exists(path) or os.path.exists(parquet_path(path))
+
+
+def parse_id_list(value):
+    """
+    Parse a sequence id list written to a TSV table, e.g. "['NC_000913']", without eval
+    :param value: the cell value
+    :return: a list of ids or None
+    """
+    if not isinstance(value, str):
+        return None
+    value = ast.literal_eval(value)
+    return list(value) if value is not None else None
+
+
+def lineage_index(path, taxdump=None):
+    """
+    The LineageIndex of an organism table, built on first use and cached next to it, e.g. outdir/organism_table.lineage.idx
+    :param path: the TSV or parquet path
+    :param taxdump: the folder of NCBI's taxdump (nodes.dmp, names.dmp), for selections by NCBI taxid subtree or rank
+    :return: a LineageIndex; it is rebuilt when the table or the taxdump changed since it was cached
+    """
+    source = parquet_path(path) if path.endswith('.parquet') or not os.path.exists(path) else path
+    index_file = lineage_index_path(path)
+    index = LineageIndex.load(index_file, source, taxdump)
+    if index is None:
+        index = LineageIndex.build(read_entry_table(path, columns=['org_code', 'lineage', 'taxaid']), source, taxdump)
+        try:
+            index.write(index_file)
+        except OSError:
+            # e.g. a read-only output folder; the index is only used for this selection
+            pass
+    return index
+
+
+def select_organisms(path, organisms=None, exclude=None, taxdump=None, logger=None):
+    """
+    Select organisms of an organism table by their lineage, see LineageIndex.lookup for the terms
+    :param path: the TSV or parquet path
+    :param organisms: e.g. ['Archaea', 'Bacteria', 'Fungi'] or ['Firmicutes']; all organisms when None
+    :param exclude: e.g. ['Bacilli']
+    :param taxdump: the folder of NCBI's taxdump, for taxid and NCBI rank terms
+    :param logger: reports the terms that match no organism
+    :return: the set of selected org codes
+    """
+    return lineage_index(path, taxdump).select(organisms, exclude, logger=logger)
+
+
+def _to_arrow(table):
+    columns = dict()
+    for column in table.columns:
+        if column in SEQ_ID_COLUMNS:
+            values = pa.array([x if isinstance(x, list) else None for x in table[column]], type=pa.list_(pa.string()))
+        else:
+            values = pa.array([None if pd.isna(x) else str(x) for x in table[column]], type=pa.string())
+        if column in DICTIONARY_COLUMNS:
+            values = values.dictionary_encode()
+        columns[column] = values
+    return pa.table(columns)
+
+
+def _to_pandas(table):
+    df = table.to_pandas()
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype(object)
+        elif column in SEQ_ID_COLUMNS:
+            df[column] = [list(x) if x is not None else None for x in df[column]]
+    return df
+
+
+def _write_parquet(table, path, metadata=None):
+    # write next to the target and rename, so that readers never see a partial file
+    table = _to_arrow(table)
+    if metadata is not None:
+        table = table.replace_schema_metadata(metadata)
+    pq.write_table(table, path + '.tmp', compression='zstd')
+    os.replace(path + '.tmp', path)
+
+
+def write_entry_table(table, path, store='tsv'):
+    """
+    Write the organism or virus table
+    :param table: a DataFrame; the SEQ_ID_COLUMNS hold lists
+    :param path: the TSV path, e.g. outdir/organism_table.txt
+    :param store: 'tsv' or 'parquet' (written as outdir/organism_table.parquet with native list columns)
+    :return: None
+    """
+    if store == 'parquet':
+        _require_pyarrow()
+        _write_parquet(table, parquet_path(path))
+        if os.path.exists(path):
+            os.remove(path)
+    else:
+        # as in _write_parquet, so that the next pipeline stage never reads a partial table
+        table.to_csv(path + '.tmp', sep='\t', index=None)
+        os.replace(path + '.tmp', path)
+        if os.path.exists(parquet_path(path)):
+            os.remove(parquet_path(path))
+
+
+def read_entry_table(path, columns=None, organisms=None, exclude=None, taxdump=None, logger=None):
+    """
+    Read the organism or virus table, from its parquet version when there is one
+    :param path: the TSV or parquet path
+    :param columns: the columns to load (all by default)
+    :param organisms: keep only these organisms of an organism table, see select_organisms (e.g. ['Bacteria'])
+    :param exclude: leave out these organisms, see select_organisms (e.g. ['Bacilli'])
+    :param taxdump: the folder of NCBI's taxdump, for taxid and NCBI rank terms in organisms and exclude
+    :param logger: reports the organisms and exclude terms that match no organism
+    :return: a DataFrame with the SEQ_ID_COLUMNS as lists and all other columns as strings
+    """
+    # the selection is answered by the lineage index as a set of org codes, so no row is matched in Python
+    selected = select_organisms(path, organisms, exclude, taxdump, logger) if organisms is not None or exclude else None
+    if path.endswith('.parquet') or not os.path.exists(path):
+        _require_pyarrow()
+        dataset = ds.dataset(parquet_path(path), format='parquet')
+        row_filter = ds.field('org_code').isin(sorted(selected)) if selected is not None else None
+        return _to_pandas(dataset.to_table(columns=columns, filter=row_filter))
+    usecols = None if columns is None else list(dict.fromkeys(columns + (['org_code'] if selected is not None else [])))
+    table = pd.read_csv(path, sep='\t', header=0, dtype=str, usecols=usecols)
+    for column in SEQ_ID_COLUMNS:
+        if column in table.columns:
+            table[column] = table[column].apply(parse_id_list)
+    if selected is not None:
+        table = table.loc[table['org_code'].isin(selected),:].reset_index(drop=True)
+    return table[columns] if columns is not None else table
+
+
+class GeneTableWriter:
+    """
+    Append the rows of a gene table to disk in chunks as they arrive, so that memory does not grow with the table.
+
+    The rows go to ``<path>.partial``; after every chunk its end offset is appended to ``<path>.partial.checkpoint``.
+    A new writer on the same path truncates the partial table to the last checkpoint and lists the genes already
+    written in ``done``, so an interrupted run resumes where it stopped. ``commit`` moves the table to ``path``.
+    The options that decide what the rows hold (``run``) head the checkpoint; a partial table written with other
+    options is discarded, and ``discarded`` is set, instead of being resumed.
+    """
+
+    def __init__(self, path, columns, chunk_rows=10000, run=None):
+        self.path = path
+        self.partial_file = path + '.partial'
+        self.checkpoint_file = self.partial_file + '.checkpoint'
+        self.columns = columns
+        self.chunk_rows = chunk_rows
+        self.done = set()
+        self.discarded = False
+        self._rows = []
+        end_offset = None
+        if os.path.exists(self.partial_file) and os.path.exists(self.checkpoint_file):
+            written_run = None
+            with open(self.checkpoint_file) as fid:
+                for line in fid:
+                    if not line.endswith('\n'):
+                        # the last line was cut off in the middle of writing
+                        break
+                    if line.startswith('#'):
+                        written_run = json.loads(line[1:])
+                        continue
+                    end_offset = int(line.split('\t')[0])
+            with open(self.partial_file) as fid:
+                header = fid.readline()
+            if written_run != run or header != '\t'.join(columns) + '\n':
+                end_offset = None
+                self.discarded = True
+        if end_offset is None:
+            with open(self.partial_file, 'w') as out_handle:
+                out_handle.write('\t'.join(columns) + '\n')
+                end_offset = out_handle.tell()
+            with open(self.checkpoint_file, 'w') as out_handle:
+                if run is not None:
+                    out_handle.write(f"#{json.dumps(run, sort_keys=True)}\n")
+                out_handle.write(f"{end_offset}\t0\n")
+        else:
+            with open(self.partial_file, 'r+') as out_handle:
+                out_handle.truncate(end_offset)
+            for df in pd.read_csv(self.partial_file, sep='\t', header=0, dtype=str, usecols=['kegg_gene_id'], chunksize=100000):
+                self.done.update(df['kegg_gene_id'])
+        self._out_handle = open(self.partial_file, 'a')
+        self._checkpoint_handle = open(self.checkpoint_file, 'a')
+
+    def add(self, rows):
+        """
+        :param rows: tuples in the order of the columns; the first one is the kegg_gene_id
+        :return: None
+        """
+        self._rows.extend(rows)
+        if len(self._rows) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        pd.DataFrame(self._rows, columns=self.columns).to_csv(self._out_handle, sep='\t', index=None, header=False)
+        self._out_handle.flush()
+        os.fsync(self._out_handle.fileno())
+        # the checkpoint is written after the rows it covers are on disk
+        self._checkpoint_handle.write(f"{self._out_handle.tell()}\t{len(self._rows)}\n")
+        self._checkpoint_handle.flush()
+        self.done.update(x[0] for x in self._rows)
+        self._rows = []
+
+    def close(self):
+        self.flush()
+        self._out_handle.close()
+        self._checkpoint_handle.close()
+
+    def commit(self):
+        """
+        Write the remaining rows and move the partial table to its final path
+        :return: None
+        """
+        self.close()
+        os.replace(self.partial_file, self.path)
+        os.remove(self.checkpoint_file)
+
+
+def _partition_file(store_dir, org_code):
+    return os.path.join(store_dir, f"{PARTITIONING}={org_code}", 'part-0.parquet')
+
+
+def _table_digest(table):
+    return hashlib.sha1(pd.util.hash_pandas_object(table, index=False).values.tobytes()).hexdigest()
+
+
+def write_gene_partition(table, store_dir, org_code, digest=None):
+    """
+    Write the genes of one organism into the gene store
+    :param table: a DataFrame with (a subset of) the GENE_COLUMNS
+    :param store_dir: the gene store, e.g. outdir/kegg_gene_info.parquet
+    :param org_code: the partition the genes are written to (replaced if it exists)
+    :param digest: an optional checksum of the genes, kept in the parquet metadata (see partition_digest)
+    :return: None
+    """
+    _require_pyarrow()
+    partition = os.path.join(store_dir, f"{PARTITIONING}={org_code}")
+    if not os.path.exists(partition):
+        os.makedirs(partition)
+    _write_parquet(table[[x for x in GENE_COLUMNS if x in table.columns]], _partition_file(store_dir, org_code),
+                   metadata={b'sha1': digest.encode()} if digest is not None else None)
+
+
+def partition_digest(store_dir, org_code):
+    """
+    :return: the checksum a partition was written with, or None
+    """
+    partition_file = _partition_file(store_dir, org_code)
+    if not os.path.exists(partition_file):
+        return None
+    metadata = pq.read_schema(partition_file).metadata or dict()
+    return metadata[b'sha1'].decode() if b'sha1' in metadata else None
+
+
+def pack_gene_tables(gene_dir, store_dir, logger=None):
+    """
+    Copy the annotated gene tables written by the extractors into the gene store, and remove the partitions of the
+    organisms (or virus gene sets) whose gene tables are gone
+    :param gene_dir: the folder of <org_code>_kegg_genes.txt tables or the virus gene_table.txt
+    :param store_dir: the gene store
+    :param logger: logger
+    :return: the number of partitions written; tables older than their partition and unchanged virus gene sets are skipped
+    """
+    written = 0
+    # the partitions that still have a gene table
+    packed = set()
+    for gene_table_file in sorted(glob(os.path.join(gene_dir, '*.txt'))):
+        name = os.path.basename(gene_table_file)
+        if name.endswith('_kegg_genes.txt'):
+            org_code = name[:-len('_kegg_genes.txt')]
+            packed.add(org_code)
+            partition_file = _partition_file(store_dir, org_code)
+            if os.path.exists(partition_file) and os.path.getmtime(partition_file) >= os.path.getmtime(gene_table_file):
+                continue
+            table = pd.read_csv(gene_table_file, sep='\t', header=0, dtype=str, keep_default_na=False)
+            if 'koid' not in table.columns:
+                # not annotated yet
+                continue
+            write_gene_partition(table, store_dir, org_code)
+            written += 1
+        elif name == 'gene_table.txt':
+            # the virus genes are partitioned by their gene set (vg, vp)
+            partition_files = glob(_partition_file(store_dir, '*'))
+            if partition_files and min(os.path.getmtime(x) for x in partition_files) >= os.path.getmtime(gene_table_file):
+                packed.update(os.path.basename(os.path.dirname(x)).split('=', 1)[1] for x in partition_files)
+                continue
+            table = pd.read_csv(gene_table_file, sep='\t', header=0, dtype=str, keep_default_na=False)
+            for org_code, group in table.groupby(table['kegg_gene_id'].str.split(':').str[0]):
+                packed.add(org_code)
+                digest = _table_digest(group)
+                if partition_digest(store_dir, org_code) == digest:
+                    # the gene set did not change with the table; mark the partition as up to date
+                    os.utime(_partition_file(store_dir, org_code))
+                    continue
+                write_gene_partition(group, store_dir, org_code, digest=digest)
+                written += 1
+    removed = 0
+    for partition in sorted(glob(os.path.join(store_dir, f"{PARTITIONING}=*"))):
+        if os.path.basename(partition).split('=', 1)[1] not in packed:
+            shutil.rmtree(partition)
+            removed += 1
+    if logger is not None:
+        logger.info(f"{written} gene tables are packed into {store_dir}, {removed} partitions without a gene table are removed")
+    return written
+
+
+def read_gene_store(store_dir, columns=None, org_codes=None, row_filter=None):
+    """
+    Load genes from the gene store
+    :param store_dir: the gene store
+    :param columns: the columns to load, e.g. ['kegg_gene_id', 'koid']; only their column chunks are read
+    :param org_codes: the organisms to load; the other partitions are not opened
+    :param row_filter: an optional pyarrow.dataset expression pushed down to the scan, e.g. ds.field('koid') == 'ko:K00844'
+    :return: a DataFrame
+    """
+    _require_pyarrow()
+    dataset = ds.dataset(store_dir, format='parquet', partitioning=ds.partitioning(pa.schema([(PARTITIONING, pa.string())]), flavor='hive'))
+    if org_codes is not None:
+        org_filter = ds.field(PARTITIONING).isin(list(org_codes))
+        row_filter = org_filter if row_filter is None else org_filter & row_filter
+    return _to_pandas(dataset.to_table(columns=columns, filter=row_filter))
+
+
+def add_store_arguments(parser):
+    parser.add_argument("--store", type=str, choices=['tsv', 'parquet'], default='tsv',
+                        help="Write the organism/virus table as TSV or parquet; parquet also packs the annotated gene tables into <outdir>/kegg_gene_info.parquet, partitioned by organism")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--outdir", type=str, help="An output folder of extract_kegg_organism_data.py or extract_kegg_virus_data.py to convert to parquet")
+    args = parser.parse_args()
+
+    for name in ['organism_table.txt', 'virus_table.txt']:
+        path = os.path.join(args.outdir, name)
+        if os.path.exists(path):
+            write_entry_table(read_entry_table(path), path, store='parquet')
+            print(f"{path} is converted to {parquet_path(path)}")
+    gene_dir = os.path.join(args.outdir, 'kegg_gene_info')
+    if os.path.exists(gene_dir):
+        print(f"{pack_gene_tables(gene_dir, gene_dir + '.parquet')} gene tables are packed into {gene_dir}.parquet")
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+import os
+import sys
+import socket
+import sqlite3
+import threading
+import time
+import argparse
+
+PENDING, LEASED, DONE, FAILED = 'pending', 'leased', 'done', 'failed'
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    """
+    A job queue in one SQLite file that any number of processes, on one host or on hosts sharing a filesystem, work off.
+
+    A worker claims jobs with a lease of ``lease`` seconds and keeps it alive with a heartbeat thread while it works
+    on them. A job whose lease expires (its worker crashed or lost the filesystem) is claimed again by another worker.
+    A failed job goes back to the queue until it has been tried ``max_attempts`` times. The file uses a rollback
+    journal rather than WAL, which needs shared memory between the processes, so only POSIX file locks are needed.
+    """
+
+    def __init__(self, path, lease=600, max_attempts=3, worker_id=None):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.worker_id = worker_id if worker_id is not None else default_worker_id()
+        self.held = set()
+        self._lock = threading.Lock()
+        self._heartbeat = None
+        self._stop = threading.Event()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=DELETE')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS jobs (key TEXT PRIMARY KEY, state TEXT, worker TEXT, lease_until REAL, attempts INTEGER, error TEXT, updated REAL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)')
+
+    def _transaction(self, statements):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers never claim the same job
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = statements(self._conn)
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            return result
+
+    def add(self, keys):
+        """
+        Enqueue jobs; keys that are already in the queue keep their state
+        :param keys: e.g. KEGG organism codes
+        :return: the number of jobs added
+        """
+        now = time.time()
+        rows = [(x, PENDING, 0, now) for x in keys]
+        return self._transaction(lambda conn: conn.executemany('INSERT OR IGNORE INTO jobs (key, state, attempts, updated) VALUES (?, ?, ?, ?)', rows).rowcount)
+
+    def claim(self, n=1):
+        """
+        Lease the next pending jobs, or jobs whose lease expired
+        :param n: the number of jobs to claim
+        :return: a list of keys, empty when there is nothing left to claim
+        """
+        def _claim(conn):
+            now = time.time()
+            # jobs whose worker died on their last attempt
+            conn.execute('UPDATE jobs SET state = ?, error = ?, updated = ? WHERE state = ? AND lease_until < ? AND attempts >= ?',
+                         (FAILED, 'the lease expired', now, LEASED, now, self.max_attempts))
+            keys = [x[0] for x in conn.execute('SELECT key FROM jobs WHERE (state = ? OR (state = ? AND lease_until < ?)) AND attempts < ? ORDER BY rowid LIMIT ?',
+                                               (PENDING, LEASED, now, self.max_attempts, n))]
+            conn.executemany('UPDATE jobs SET state = ?, worker = ?, lease_until = ?, attempts = attempts + 1, updated = ? WHERE key = ?',
+                             [(LEASED, self.worker_id, now + self.lease, now, x) for x in keys])
+            return keys
+        keys = self._transaction(_claim)
+        with self._lock:
+            self.held.update(keys)
+        return keys
+
+    def _finish(self, key, state, error=None):
+        # state is an SQL expression, so that the attempts are checked in the same transaction
+        def _update(conn):
+            # a job whose lease expired and was claimed by another worker is left to that worker
+            return conn.execute(f"UPDATE jobs SET state = {state}, error = ?, updated = ? WHERE key = ? AND state = ? AND worker = ?",
+                                (error, time.time(), key, LEASED, self.worker_id)).rowcount
+        with self._lock:
+            self.held.discard(key)
+        return self._transaction(_update) == 1
+
+    def complete(self, key):
+        """
+        :param key: a job held by this worker
+        :return: False when the lease was lost to another worker
+        """
+        return self._finish(key, f"'{DONE}'")
+
+    def fail(self, key, error=None):
+        """
+        Give a job back; it is retried until it has been tried max_attempts times
+        :param key: a job held by this worker
+        :param error: the reason, kept in the queue
+        :return: False when the lease was lost to another worker
+        """
+        return self._finish(key, f"CASE WHEN attempts >= {int(self.max_attempts)} THEN '{FAILED}' ELSE '{PENDING}' END", error)
+
+    def requeue(self, keys, error=None):
+        """
+        Put jobs back to pending, with a fresh count of attempts, e.g. after a merge found their output missing
+        :param keys: the job keys
+        :param error: the reason, kept in the queue
+        :return: None
+        """
+        now = time.time()
+        self._transaction(lambda conn: conn.executemany('UPDATE jobs SET state = ?, worker = NULL, attempts = 0, error = ?, updated = ? WHERE key = ?',
+                                                        [(PENDING, error, now, x) for x in keys]))
+
+    def renew(self):
+        """
+        Extend the leases of the jobs this worker holds
+        :return: None
+        """
+        with self._lock:
+            held = list(self.held)
+        if held:
+            until = time.time() + self.lease
+            self._transaction(lambda conn: conn.executemany('UPDATE jobs SET lease_until = ? WHERE key = ? AND state = ? AND worker = ?',
+                                                            [(until, x, LEASED, self.worker_id) for x in held]))
+
+    def start_heartbeat(self, interval=None):
+        """
+        Renew the leases in a background thread, every third of the lease by default
+        :param interval: the seconds between two renewals
+        :return: None
+        """
+        interval = interval if interval is not None else self.lease / 3
+
+        def _beat():
+            while not self._stop.wait(interval):
+                self.renew()
+
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=_beat, daemon=True)
+        self._heartbeat.start()
+
+    def stop_heartbeat(self):
+        if self._heartbeat is not None:
+            self._stop.set()
+            self._heartbeat.join()
+            self._heartbeat = None
+
+    def jobs(self, state=None):
+        """
+        :param state: only the jobs in this state
+        :return: a list of (key, state, worker, attempts, error)
+        """
+        query = 'SELECT key, state, worker, attempts, error FROM jobs'
+        with self._lock:
+            if state is not None:
+                return self._conn.execute(query + ' WHERE state = ? ORDER BY rowid', (state,)).fetchall()
+            return self._conn.execute(query + ' ORDER BY rowid').fetchall()
+
+    def counts(self):
+        counts = {x: 0 for x in [PENDING, LEASED, DONE, FAILED]}
+        with self._lock:
+            counts.update(self._conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+        return counts
+
+    def summary(self):
+        counts = self.counts()
+        return f"{sum(counts.values())} jobs: {counts[DONE]} done, {counts[LEASED]} leased, {counts[PENDING]} pending, {counts[FAILED]} failed"
+
+    def close(self):
+        self.stop_heartbeat()
+        self._conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queue", type=str, help="The queue file, e.g. <outdir>/organism_queue.sqlite")
+    parser.add_argument("--requeue_failed", action='store_true', help="Put the jobs that failed max_attempts times back to pending")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.queue):
+        print(f"Error: {args.queue} does not exist", flush=True)
+        sys.exit(1)
+    queue = WorkQueue(args.queue)
+    if args.requeue_failed:
+        queue.requeue([x[0] for x in queue.jobs(FAILED)])
+    print(queue.summary())
+    for key, state, worker, attempts, error in queue.jobs():
+        if state != DONE:
+            print('\t'.join([key, state, worker or '', str(attempts), error or '']))
+    queue.close()
@@ -0,0 +1,92 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts'))
+from convert_table_to_fasta import convert_table_to_FASTA, update_table_to_FASTA, convert_file, OUT_NAMES
+from convert_benchmark import render_fixture_tables
+from fasta_index import FastaIndex
+
+test_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_data', 'output')
+
+
+def _convert(file_names, out_dir, processes, chunksize=100000):
+    out_files = [os.path.join(str(out_dir), x) for x in OUT_NAMES]
+    convert_table_to_FASTA(file_names, *out_files, processes=processes, chunksize=chunksize)
+    results = []
+    for x in out_files:
+        with open(x) as fid:
+            results.append(fid.read())
+    return results
+
+
+def test_convert_table_to_FASTA(tmp_path):
+    table = tmp_path / 'eco_kegg_genes.txt'
+    table.write_text('kegg_gene_id\tdesc\tkoid\taaseq\tntseq\n'
+                     'eco:b0001\tthrL\tko:K08278\tMKR\tATGAAACGC\n'
+                     'eco:b0002\tunknown\t\tMRV\tATGCGAGTG\n'
+                     'eco:b0003\tno sequence\t\t\t\n')
+    aa_ko, aa_no_ko, nt_ko, nt_no_ko = _convert([str(table)], tmp_path, processes=1)
+    assert aa_ko == '>eco:b0001|thrL|ko:K08278\nMKR\n'
+    assert aa_no_ko == '>eco:b0002|unknown|\nMRV\n'
+    assert nt_ko == '>eco:b0001|thrL|ko:K08278\nATGAAACGC\n'
+    # the No KO nucleotide file holds the nucleotide sequence
+    assert nt_no_ko == '>eco:b0002|unknown|\nATGCGAGTG\n'
+
+
+def test_parallel_order(tmp_path):
+    table_dir = tmp_path / 'tables'
+    table_dir.mkdir()
+    file_names = render_fixture_tables(test_data, str(table_dir), genes_per_table=300)
+    (tmp_path / 'serial').mkdir()
+    (tmp_path / 'parallel').mkdir()
+    serial = _convert(file_names, tmp_path / 'serial', processes=1)
+    assert _convert(file_names, tmp_path / 'parallel', processes=3) == serial
+    # the records are written a chunk of rows at a time, from the workers through spool files that are removed again
+    (tmp_path / 'chunked').mkdir()
+    assert _convert(file_names, tmp_path / 'chunked', processes=1, chunksize=7) == serial
+    assert _convert(file_names, tmp_path / 'chunked', processes=3, chunksize=7) == serial
+    assert sorted(os.listdir(tmp_path / 'chunked')) == sorted(OUT_NAMES + [x + '.idx' for x in OUT_NAMES])
+    for x in OUT_NAMES:
+        index = FastaIndex(str(tmp_path / 'chunked' / x))
+        assert len(index) == serial[OUT_NAMES.index(x)].count('>')
+        index.close()
+    with open(os.path.join(test_data, OUT_NAMES[0])) as fid:
+        assert sorted(serial[0].splitlines()) == sorted(fid.read().splitlines())
+
+
+def test_update_table_to_FASTA(tmp_path):
+    table_dir = tmp_path / 'tables'
+    table_dir.mkdir()
+    file_names = render_fixture_tables(test_data, str(table_dir), genes_per_table=200)
+    out_files = [str(tmp_path / x) for x in OUT_NAMES]
+    manifest = str(tmp_path / 'convert_manifest.json')
+    assert update_table_to_FASTA(file_names, *out_files, manifest) == (len(file_names), 0)
+    assert update_table_to_FASTA(file_names, *out_files, manifest) == (0, 0)
+
+    # remove a table, change one, touch one without changing it and add a new one
+    removed, changed, touched = file_names[1], file_names[3], file_names[4]
+    os.remove(removed)
+    with open(changed) as fid:
+        lines = fid.readlines()
+    with open(changed, 'w') as fid:
+        fid.writelines(lines[:50])
+    os.utime(touched, ns=(0, 0))
+    added = str(table_dir / 'zzz_kegg_genes.txt')
+    with open(added, 'w') as fid:
+        fid.writelines([lines[0]] + [x.replace('\t', '_new\t', 1) for x in lines[60:80]])
+    file_names = sorted([x for x in file_names if x != removed] + [added])
+    assert update_table_to_FASTA(file_names, *out_files, manifest, processes=2) == (2, 1)
+
+    (tmp_path / 'full').mkdir()
+    full = _convert(file_names, tmp_path / 'full', processes=1)
+    appended = [x + y for x, y in zip(convert_file(changed), convert_file(added))]
+    for out_file, expected, tail in zip(out_files, full, appended):
+        with open(out_file) as fid:
+            text = fid.read()
+        # the same records, with those of the changed and the new table at the end
+        assert sorted(text.splitlines()) == sorted(expected.splitlines())
+        assert text.endswith(tail)
+        index = FastaIndex(out_file)
+        headers = [x[1:] for x in text.splitlines() if x.startswith('>')]
+        assert len(index) == len(headers)
+        assert ''.join(index.get(x.split('|')[0]) for x in headers) == text
+        index.close()
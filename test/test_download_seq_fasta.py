@@ -0,0 +1,70 @@
+import os
+import sys
+import logging
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts'))
+import download_seq_fasta
+from download_seq_fasta import read_checkpoint, download_seqs, _write_fasta_chunks
+from mock_services import MockServices, render_fixtures
+
+
+def test_write_fasta_chunks(tmp_path):
+    # the empty lines between records are dropped, also when a chunk boundary falls between the two newlines
+    with open(tmp_path / 'out.fasta', 'wb') as out_handle:
+        size = _write_fasta_chunks([b'>a\nACGT\n', b'\n>b\nAC', b'GT\n\n'], out_handle)
+    assert size == 18
+    assert (tmp_path / 'out.fasta').read_text() == '>a\nACGT\n>b\nACGT\n'
+
+
+def test_read_checkpoint(tmp_path):
+    outfile = str(tmp_path / 'seqs.fasta')
+    assert read_checkpoint(outfile) == set()
+    with open(outfile, 'w') as fid:
+        fid.write('>A1.1 one\nAC\n>B1.1 two\nGT\n>C1.1 cut')
+    with open(f"{outfile}.checkpoint", 'w') as fid:
+        fid.write('13\tA1\n26\tB1\n39\tC1')
+    # the last checkpoint line was cut off, so its batch is dropped from the output and downloaded again
+    assert read_checkpoint(outfile) == {'A1', 'B1'}
+    with open(outfile) as fid:
+        assert fid.read() == '>A1.1 one\nAC\n>B1.1 two\nGT\n'
+    # an output without checkpoint: the accessions are taken from the headers
+    os.remove(f"{outfile}.checkpoint")
+    assert read_checkpoint(outfile) == {'A1.1', 'A1', 'B1.1', 'B1'}
+    # a checkpoint left without its output is dropped, rather than appended to
+    os.remove(outfile)
+    with open(f"{outfile}.checkpoint", 'w') as fid:
+        fid.write('13\tA1\n')
+    assert read_checkpoint(outfile) == set()
+    assert not os.path.exists(f"{outfile}.checkpoint")
+
+
+def test_download_seqs_resume(tmp_path, monkeypatch):
+    fixtures = render_fixtures(n_organisms=2, n_viruses=2)
+    accessions = sorted(fixtures.genomes)
+    services = MockServices(fixtures).start()
+    monkeypatch.setattr(download_seq_fasta, 'EFETCH_LINK', services.link('ncbi') + '/efetch.fcgi')
+    outfile = str(tmp_path / 'seqs.fasta')
+    logger = logging.getLogger(__name__)
+    try:
+        assert download_seqs(accessions[:2], outfile, threads=2, batch_size=1, logger=logger) == []
+        # a crash in the middle of the next batch leaves part of a record behind
+        with open(outfile, 'a') as fid:
+            fid.write('>partial record\nACG')
+        # the accessions already written are not downloaded again
+        for accession in accessions[:2]:
+            del fixtures.genomes[accession]
+        assert download_seqs(accessions, outfile, threads=2, batch_size=2, logger=logger) == []
+        assert download_seqs(accessions + ['XX000000'], outfile, threads=2, batch_size=2, logger=logger) == ['XX000000']
+        # an accession that efetch leaves out of a batch is not checkpointed, but tried on its own and reported
+        other = str(tmp_path / 'other.fasta')
+        assert download_seqs([accessions[2], 'XX000001'], other, batch_size=2, logger=logger) == ['XX000001']
+        assert read_checkpoint(other) == {accessions[2], accessions[2] + '.1'}
+    finally:
+        services.shutdown()
+
+    with open(outfile) as fid:
+        headers = [line[1:].split('.')[0] for line in fid if line.startswith('>')]
+    assert sorted(headers) == accessions
+    assert '\n\n' not in open(outfile).read()
+    assert not [x for x in os.listdir(tmp_path) if x.endswith('.tmp')]
+    with open(f"{outfile}.checkpoint") as fid:
+        assert 'XX000000' not in fid.read()
@@ -0,0 +1,111 @@
+import os
+import sys
+import json
+import logging
+import subprocess
+from glob import glob
+import pandas as pd
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts'))
+from kegg_client import FetchResult
+from mock_services import MockServices, render_fixtures
+from table_store import read_entry_table
+from extract_kegg_organism_data import extract_organism_info, process_organism_page, fetch_organism_info, write_gene_table
+
+
+def organism_page(taxid, genbank, refseq):
+    return (f"<table><tr><td>Taxonomy</td><td><a href=\"https://www.ncbi.nlm.nih.gov/Taxonomy/Browser/wwwtax.cgi?id={taxid}\">{taxid}</a></td></tr>\n"
+            f"<tr><td>Chromosome</td><td><a href=\"https://www.ncbi.nlm.nih.gov/nuccore/{genbank}\">{genbank}</a> "
+            f"<a href=\"https://www.genome.jp/dbget-bin/www_bget?refseq:{refseq}\"><b>{refseq}</b></a></td></tr></table>")
+
+
+class PageFetcher:
+    """
+    Answers the show_organism requests from a dict of pages; the organisms without a page fail
+    """
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.failed = []
+        self.requested = []
+
+    def fetch_all(self, items):
+        self.failed = []
+        for key, url in items:
+            self.requested.append(key)
+            if key in self.pages:
+                yield FetchResult(key, url, 200, self.pages[key], None, 0.0)
+            else:
+                self.failed.append((key, url))
+
+
+def test_extract_organism_info():
+    assert extract_organism_info(organism_page(511145, 'U00096', 'NC_000913')) == ('511145', ['U00096'], ['NC_000913'])
+    assert extract_organism_info('<html>no links</html>') == (None, [], [])
+    row = process_organism_page(FetchResult('eco', 'url', 200, organism_page(511145, 'U00096', 'NC_000913'), None, 0.0))
+    assert row == ('eco', '511145', ['U00096'], ['NC_000913'])
+    assert process_organism_page(FetchResult('eco', 'url', 404, '', None, 0.0)) is None
+
+
+def test_fetch_organism_info_failed_pages(tmp_path):
+    partial_file = str(tmp_path / 'organism_table.txt.partial')
+    pages = {'eco': organism_page(511145, 'U00096', 'NC_000913')}
+    fetcher = PageFetcher(pages)
+    organism_info, failed = fetch_organism_info(['eco', 'hsa'], partial_file, fetcher, logging.getLogger(__name__))
+    # the failed page is reported and not written, so it is fetched again from the partial file
+    assert failed == ['hsa']
+    assert list(organism_info['org_code']) == ['eco']
+    assert organism_info['rs_ncbi_seq_ids'][0] == ['NC_000913']
+
+    pages['hsa'] = organism_page(9606, 'CM000663', 'NC_000001')
+    fetcher = PageFetcher(pages)
+    organism_info, failed = fetch_organism_info(['eco', 'hsa'], partial_file, fetcher, logging.getLogger(__name__))
+    assert failed == []
+    assert fetcher.requested == ['hsa']
+    assert dict(zip(organism_info['org_code'], organism_info['taxaid'])) == {'eco': '511145', 'hsa': '9606'}
+    # rows of organisms that are not requested any more are left out
+    organism_info, _ = fetch_organism_info(['hsa'], partial_file, PageFetcher(pages), logging.getLogger(__name__))
+    assert list(organism_info['org_code']) == ['hsa']
+
+
+def test_write_gene_table_sync(tmp_path):
+    gene_table_file = str(tmp_path / 'eco_kegg_genes.txt')
+    infile = pd.DataFrame({'kegg_gene_id': ['eco:b0001', 'eco:b0002'], 'desc': ['thrL', 'thrA'],
+                           'koid': ['ko:K08278', 'ko:K12524'], 'aaseq': ['MKR', 'MRV'], 'ntseq': ['ATG', 'ATG']})
+    # --ko_only: the KO link of eco:b0001 is gone from the new release, and the sequences are kept
+    rows = [(x, None, None, None) for x in infile['kegg_gene_id']]
+    write_gene_table(gene_table_file, infile, rows, {'eco:b0002': 'ko:K00003'}, columns=('koid',))
+    table = pd.read_csv(gene_table_file, sep='\t', dtype=str, keep_default_na=False)
+    assert table[['koid', 'aaseq']].values.tolist() == [['', 'MKR'], ['ko:K00003', 'MRV']]
+
+
+def test_sync(tmp_path):
+    fixtures = render_fixtures(n_organisms=2, n_viruses=1)
+    for org_code in ['aaa', 'zaab']:
+        fixtures.paths[f"/list/{org_code}"] = ''.join(fixtures.paths[f"/list/{org_code}"].splitlines(keepends=True)[:3])
+    services = MockServices(fixtures).start()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts', 'extract_kegg_organism_data.py')
+    command = [sys.executable, script, '--outdir', str(tmp_path), '--organisms', 'Bacteria', '--rate', '50', '--max_rate', '100']
+    env = {**os.environ, **services.environment()}
+    try:
+        subprocess.run(command, env=env, check=True, capture_output=True)
+        # zaab gets a new genome with another taxid under the same page URL, one aaa gene changes and one is removed
+        fixtures.paths['/list/organism'] = fixtures.paths['/list/organism'].replace('T00002\tzaab', 'T09999\tzaab')
+        fixtures.pages['zaab'] = fixtures.pages['zaab'].replace('397945', '12345')
+        changed, kept, removed = [x.split('\t')[0] for x in fixtures.paths['/list/aaa'].splitlines()]
+        fixtures.paths['/list/aaa'] = ''.join(fixtures.paths['/list/aaa'].replace(f"{changed}\t", f"{changed}\tupdated; ").splitlines(keepends=True)[:2])
+        desc, _, aaseq, ntseq, taxaid = fixtures.genes[changed]
+        fixtures.genes[changed] = ('updated; ' + desc, 'ko:K99999', aaseq, ntseq, taxaid)
+        subprocess.run(command + ['--sync'], env=env, check=True, capture_output=True)
+    finally:
+        services.shutdown()
+
+    # the changed page is downloaded again instead of being replayed from the response cache
+    organism_table = read_entry_table(str(tmp_path / 'organism_table.txt'))
+    assert dict(zip(organism_table['org_code'], organism_table['taxaid'].astype(str))) == {'aaa': '397945', 'zaab': '12345'}
+    genes = pd.read_csv(tmp_path / 'kegg_gene_info' / 'aaa_kegg_genes.txt', sep='\t', dtype=str)
+    assert sorted(genes['kegg_gene_id']) == sorted([changed, kept])
+    assert genes.set_index('kegg_gene_id').loc[changed, 'koid'] == 'ko:K99999'
+    with open(glob(str(tmp_path / 'sync_manifest_*.json'))[0]) as fid:
+        manifest = json.load(fid)
+    assert manifest['entries']['organisms']['changed'] == ['zaab']
+    assert manifest['genes']['aaa'] == {'added': [], 'removed': [removed], 'changed': [changed]}
@@ -0,0 +1,36 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts'))
+from convert_table_to_fasta import convert_table_to_FASTA, OUT_NAMES
+from convert_benchmark import render_fixture_tables
+from fasta_index import FastaIndex, build_fasta_index, index_path
+
+test_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_data', 'output')
+
+
+def test_fasta_index(tmp_path):
+    table_dir = tmp_path / 'tables'
+    table_dir.mkdir()
+    file_names = render_fixture_tables(test_data, str(table_dir))
+    out_files = [str(tmp_path / x) for x in OUT_NAMES]
+    convert_table_to_FASTA(file_names, *out_files)
+    for out_file in out_files:
+        with open(out_file) as fid:
+            text = fid.read()
+        headers = [x[1:] for x in text.splitlines() if x.startswith('>')]
+        index = FastaIndex(out_file)
+        assert len(index) == len(headers)
+        assert ''.join(index.get(x.split('|')[0]) for x in headers) == text
+        for ko in {x.split('|')[-1] for x in headers if x.split('|')[-1]}:
+            gene_ids = [x.split('|')[0] for x in headers if x.split('|')[-1] == ko]
+            assert index.gene_ids_for_ko(ko) == gene_ids
+            assert index.records_for_ko(ko[len('ko:'):]) == ''.join(index.get(x) for x in gene_ids)
+        assert 'aaa:Acav_9999' not in index
+        assert index.records_for_ko('K99999') == ''
+        index.close()
+        # indexing the written file gives the same index
+        with open(index_path(out_file), 'rb') as fid:
+            written = fid.read()
+        build_fasta_index(out_file, block_size=4096)
+        with open(index_path(out_file), 'rb') as fid:
+            assert fid.read() == written
@@ -1,5 +1,37 @@
+import os
+import sys
 import subprocess
 import networkx as nx
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts'))
+from get_ko_hierarchy import HierarchyBuilder, organize_hierarchy, render_fixture_hierarchy, brite_id_mapping, strip_brackets
+
+hierarchy_json = {'name': 'ko00001', 'children': [
+    {'name': '09100 Metabolism', 'children': [
+        {'name': '09101 Carbohydrate metabolism', 'children': [
+            {'name': '00010 Glycolysis / Gluconeogenesis [PATH:ko00010]', 'children': [
+                {'name': 'K00844 HK; hexokinase [EC:2.7.1.1]'},
+                {'name': 'K12407 GCK; glucokinase [EC:2.7.1.2]'}]}]}]}]}
+
+
+def test_organize_hierarchy():
+    assert strip_brackets('K00844 HK; hexokinase [EC:2.7.1.1]') == 'K00844 HK; hexokinase'
+    assert organize_hierarchy(hierarchy_json, regex=r'^K\d{5} ')['K00844'] == 'ko00001|09100 Metabolism|09101 Carbohydrate metabolism|00010 Glycolysis / Gluconeogenesis|K00844 HK; hexokinase'
+    builder = HierarchyBuilder()
+    assert builder.add_hierarchy({'name': 'br08901', 'children': [{'name': 'Metabolism', 'children': [{'name': '01100 Metabolic pathways'}]}]}) == 0
+    assert builder.add_hierarchy(hierarchy_json) == 2
+
+
+def test_hierarchy_builder(tmp_path):
+    edge_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data', 'kegg_ko_edge_df_br:ko00001.txt')
+    fixture_json, brite_list = render_fixture_hierarchy(edge_file)
+    builder = HierarchyBuilder(id_mapping=brite_id_mapping(brite_list))
+    # the same hierarchy twice: every edge is kept once
+    builder.add_hierarchy(fixture_json, order=0)
+    builder.add_hierarchy(fixture_json, order=1)
+    builder.build()
+    builder.write_edge_list(str(tmp_path / 'edges.txt'))
+    with open(edge_file) as fid, open(str(tmp_path / 'edges.txt')) as out_fid:
+        assert sorted(out_fid) == sorted(fid)
 
 
 def test_brite_subtree():
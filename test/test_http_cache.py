@@ -0,0 +1,41 @@
+import os
+import sys
+import time
+import zlib
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts'))
+from http_cache import ResponseCache
+
+
+def test_cache_ttl_and_offline(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'), ttl=60)
+    cache.put('http://rest.kegg.jp/list/brite', 200, 'br:ko00001\tKEGG Orthology (KO)\n')
+    assert cache.get('http://rest.kegg.jp/list/brite').text == 'br:ko00001\tKEGG Orthology (KO)\n'
+    assert cache.get('http://rest.kegg.jp/list/organism') is None
+    cache.close()
+
+    # expired entries are downloaded again online, but still replayed offline
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'), ttl=0)
+    time.sleep(0.01)
+    assert cache.get('http://rest.kegg.jp/list/brite') is None
+    cache.close()
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'), ttl=0, offline=True)
+    assert cache.get('http://rest.kegg.jp/list/brite').status_code == 200
+    cache.delete('http://rest.kegg.jp/list/brite')
+    assert cache.get('http://rest.kegg.jp/list/brite') is None
+    cache.close()
+
+
+def test_cache_lru_eviction(tmp_path):
+    body = os.urandom(2000).hex()
+    size = len(zlib.compress(body.encode(), 6))
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'), max_bytes=int(3.5 * size))
+    for i in range(3):
+        cache.put(f"http://rest.kegg.jp/get/{i}", 200, body)
+        time.sleep(0.01)
+    # touch the oldest entry so that the second one is the least recently used
+    assert cache.get('http://rest.kegg.jp/get/0') is not None
+    cache.put('http://rest.kegg.jp/get/3', 200, body)
+    assert cache.get('http://rest.kegg.jp/get/1') is None
+    assert cache.get('http://rest.kegg.jp/get/0') is not None
+    assert cache.get('http://rest.kegg.jp/get/3') is not None
+    cache.close()
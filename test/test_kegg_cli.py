@@ -0,0 +1,83 @@
+import os
+import sys
+import subprocess
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts'))
+from kegg_cli import LazyModule, lazy_import
+from convert_table_to_fasta import convert_table_to_FASTA, OUT_NAMES
+from convert_benchmark import render_fixture_tables
+
+script_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts')
+test_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_data', 'output')
+# runs kegg-extract in a fresh interpreter and prints the heavy libraries it imported
+RUN = """
+import sys, multiprocessing
+multiprocessing.set_start_method(sys.argv[1])
+import kegg_cli
+try:
+    kegg_cli.main(sys.argv[2:])
+except SystemExit:
+    pass
+print(sorted(x for x in ['pandas', 'pyarrow', 'sourmash'] if x in sys.modules))
+"""
+
+
+# the same through the kegg_extract package, as installed; the scripts must not be importable as top-level modules
+RUN_PACKAGE = """
+import sys, multiprocessing
+multiprocessing.set_start_method(sys.argv[1])
+import kegg_extract
+from kegg_extract import metrics, kegg_client
+assert kegg_client.METRICS is metrics.METRICS
+try:
+    kegg_extract.main(sys.argv[2:])
+except SystemExit:
+    pass
+print('top-level:', sorted(x for x in ['metrics', 'kegg_cli', 'table_store', 'convert_table_to_fasta'] if x in sys.modules), flush=True)
+"""
+
+
+def run(args, start_method='spawn', package_dir=None):
+    code, path = (RUN, script_dir) if package_dir is None else (RUN_PACKAGE, package_dir)
+    result = subprocess.run([sys.executable, '-c', code, start_method] + args, capture_output=True, text=True, check=True,
+                            env=dict(os.environ, PYTHONPATH=path), cwd=path)
+    return result.stdout.splitlines()
+
+
+def test_lazy_import():
+    assert lazy_import('os') is os
+    assert lazy_import('no_such_module', optional=True) is None
+    sys.modules.pop('colorsys', None)
+    colorsys = lazy_import('colorsys')
+    assert isinstance(colorsys, LazyModule) and 'colorsys' not in sys.modules
+    assert colorsys.rgb_to_hsv(1, 0, 0) == (0, 1, 1) and 'colorsys' in sys.modules
+
+
+def test_kegg_cli(tmp_path):
+    # the help of kegg-extract and of its commands does not load the heavy libraries
+    for args in [['--help'], ['organisms', '--help'], ['fasta', '--help'], ['sketch', '--help']]:
+        assert run(args)[-1] == '[]'
+
+    # the FASTA conversion from the CLI, with workers started by spawn, as by fork
+    table_dir = tmp_path / 'tables'
+    table_dir.mkdir()
+    file_names = render_fixture_tables(test_data, str(table_dir), genes_per_table=100)
+    for name in file_names[3:]:
+        os.remove(name)
+    expected = [str(tmp_path / x) for x in OUT_NAMES]
+    convert_table_to_FASTA(file_names[:3], *expected)
+    for start_method in ['spawn', 'fork']:
+        out_dir = tmp_path / start_method
+        run(['fasta', '--gene_dir', str(table_dir), '--out_dir', str(out_dir), '--processes', '2', '--full'], start_method)
+        for name, path in zip(OUT_NAMES, expected):
+            with open(out_dir / name) as fid, open(path) as expected_fid:
+                assert fid.read() == expected_fid.read()
+
+    # the package imports its modules once, under the package name only
+    package_dir = tmp_path / 'site'
+    package_dir.mkdir()
+    os.symlink(os.path.abspath(script_dir), package_dir / 'kegg_extract')
+    out_dir = tmp_path / 'package'
+    assert run(['fasta', '--gene_dir', str(table_dir), '--out_dir', str(out_dir), '--processes', '2', '--full'], package_dir=str(package_dir)).count('top-level: []') == 1
+    for name, path in zip(OUT_NAMES, expected):
+        with open(out_dir / name) as fid, open(path) as expected_fid:
+            assert fid.read() == expected_fid.read()
@@ -0,0 +1,83 @@
+import os
+import sys
+import asyncio
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts'))
+from kegg_client import AsyncFetcher, PackingStats, pack_queries, _start_stand_in_server
+from rate_limit import AdaptiveTokenBucket, RetryPolicy
+
+
+def test_async_fetcher_stand_in_server():
+    server = _start_stand_in_server(latency=0.01)
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    items = [(i, f"{base}/get/eco:b{i:04d}+eco:b{i + 1:04d}") for i in range(50)]
+    fetcher = AsyncFetcher(concurrency=8)
+    results = list(fetcher.fetch(items))
+    server.shutdown()
+    assert sorted(result.key for result in results) == list(range(50))
+    assert all(result.status == 200 for result in results)
+    assert all(result.text.count('///') == 2 for result in results)
+    assert fetcher.stats.requests == 50
+    assert fetcher.stats.errors == 0
+
+
+def test_async_fetcher_retries_server_errors():
+    server = _start_stand_in_server(latency=0.0, error_rate=0.3)
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    items = [(i, f"{base}/get/eco:b{i:04d}") for i in range(50)]
+    fetcher = AsyncFetcher(concurrency=8, retry=RetryPolicy(max_retries=2, base_delay=0.01))
+    results = list(fetcher.fetch_all(items, passes=5))
+    server.shutdown()
+    assert fetcher.stats.retries > 0
+    # whatever failed every retry of every pass is kept for the caller, nothing is dropped silently
+    assert sorted([result.key for result in results] + [key for key, _ in fetcher.failed]) == list(range(50))
+
+
+def test_async_fetcher_items_off_event_loop():
+    server = _start_stand_in_server(latency=0.0)
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    loops = []
+
+    def _items():
+        for i in range(20):
+            # the items must not be produced on the event loop thread, where reading a table would stall every request
+            try:
+                loops.append(asyncio.get_running_loop())
+            except RuntimeError:
+                pass
+            yield i, f"{base}/get/eco:b{i:04d}"
+        raise ValueError("bad table")
+
+    fetcher = AsyncFetcher(concurrency=4)
+    results = []
+    with pytest.raises(ValueError):
+        for result in fetcher.fetch(_items()):
+            results.append(result)
+    server.shutdown()
+    assert not loops
+    assert sorted(result.key for result in results) == list(range(20))
+
+
+def test_adaptive_token_bucket():
+    bucket = AdaptiveTokenBucket(rate=10, max_rate=20)
+    bucket.update(429)
+    assert bucket.rate == 5
+    # a burst of in-flight failures only backs off once
+    bucket.update(503)
+    assert bucket.rate == 5
+    for _ in range(100):
+        bucket.update(200)
+    assert abs(bucket.rate - 10) < 1e-6
+    bucket.tokens = 0
+    assert 0 < bucket.reserve() <= 0.1
+
+
+def test_pack_queries_across_organisms():
+    stats = PackingStats()
+    groups = [('eco', [f"eco:b{i:04d}" for i in range(13)]), ('aaa', [f"aaa:Acav_{i:04d}" for i in range(14)])]
+    queries = list(pack_queries(groups, stats=stats))
+    assert [query.count('+') + 1 for query in queries] == [10, 10, 7]
+    assert queries[1].startswith('eco:b0010+eco:b0011+eco:b0012+aaa:Acav_0000')
+    assert stats.requests == 3
+    assert stats.unpacked_requests == 4
+    assert stats.ids == 27
@@ -0,0 +1,49 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts'))
+from kegg_flatfile import iter_lines, iter_records, parse_get_response, parse_link_response, iter_fasta, render_record, _parse_legacy, _parse_streaming
+
+response_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data', 'kegg_get_response.txt')
+
+
+def test_iter_records_fields():
+    with open(response_file) as fid:
+        records = list(iter_records(fid))
+    assert [record.entry for record in records] == ['b0001', 'b0005']
+    assert records[0].koid == 'ko:K08278'
+    assert records[1].koid is None
+    assert records[0].aaseq == 'MKRISTTITTTITITTGNGAG'
+    assert len(records[1].aaseq) == 98
+    assert len(records[1].ntseq) == 297
+    assert records[0].get('DBLINKS') == 'NCBI-GeneID: 944742\nNCBI-ProteinID: NP_414542\nUniProt: P0AD86'
+
+
+def test_parse_get_response_matches_legacy():
+    with open(response_file) as fid:
+        text = fid.read()
+    query = 'eco:b0001+eco:b0005'
+    assert _parse_streaming(query, text) == _parse_legacy(query, text)
+    # records are routed by ENTRY, so a gene that KEGG drops from the response does not shift the others
+    rows = list(parse_get_response('eco:b0001+eco:b0002+eco:b0005', text))
+    assert [kegg_gene_id for kegg_gene_id, _ in rows] == ['eco:b0001', 'eco:b0005']
+    assert list(iter_lines('a\nb\n')) == ['a', 'b']
+
+
+def test_parse_get_response_shared_entry():
+    # a packed query can hold genes of several organisms with the same ENTRY part
+    text = render_record('abc:0001', 'gene A', 'ko:K00001', 'MA', 'atg') + render_record('xyz:0001', 'gene X', 'ko:K00002', 'MC', 'atc')
+    rows = dict(parse_get_response('xyz:0001+abc:0001', text))
+    assert rows['abc:0001'].koid == 'ko:K00001'
+    assert rows['xyz:0001'].koid == 'ko:K00002'
+    # a missing record does not take the ENTRY of another organism's gene
+    rows = list(parse_get_response('xyz:0001+abc:0001', render_record('xyz:0001', 'gene X', 'ko:K00002', 'MC', 'atc')))
+    assert [kegg_gene_id for kegg_gene_id, _ in rows] == ['xyz:0001']
+
+
+def test_link_and_fasta_responses():
+    links = parse_link_response('eco:b0001\tko:K08278\neco:b0002\tko:K12524\neco:b0002\tko:K00003\n')
+    assert links == {'eco:b0001': 'ko:K08278', 'eco:b0002': 'ko:K12524'}
+    fasta = '>eco:b0001 K08278 thrL; thr operon leader peptide (A)\nMKRISTTITTTITITTGNGAG\n>eco:b0005 yaaX (A)\nMKKMQSIVLALSLVLVAPMAAQAAEITLVPSVKLQIGDRDNRGYYWDGGHWRDHGWWKQH\nYEWRGNRWHLHGPPPPPRHHKKAPHDHHGGHGPGKHHR\n'
+    records = dict(iter_fasta(fasta))
+    assert records['eco:b0001'] == 'MKRISTTITTTITITTGNGAG'
+    assert len(records['eco:b0005']) == 98
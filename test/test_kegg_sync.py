@@ -0,0 +1,26 @@
+import os
+import sys
+import json
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts'))
+from kegg_sync import parse_list_response, diff_listing, SyncManifest
+
+
+def test_diff_listing(tmp_path):
+    old = parse_list_response('eco:b0001\tthrL; thr operon leader peptide\neco:b0002\tthrA; aspartate kinase\neco:b0003\tthrB; homoserine kinase\n')
+    new = parse_list_response('eco:b0001\tthrL; thr operon leader peptide\neco:b0003\tthrB; homoserine kinase (updated)\neco:b0004\tthrC; threonine synthase\n')
+    added, removed, changed = diff_listing(old, new)
+    assert added == ['eco:b0004']
+    assert removed == ['eco:b0002']
+    assert changed == ['eco:b0003']
+
+    organisms = parse_list_response('T00007\teco\tEscherichia coli K-12 MG1655\tProkaryotes;Bacteria\n', key_column=1, value_column=0)
+    assert organisms == {'eco': 'T00007'}
+
+    manifest = SyncManifest()
+    manifest.add_entries('organisms', [], [], [])
+    manifest.add_genes('eco', added, removed, changed)
+    manifest.add_genes('aaa', [], [], [])
+    with open(manifest.write(str(tmp_path))) as fid:
+        data = json.load(fid)
+    assert list(data['genes']) == ['eco']
+    assert data['genes']['eco']['removed'] == ['eco:b0002']
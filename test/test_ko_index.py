@@ -0,0 +1,49 @@
+import os
+import sys
+import pytest
+import networkx as nx
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts'))
+from ko_index import KOHierarchyIndex, read_edge_list, write_index
+
+edge_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data', 'kegg_ko_edge_df_br:ko00001.txt')
+
+
+def test_ko00001_index(tmp_path):
+    write_index(str(tmp_path / 'index.bin'), *read_edge_list(edge_file))
+    index = KOHierarchyIndex(str(tmp_path / 'index.bin'))
+    with open(edge_file) as fid:
+        next(fid)
+        G = nx.read_edgelist(fid, delimiter='\t', nodetype=str, create_using=nx.DiGraph)
+    for ko in ['K00844', 'K12407', 'K25026']:
+        assert index.ancestors(ko) == nx.ancestors(G, ko)
+        assert index.root_paths(ko) == [nx.shortest_path(G, 'root', ko)[1:]]
+    assert index.descendants('09100 Metabolism') == nx.descendants(G, '09100 Metabolism')
+    assert index.is_ancestor('09100 Metabolism', 'K00845')
+    assert not index.is_ancestor('09160 Human Diseases', 'K00845')
+    assert index.lca(['K00845', 'K25026']) == '00524 Neomycin, kanamycin and gentamicin biosynthesis'
+    assert index.lca(['K00845', 'K12407']) == 'ko00001'
+    assert 'K99999' not in index
+    index.close()
+
+
+def test_dag_index(tmp_path):
+    # K00001 is in two BRITE hierarchies, and br2 is also nested inside br1
+    edges = [('root', 'br1'), ('root', 'br2'), ('br1', 'A'), ('A', 'K00001'), ('br1', 'br2'), ('br2', 'B'), ('B', 'K00001'), ('B', 'K00002')]
+    labels = sorted({x for edge in edges for x in edge})
+    write_index(str(tmp_path / 'index.bin'), [labels.index(x) for x, _ in edges], [labels.index(y) for _, y in edges], labels)
+    index = KOHierarchyIndex(str(tmp_path / 'index.bin'))
+    # the root paths are walked up from the node on demand, and come in the pre-order of the root
+    assert index.root_paths('K00001') == [['br1', 'A', 'K00001'], ['br1', 'br2', 'B', 'K00001'], ['br2', 'B', 'K00001']]
+    assert index.descendants('br1') == {'A', 'br2', 'B', 'K00001', 'K00002'}
+    assert index.is_ancestor('br1', 'K00002') and not index.is_ancestor('A', 'K00002')
+    assert index.ancestors('K00001') == {'root', 'br1', 'br2', 'A', 'B'}
+    assert sorted(index.parents('K00001')) == ['A', 'B']
+    assert index.lca(['K00001', 'K00002']) == 'B'
+    assert index.lca(['K00001', 'A']) == 'A'
+    index.close()
+
+
+def test_cycle(tmp_path):
+    labels = ['root', 'A', 'B']
+    with pytest.raises(Exception, match='cycle'):
+        write_index(str(tmp_path / 'index.bin'), [0, 1, 2], [1, 2, 1], labels)
@@ -0,0 +1,67 @@
+import os
+import sys
+import pandas as pd
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts'))
+from lineage_index import LineageIndex, lineage_index_path
+from table_store import write_entry_table, read_entry_table, select_organisms
+
+organism_table = pd.DataFrame({
+    'T_number': ['T00001', 'T00002', 'T00003', 'T00004', 'T00005'],
+    'org_code': ['bsu', 'sau', 'cac', 'eco', 'sce'],
+    'name': ['Bacillus subtilis 168', 'Staphylococcus aureus', 'Clostridium acetobutylicum', 'Escherichia coli K-12 MG1655', 'Saccharomyces cerevisiae'],
+    'lineage': ['Prokaryotes;Bacteria;Firmicutes - Bacilli;Bacillus', 'Prokaryotes;Bacteria;Firmicutes - Bacilli;Staphylococcus',
+                'Prokaryotes;Bacteria;Firmicutes - Clostridia;Clostridium', 'Prokaryotes;Bacteria;Gammaproteobacteria - Enterobacteria;Escherichia',
+                'Eukaryotes;Fungi;Ascomycetes;Saccharomycetes'],
+    'taxaid': ['224308', '1280', '1488', '511145', None],
+    'gb_ncbi_seq_id': [None] * 5,
+    'rs_ncbi_seq_ids': [['NC_000964'], ['NC_007795'], ['NC_003030'], ['NC_000913'], None],
+})
+
+# taxid, parent, rank, name of a corner of NCBI's taxonomy
+TAXONOMY = [
+    (1, 1, 'no rank', 'root'), (2, 1, 'superkingdom', 'Bacteria'), (1239, 2, 'phylum', 'Bacillota'),
+    (91061, 1239, 'class', 'Bacilli'), (186801, 1239, 'class', 'Clostridia'), (1386, 91061, 'genus', 'Bacillus'),
+    (224308, 1386, 'strain', 'Bacillus subtilis subsp. subtilis str. 168'), (1280, 91061, 'species', 'Staphylococcus aureus'),
+    (1488, 186801, 'species', 'Clostridium acetobutylicum'), (1224, 2, 'phylum', 'Pseudomonadota'), (511145, 1224, 'strain', 'Escherichia coli str. K-12 substr. MG1655'),
+]
+
+
+def write_taxdump(taxdump):
+    os.makedirs(taxdump)
+    with open(os.path.join(taxdump, 'nodes.dmp'), 'w') as fid:
+        fid.writelines(f"{taxid}\t|\t{parent}\t|\t{rank}\t|\t\t|\n" for taxid, parent, rank, _ in TAXONOMY)
+    with open(os.path.join(taxdump, 'names.dmp'), 'w') as fid:
+        for taxid, _, _, name in TAXONOMY:
+            fid.write(f"{taxid}\t|\t{name}\t|\t\t|\tscientific name\t|\n")
+            fid.write(f"{taxid}\t|\t{name} (synonym)\t|\t\t|\tsynonym\t|\n")
+
+
+def test_lineage_index(tmp_path, caplog):
+    path = str(tmp_path / 'organism_table.txt')
+    write_entry_table(organism_table, path)
+
+    # KEGG lineage levels, their parts and rank=name, case-insensitive; the index is cached next to the table
+    assert select_organisms(path, ['Firmicutes'], ['Bacilli']) == {'cac'}
+    assert os.path.exists(lineage_index_path(path))
+    assert select_organisms(path, ['Bacteria', 'fungi']) == {'bsu', 'sau', 'cac', 'eco', 'sce'}
+    assert select_organisms(path, ['group=Firmicutes - Bacilli']) == select_organisms(path, ['bacilli']) == {'bsu', 'sau'}
+    assert select_organisms(path, exclude=['Bacteria']) == {'sce'}
+    assert select_organisms(path, ['Archaea']) == set()
+    assert caplog.messages[-1] == "No organism matches Archaea"
+    # the organism's own taxid works without a taxdump, a subtree does not
+    assert select_organisms(path, ['1280']) == {'sau'}
+    assert select_organisms(path, ['taxid=1239']) == set()
+
+    # NCBI subtrees and ranks from a taxdump
+    taxdump = str(tmp_path / 'taxdump')
+    write_taxdump(taxdump)
+    assert select_organisms(path, ['1239'], ['taxid=91061'], taxdump=taxdump) == {'cac'}
+    assert select_organisms(path, ['phylum=Bacillota'], taxdump=taxdump) == select_organisms(path, ['Bacillota'], taxdump=taxdump) == {'bsu', 'sau', 'cac'}
+    assert select_organisms(path, ['taxid=2'], ['class=bacilli'], taxdump=taxdump) == {'cac', 'eco'}
+
+    # the cached index follows the table
+    write_entry_table(organism_table.iloc[:3], path)
+    assert select_organisms(path, ['Firmicutes']) == {'bsu', 'sau', 'cac'}
+    assert LineageIndex.load(lineage_index_path(path), path).select() == {'bsu', 'sau', 'cac'}
+    table = read_entry_table(path, columns=['rs_ncbi_seq_ids'], organisms=['Firmicutes'], exclude=['Clostridia'])
+    assert table['rs_ncbi_seq_ids'].tolist() == [['NC_000964'], ['NC_007795']]
@@ -0,0 +1,54 @@
+import os
+import sys
+import json
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts'))
+from metrics import Metrics, Progress, endpoint_of
+from rate_limit import alias_host
+
+
+def test_endpoint_of():
+    assert endpoint_of('http://rest.kegg.jp/get/eco:b0001+eco:b0002/aaseq') == 'rest.kegg.jp/get'
+    assert endpoint_of('https://www.genome.jp/kegg-bin/show_organism?org=eco') == 'www.genome.jp/show_organism'
+    alias_host('127.0.0.1:8899', 'eutils.ncbi.nlm.nih.gov')
+    assert endpoint_of('http://127.0.0.1:8899/entrez/eutils/efetch.fcgi') == 'eutils.ncbi.nlm.nih.gov/efetch.fcgi'
+
+
+def test_metrics_export(tmp_path):
+    metrics = Metrics(script='test')
+    for elapsed in [0.02, 0.02, 0.3]:
+        metrics.record_request('http://rest.kegg.jp/get/eco:b0001', 200, elapsed, 100)
+    metrics.record_request('http://rest.kegg.jp/get/eco:b0001', None, 1.5)
+    metrics.inc('http_retries_total', endpoint='rest.kegg.jp/get')
+    metrics.profile_dir = str(tmp_path / 'profile')
+    with metrics.stage('parse'):
+        sorted(range(1000))
+    metrics.inc('records_total', 10, stage='parse')
+    assert metrics.summary().split('\n')[0] == 'rest.kegg.jp/get: 4 requests (1 failed, 1 retried, 0.0 MB, 0 from the cache), latency p50 <= 0.025s, p95 <= 2.5s'
+    assert metrics.summary().split('\n')[1].startswith('stage parse: ')
+
+    metrics.write(str(tmp_path / 'metrics.prom'))
+    with open(str(tmp_path / 'metrics.prom')) as fid:
+        lines = fid.read().split('\n')
+    assert 'kegg_http_requests_total{script="test",endpoint="rest.kegg.jp/get",status="error"} 1' in lines
+    assert 'kegg_http_request_duration_seconds_bucket{script="test",endpoint="rest.kegg.jp/get",le="0.025"} 2' in lines
+    assert 'kegg_http_request_duration_seconds_bucket{script="test",endpoint="rest.kegg.jp/get",le="+Inf"} 4' in lines
+    assert 'kegg_http_request_duration_seconds_count{script="test",endpoint="rest.kegg.jp/get"} 4' in lines
+    metrics.write(str(tmp_path / 'metrics.json'))
+    with open(str(tmp_path / 'metrics.json')) as fid:
+        exported = json.load(fid)
+    assert {'name': 'records_total', 'labels': {'stage': 'parse'}, 'value': 10} in exported['counters']
+    assert exported['histograms'][0]['counts'][:3] == [0, 2, 0]
+
+    assert metrics.write_profiles() == [str(tmp_path / 'profile' / 'test_parse.pstats')]
+    assert os.path.exists(str(tmp_path / 'profile' / 'test_parse.txt'))
+
+
+def test_progress(capsys):
+    progress = Progress(total=1000, desc='genes')
+    progress.interval = 3600
+    for _ in range(1000):
+        progress.update()
+    progress.close()
+    progress.close()
+    lines = capsys.readouterr().out.strip().split('\n')
+    assert len(lines) == 1 and lines[0].startswith('genes: 1000/1000 (100.0%)')
@@ -0,0 +1,87 @@
+import os
+import sys
+import subprocess
+import requests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts'))
+from mock_services import MockServices, render_fixtures
+from kegg_flatfile import parse_get_response, parse_link_response
+from e2e_benchmark import find_regressions
+
+fixtures = render_fixtures(n_organisms=2, n_viruses=3)
+
+
+def test_mock_services():
+    services = MockServices(fixtures).start()
+    try:
+        kegg, genome, ncbi = [services.link(x) for x in ['kegg', 'genome', 'ncbi']]
+        assert requests.get(f"{kegg}/list/organism").text.split('\n')[1].split('\t')[1] == 'zaab'
+        res = requests.get(f"{kegg}/get/zaab:Acav_0001+vg:1000001+aaa:missing")
+        records = dict(parse_get_response('zaab:Acav_0001+vg:1000001+aaa:missing', res.text))
+        assert records['zaab:Acav_0001'].koid == 'ko:K02313'
+        assert records['vg:1000001'].taxaid == '10001'
+        assert 'aaa:missing' not in records
+        assert requests.get(f"{kegg}/get/aaa:missing").status_code == 404
+        assert parse_link_response(requests.get(f"{kegg}/link/ko/aaa").text)['aaa:Acav_0001'] == 'ko:K02313'
+        assert 'NC_000002' in requests.get(f"{genome}/kegg-bin/show_organism?org=zaab").text
+        res = requests.post(f"{ncbi}/efetch.fcgi", data={'db': 'nucleotide', 'id': 'NC_000001,AB900003', 'rettype': 'fasta', 'retmode': 'text'})
+        assert [x.split()[0] for x in res.text.split('\n') if x.startswith('>')] == ['>NC_000001.1', '>AB900003.1']
+        assert services.snapshot()['kegg']['requests'] == 4
+    finally:
+        services.shutdown()
+
+
+def test_mock_services_throttle():
+    services = MockServices(fixtures, rate=2).start()
+    try:
+        status = [requests.get(f"{services.link('kegg')}/list/brite").status_code for _ in range(4)]
+        assert status[:2] == [200, 200] and 403 in status[2:]
+        assert services.snapshot()['kegg']['throttled'] >= 1
+    finally:
+        services.shutdown()
+
+
+def test_get_ko_hierarchy_end_to_end(tmp_path):
+    services = MockServices(fixtures).start()
+    try:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts', 'get_ko_hierarchy.py')
+        subprocess.run([sys.executable, script, '--brite', 'ko00001', '--outdir', str(tmp_path), '--no_cache'],
+                       env={**os.environ, **services.environment()}, check=True, capture_output=True)
+    finally:
+        services.shutdown()
+    edge_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data', 'kegg_ko_edge_df_br:ko00001.txt')
+    with open(edge_file) as fid, open(str(tmp_path / 'kegg_ko_edge_df_br:ko00001.txt')) as out_fid:
+        assert sorted(out_fid) == sorted(fid)
+
+
+def test_get_ko_hierarchy_truncated_response(tmp_path):
+    truncated = render_fixtures(n_organisms=1, n_viruses=1)
+    complete = truncated.paths['/get/br:ko00001/json']
+    truncated.paths['/get/br:ko00001/json'] = complete[:len(complete) // 2]
+    services = MockServices(truncated).start()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts', 'get_ko_hierarchy.py')
+    command = [sys.executable, script, '--brite', 'ko00001', '--outdir', str(tmp_path)]
+    try:
+        # the edge list lacks the hierarchy, so the run fails
+        assert subprocess.run(command, env={**os.environ, **services.environment()}, capture_output=True).returncode == 1
+        # the truncated body is not replayed from the response cache
+        truncated.paths['/get/br:ko00001/json'] = complete
+        subprocess.run(command, env={**os.environ, **services.environment()}, check=True, capture_output=True)
+    finally:
+        services.shutdown()
+    edge_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data', 'kegg_ko_edge_df_br:ko00001.txt')
+    with open(edge_file) as fid, open(str(tmp_path / 'kegg_ko_edge_df_br:ko00001.txt')) as out_fid:
+        assert sorted(out_fid) == sorted(fid)
+
+
+def test_find_regressions():
+    def _run(wall_time, exit_code=0):
+        return {'time': '', 'commit': None, 'machine': 'test', 'params': {'organisms': 5},
+                'stages': {'get_ko_hierarchy': {'exit_code': exit_code, 'wall_time': wall_time, 'peak_rss_mb': 100, 'records': 25960}}}
+    assert find_regressions(_run(10), []) == ([], [])
+    history = [_run(10)]
+    assert find_regressions(_run(11), history)[1] == []
+    assert find_regressions(_run(13), history)[1] == ['get_ko_hierarchy: wall_time 10.00 -> 13.00 (+30%)']
+    assert find_regressions(_run(10, exit_code=1), history)[1] == ['get_ko_hierarchy failed with exit code 1']
+    # a slow run does not become the baseline, so a drift of less than 20% per run is still caught
+    history = [_run(10), _run(10), _run(11.5), _run(10, exit_code=1)]
+    assert find_regressions(_run(13), history)[1] == ['get_ko_hierarchy: wall_time 10.00 -> 13.00 (+30%)']
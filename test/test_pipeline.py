@@ -0,0 +1,110 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts'))
+from pipeline import Stage, Pipeline, DONE, SKIPPED, FAILED, BLOCKED
+
+# writes the table, then waits until a reader of the table has run before it writes the gene folder
+PRODUCER = """
+import os, sys, time
+out = sys.argv[1]
+with open(os.path.join(out, 'table.txt.tmp'), 'w') as fid:
+    fid.write('eco\\n')
+os.replace(os.path.join(out, 'table.txt.tmp'), os.path.join(out, 'table.txt'))
+for _ in range(200):
+    if os.path.exists(os.path.join(out, 'seqs.fasta')):
+        os.makedirs(os.path.join(out, 'genes'), exist_ok=True)
+        open(os.path.join(out, 'genes', 'eco.txt'), 'w').close()
+        sys.exit(0)
+    time.sleep(0.05)
+sys.exit(1)
+"""
+COPY = "import shutil, sys; shutil.copyfile(sys.argv[1], sys.argv[2])"
+
+
+def make_stages(out):
+    def path(name):
+        return os.path.join(out, name)
+    return [
+        Stage('extract', [sys.executable, '-c', PRODUCER, out], outputs=[path('genes')], early=[path('table.txt')], pool='kegg'),
+        Stage('download', [sys.executable, '-c', COPY, path('table.txt'), path('seqs.fasta')], inputs=[path('table.txt')], outputs=[path('seqs.fasta')], pool='ncbi'),
+        Stage('convert', [sys.executable, '-c', COPY, path('genes/eco.txt'), path('genes.faa')], inputs=[path('genes')], outputs=[path('genes.faa')]),
+        Stage('broken', [sys.executable, '-c', 'import sys; sys.exit(2)'], inputs=[path('table.txt')], outputs=[path('broken.txt')]),
+        Stage('after_broken', [sys.executable, '-c', COPY, path('broken.txt'), path('after.txt')], inputs=[path('broken.txt')], outputs=[path('after.txt')]),
+    ]
+
+
+def test_pipeline(tmp_path):
+    out = str(tmp_path)
+    state_dir = os.path.join(out, '.pipeline')
+    # the download starts on the early table while the extractor still runs, otherwise the extractor fails
+    states = Pipeline(make_stages(out), state_dir, pools={'kegg': 1, 'ncbi': 1}, poll=0.05).run()
+    assert states == {'extract': DONE, 'download': DONE, 'convert': DONE, 'broken': FAILED, 'after_broken': BLOCKED}
+    assert os.path.exists(os.path.join(state_dir, 'broken.log'))
+
+    # nothing changed: the stages that succeeded are up to date, the failed one is tried again
+    states = Pipeline(make_stages(out), state_dir, poll=0.05).run()
+    assert states == {'extract': SKIPPED, 'download': SKIPPED, 'convert': SKIPPED, 'broken': FAILED, 'after_broken': BLOCKED}
+
+    # a changed input runs the stages that read it
+    with open(os.path.join(out, 'table.txt'), 'a') as fid:
+        fid.write('hsa\n')
+    states = Pipeline(make_stages(out), state_dir, poll=0.05).run(force=['convert'])
+    assert states['extract'] == SKIPPED and states['download'] == DONE and states['convert'] == DONE
+    with open(os.path.join(out, 'seqs.fasta')) as fid:
+        assert fid.read() == 'eco\nhsa\n'
+
+
+def test_pipeline_failed_rerun(tmp_path):
+    # a stage that writes its output and then exits non-zero (e.g. some downloads still fail) is run again next time
+    out = str(tmp_path)
+    state_dir = os.path.join(out, '.pipeline')
+    flaky = "import os, sys; open(sys.argv[1], 'w').close(); sys.exit(1 if os.path.exists(sys.argv[2]) else 0)"
+
+    def stages():
+        return [Stage('flaky', [sys.executable, '-c', flaky, os.path.join(out, 'out.txt'), os.path.join(out, 'fail')], outputs=[os.path.join(out, 'out.txt')])]
+
+    assert Pipeline(stages(), state_dir, poll=0.05).run() == {'flaky': DONE}
+    open(os.path.join(out, 'fail'), 'w').close()
+    assert Pipeline(stages(), state_dir, poll=0.05).run(force=['flaky']) == {'flaky': FAILED}
+    assert Pipeline(stages(), state_dir, poll=0.05).run() == {'flaky': FAILED}
+    os.remove(os.path.join(out, 'fail'))
+    assert Pipeline(stages(), state_dir, poll=0.05).run() == {'flaky': DONE}
+    assert Pipeline(stages(), state_dir, poll=0.05).run() == {'flaky': SKIPPED}
+
+
+# rewrites its early table once the reader of the first version has written its output
+REWRITER = """
+import os, sys, time
+out = sys.argv[1]
+time.sleep(0.3)
+for text in ['v1\\n', 'v2\\n']:
+    with open(os.path.join(out, 'table.txt.tmp'), 'w') as fid:
+        fid.write(text)
+    os.replace(os.path.join(out, 'table.txt.tmp'), os.path.join(out, 'table.txt'))
+    for _ in range(200):
+        if os.path.exists(os.path.join(out, 'copy.txt')):
+            break
+        time.sleep(0.05)
+open(os.path.join(out, 'genes.txt'), 'w').close()
+"""
+
+
+def test_pipeline_early_input(tmp_path):
+    out = str(tmp_path)
+    state_dir = os.path.join(out, '.pipeline')
+
+    def stages():
+        return [Stage('extract', [sys.executable, '-c', REWRITER, out], outputs=[os.path.join(out, 'genes.txt')], early=[os.path.join(out, 'table.txt')]),
+                Stage('copy', [sys.executable, '-c', COPY, os.path.join(out, 'table.txt'), os.path.join(out, 'copy.txt')],
+                      inputs=[os.path.join(out, 'table.txt')], outputs=[os.path.join(out, 'copy.txt')])]
+
+    # the table of an earlier run is not read before the extractor has written it again
+    with open(os.path.join(out, 'table.txt'), 'w') as fid:
+        fid.write('stale\n')
+    assert Pipeline(stages(), state_dir, poll=0.05).run() == {'extract': DONE, 'copy': DONE}
+    with open(os.path.join(out, 'copy.txt')) as fid:
+        assert fid.read() == 'v1\n'
+    # the copy was made from the first version of the table, so it is made again from the final one
+    assert Pipeline(stages(), state_dir, poll=0.05).run(force=[]) == {'extract': SKIPPED, 'copy': DONE}
+    with open(os.path.join(out, 'copy.txt')) as fid:
+        assert fid.read() == 'v2\n'
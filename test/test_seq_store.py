@@ -0,0 +1,26 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts'))
+from seq_store import SequenceStore, encode_sequence, decode_sequence, RAW, TWO_BIT_LOWER
+
+
+def test_encoding():
+    for seq in ['atgaaacgc', 'ATGAAACGCT', 'atgnnacgc', 'MKRISTTITTTITITTGNGAG', 'a']:
+        encoding, data = encode_sequence(seq)
+        assert decode_sequence(encoding, data, len(seq)) == seq
+    assert encode_sequence('atgaaacgc')[0] == TWO_BIT_LOWER
+    assert len(encode_sequence('atgaaacgc')[1]) == 3
+    assert encode_sequence('atgnnacgc')[0] == RAW
+
+
+def test_sequence_store(tmp_path):
+    store = SequenceStore(str(tmp_path / 'store'))
+    assert store.add_genes([('eco:b0001', 'MKR', 'atgaaacgc'), ('ecx:b0001', 'MKR', 'atgaaacgc'), ('eco:b0003', '', 'atgtga')]) == 3
+    # sequences that are already stored are not appended again
+    assert store.add_genes([('eco:b0002', 'MKR', None)]) == 0
+    store.close()
+    store = SequenceStore(str(tmp_path / 'store'))
+    genes = store.get_genes(['eco:b0001', 'ecx:b0001', 'eco:b0002', 'eco:b0003', 'eco:b9999'])
+    assert genes == {'eco:b0001': ('MKR', 'atgaaacgc'), 'ecx:b0001': ('MKR', 'atgaaacgc'), 'eco:b0002': ('MKR', ''), 'eco:b0003': ('', 'atgtga')}
+    assert '4 genes, 3 distinct sequences' in store.summary()
+    store.close()
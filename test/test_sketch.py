@@ -0,0 +1,55 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts'))
+import sourmash
+from sourmash import MinHash
+from convert_table_to_fasta import convert_table_to_FASTA, OUT_NAMES
+from convert_benchmark import render_fixture_tables
+from sketch import Taxonomy, table_records, fasta_records, sketch
+
+test_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_data', 'output')
+
+
+def _load(path):
+    return {x.name: x.minhash for x in sourmash.load_file_as_signatures(path)}
+
+
+def test_sketch(tmp_path):
+    table_dir = tmp_path / 'tables'
+    table_dir.mkdir()
+    # a few tables, writing a signature per gene is slow
+    file_names = render_fixture_tables(test_data, str(table_dir), genes_per_table=300)[:3]
+    organism_table = tmp_path / 'organism_table.txt'
+    organism_table.write_text('T_number\torg_code\tname\tlineage\ttaxaid\tgb_ncbi_seq_id\trs_ncbi_seq_ids\n'
+                              "T00001\taaa\tAcidovorax citrulli AAC00-1\tProkaryotes;Bacteria;Betaproteobacteria;Acidovorax\t397945\t['CP000512']\t['NC_008752']\n")
+    taxonomy = Taxonomy([str(organism_table)])
+    assert taxonomy.key_of('NC_008752.1') == 'aaa' and taxonomy.key_of('aaa:Acav_0001') == 'aaa'
+
+    # one signature per gene, straight from the tables; the same with workers and small batches
+    serial = str(tmp_path / 'genes.sig.zip')
+    n = sketch(table_records(file_names, 'protein', taxonomy), serial, str(tmp_path / 'genes.csv'), taxonomy, 10, 1, moltype='protein', protein_input=True)
+    parallel = str(tmp_path / 'genes_parallel.sig.zip')
+    assert sketch(table_records(file_names, 'protein', taxonomy), parallel, str(tmp_path / 'genes_parallel.csv'), taxonomy, 10, 1,
+                  moltype='protein', protein_input=True, processes=2, batch_size=10000) == n
+    genes = _load(serial)
+    assert len(genes) == n and _load(parallel) == genes
+
+    # the same genes from the FASTA files of the converter
+    out_files = [str(tmp_path / x) for x in OUT_NAMES]
+    convert_table_to_FASTA(file_names, *out_files)
+    from_fasta = str(tmp_path / 'fasta.sig.zip')
+    sketch(fasta_records(out_files[:2], taxonomy), from_fasta, str(tmp_path / 'fasta.csv'), taxonomy, 10, 1, moltype='protein', protein_input=True)
+    def by_gene_id(signatures):
+        return {name.split('|')[0].split(' ')[0]: sorted(minhash.hashes) for name, minhash in signatures.items()}
+    assert by_gene_id(_load(from_fasta)) == by_gene_id(genes)
+
+    # one signature per organism is the union of its genes, even when they are spread over batches and workers
+    organisms = str(tmp_path / 'organisms.sig.zip')
+    assert sketch(table_records(file_names, 'protein', taxonomy), organisms, str(tmp_path / 'organisms.csv'), taxonomy, 10, 1,
+                  moltype='protein', protein_input=True, group=True, processes=2, batch_size=10000) == 1
+    union = MinHash(n=0, ksize=10, scaled=1, is_protein=True)
+    for minhash in genes.values():
+        union.merge(minhash)
+    assert _load(organisms) == {'aaa Acidovorax citrulli AAC00-1': union}
+    with open(tmp_path / 'organisms.csv') as fid:
+        assert fid.read().splitlines() == ['ident,taxid,name,lineage', 'aaa,397945,Acidovorax citrulli AAC00-1,Prokaryotes;Bacteria;Betaproteobacteria;Acidovorax']
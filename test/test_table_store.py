@@ -0,0 +1,120 @@
+import os
+import sys
+import time
+import pytest
+import pandas as pd
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts'))
+from table_store import write_entry_table, read_entry_table, parquet_path, pack_gene_tables, read_gene_store, GeneTableWriter
+
+organism_table = pd.DataFrame({
+    'T_number': ['T00007', 'T00012', 'T01040'],
+    'org_code': ['eco', 'sce', 'hsa'],
+    'name': ['Escherichia coli K-12 MG1655', 'Saccharomyces cerevisiae', 'Homo sapiens'],
+    'lineage': ['Prokaryotes;Bacteria;Gammaproteobacteria', 'Eukaryotes;Fungi;Ascomycetes', 'Eukaryotes;Animals;Vertebrates'],
+    'taxaid': ['511145', '4932', '9606'],
+    'gb_ncbi_seq_id': [['U00096'], None, ['CM000663', 'CM000664']],
+    'rs_ncbi_seq_ids': [['NC_000913'], ['NC_001133'], None],
+})
+
+
+@pytest.mark.parametrize('store', ['tsv', 'parquet'])
+def test_entry_table(tmp_path, store):
+    if store == 'parquet':
+        pytest.importorskip('pyarrow')
+    path = str(tmp_path / 'organism_table.txt')
+    write_entry_table(organism_table, path, store)
+    assert os.path.exists(path) == (store == 'tsv')
+    assert os.path.exists(parquet_path(path)) == (store == 'parquet')
+    table = read_entry_table(path)
+    assert table['rs_ncbi_seq_ids'].tolist() == [['NC_000913'], ['NC_001133'], None]
+    table = read_entry_table(path, columns=['org_code', 'gb_ncbi_seq_id'], organisms=['bacteria', 'Fungi'])
+    assert list(table.columns) == ['org_code', 'gb_ncbi_seq_id']
+    assert table['org_code'].tolist() == ['eco', 'sce']
+    assert table['gb_ncbi_seq_id'].tolist() == [['U00096'], None]
+
+
+def test_gene_store(tmp_path):
+    pytest.importorskip('pyarrow')
+    gene_dir = tmp_path / 'kegg_gene_info'
+    gene_dir.mkdir()
+    (gene_dir / 'eco_kegg_genes.txt').write_text('kegg_gene_id\tdesc\tkoid\taaseq\tntseq\n'
+                                                 'eco:b0001\tthrL\tko:K08278\tMKR\tATGAAACGC\n'
+                                                 'eco:b0002\tthrA\tko:K12524\tMRV\tATGCGAGTG\n')
+    (gene_dir / 'sce_kegg_genes.txt').write_text('kegg_gene_id\tdesc\tkoid\taaseq\tntseq\n'
+                                                 'sce:YAL001C\tTFC3\t\tMVL\tATGGTACTG\n')
+    # a table that is not annotated yet is not packed
+    (gene_dir / 'hsa_kegg_genes.txt').write_text('kegg_gene_id\tdesc\nhsa:1\tA1BG\n')
+    store_dir = str(tmp_path / 'kegg_gene_info.parquet')
+    assert pack_gene_tables(str(gene_dir), store_dir) == 2
+    # unchanged tables are skipped
+    assert pack_gene_tables(str(gene_dir), store_dir) == 0
+    genes = read_gene_store(store_dir, columns=['kegg_gene_id', 'koid'], org_codes=['eco'])
+    assert list(genes.columns) == ['kegg_gene_id', 'koid']
+    assert genes.values.tolist() == [['eco:b0001', 'ko:K08278'], ['eco:b0002', 'ko:K12524']]
+    assert sorted(read_gene_store(store_dir, columns=['kegg_gene_id'])['kegg_gene_id']) == ['eco:b0001', 'eco:b0002', 'sce:YAL001C']
+    # the partition of an organism whose gene table is removed (e.g. by --sync) goes as well
+    (gene_dir / 'sce_kegg_genes.txt').unlink()
+    assert pack_gene_tables(str(gene_dir), store_dir) == 0
+    assert sorted(read_gene_store(store_dir, columns=['kegg_gene_id'])['kegg_gene_id']) == ['eco:b0001', 'eco:b0002']
+
+
+def test_virus_gene_store(tmp_path):
+    pytest.importorskip('pyarrow')
+    gene_dir = tmp_path / 'kegg_gene_info'
+    gene_dir.mkdir()
+    header = 'kegg_gene_id\ttaxaid\tkoid\taaseq\tntseq\tdesc\n'
+    vg = 'vg:155971\t10665\tko:K00001\tMSA\tATG\tpolyprotein\n'
+    vp = 'vp:NP_040309\t10665\t\tMKR\tATG\tcapsid\n'
+    (gene_dir / 'gene_table.txt').write_text(header + vg + vp)
+    store_dir = str(tmp_path / 'kegg_gene_info.parquet')
+    assert pack_gene_tables(str(gene_dir), store_dir) == 2
+    assert pack_gene_tables(str(gene_dir), store_dir) == 0
+    # a new gene table: only the gene set that changed is written, and the one that is gone is removed
+    os.utime(gene_dir / 'gene_table.txt', (time.time() + 10, time.time() + 10))
+    assert pack_gene_tables(str(gene_dir), store_dir) == 0
+    (gene_dir / 'gene_table.txt').write_text(header + vg.replace('polyprotein', 'updated'))
+    os.utime(gene_dir / 'gene_table.txt', (time.time() + 20, time.time() + 20))
+    assert pack_gene_tables(str(gene_dir), store_dir) == 1
+    assert os.listdir(store_dir) == ['org_code=vg']
+    assert read_gene_store(store_dir, columns=['desc'])['desc'].tolist() == ['updated']
+
+
+def test_gene_table_writer(tmp_path):
+    path = str(tmp_path / 'gene_table.txt')
+    columns = ['kegg_gene_id', 'koid', 'aaseq', 'desc']
+    rows = [('vg:155971', 'ko:K00001', 'MSA', 'polyprotein'), ('vg:155972', None, 'MKR', 'hypothetical'),
+            ('vp:NP_040309', None, '', 'capsid'), ('vp:NP_040310', 'ko:K00002', 'MVL', 'coat')]
+    writer = GeneTableWriter(path, columns, chunk_rows=2)
+    writer.add(rows[:2])
+    writer.add(rows[2:3])
+    # interrupted after the first chunk, in the middle of writing a row
+    writer._out_handle.write('vp:NP_0403')
+    writer._out_handle.close()
+    writer._checkpoint_handle.close()
+    assert not os.path.exists(path)
+    writer = GeneTableWriter(path, columns, chunk_rows=2)
+    assert writer.done == {'vg:155971', 'vg:155972'}
+    writer.add([x for x in rows if x[0] not in writer.done])
+    writer.commit()
+    assert not os.path.exists(path + '.partial')
+    table = pd.read_csv(path, sep='\t', header=0, dtype=str, keep_default_na=False)
+    assert list(table.columns) == columns
+    assert table.values.tolist() == [[x if x is not None else '' for x in row] for row in rows]
+
+
+def test_gene_table_writer_run(tmp_path):
+    path = str(tmp_path / 'gene_table.txt')
+    columns = ['kegg_gene_id', 'koid', 'aaseq', 'desc']
+    writer = GeneTableWriter(path, columns, chunk_rows=1, run={'ko_only': True})
+    writer.add([('vg:155971', 'ko:K00001', None, 'polyprotein')])
+    writer.close()
+    writer = GeneTableWriter(path, columns, chunk_rows=1, run={'ko_only': True})
+    assert writer.done == {'vg:155971'} and not writer.discarded
+    writer.close()
+    # the rows of a --ko_only run have no sequences, so a run with sequences starts over
+    writer = GeneTableWriter(path, columns, chunk_rows=1, run={'ko_only': False})
+    assert writer.done == set() and writer.discarded
+    writer.add([('vg:155972', None, 'MKR', 'hypothetical')])
+    writer.commit()
+    table = pd.read_csv(path, sep='\t', header=0, dtype=str, keep_default_na=False)
+    assert table.values.tolist() == [['vg:155972', '', 'MKR', 'hypothetical']]
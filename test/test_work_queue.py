@@ -0,0 +1,51 @@
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts'))
+from work_queue import WorkQueue, DONE, FAILED, PENDING
+
+
+def test_work_queue(tmp_path):
+    path = str(tmp_path / 'queue.sqlite')
+    first = WorkQueue(path, lease=60, max_attempts=2, worker_id='host1:1')
+    second = WorkQueue(path, lease=60, max_attempts=2, worker_id='host2:1')
+    assert first.add(['aaa', 'eco', 'hsa']) == 3
+    assert first.add(['aaa', 'zaab']) == 1
+    assert first.claim(2) == ['aaa', 'eco']
+    assert second.claim(2) == ['hsa', 'zaab']
+    assert second.claim() == []
+    assert first.complete('aaa')
+    # a failed job is tried again, until max_attempts
+    assert first.fail('eco', 'timeout')
+    assert second.claim() == ['eco']
+    assert second.fail('eco', 'timeout')
+    assert second.claim() == []
+    assert [x[:2] for x in first.jobs(FAILED)] == [('eco', FAILED)]
+    # the other worker cannot complete a job it does not hold
+    assert not first.complete('hsa')
+    assert second.complete('hsa')
+    assert first.counts() == {PENDING: 0, 'leased': 1, DONE: 2, FAILED: 1}
+    first.requeue(['eco'])
+    assert first.claim() == ['eco']
+    first.close()
+    second.close()
+
+
+def test_work_queue_lease(tmp_path):
+    path = str(tmp_path / 'queue.sqlite')
+    crashed = WorkQueue(path, lease=0.5, worker_id='host1:1')
+    alive = WorkQueue(path, lease=0.5, worker_id='host1:2')
+    crashed.add(['aaa', 'eco'])
+    assert crashed.claim() == ['aaa']
+    assert alive.claim() == ['eco']
+    alive.start_heartbeat(interval=0.1)
+    time.sleep(1)
+    # the lease of the worker without heartbeat expired, the other one is still held
+    other = WorkQueue(path, lease=0.5, worker_id='host2:1')
+    assert other.claim(2) == ['aaa']
+    assert not crashed.complete('aaa')
+    assert other.complete('aaa')
+    assert alive.complete('eco')
+    assert [x[1] for x in other.jobs()] == [DONE, DONE]
+    for queue in [crashed, alive, other]:
+        queue.close()